@@ -1,25 +1,67 @@
 # -*- coding: utf-8 -*-
 
+import os
 import re
 import sys
+import asyncio
 import time
+import heapq
+import random
+import hashlib
+import logging
+import operator
+import functools
+import itertools
 import datetime
 import argparse
 import unittest.mock as mock
-from collections import namedtuple
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from threading import Thread, Lock, Event
 
 import yaml
 import boto3
 import jmespath
-from prometheus_client.core import REGISTRY, GaugeMetricFamily
+import jmespath.exceptions
+from prometheus_client.core import REGISTRY, CounterMetricFamily, GaugeMetricFamily
 from prometheus_client import start_http_server
 
-__all__ = ["AwsMetric", "AwsMetricsCollector", "parse_aws_metrics"]
+from aws_prometheus_exporter.cloudwatch import get_metric_data_pages, merge_latest_values, metric_data_query
+from aws_prometheus_exporter.clients import AssumedRoleCredentials, ClientPool, account_from_role_arn
+from aws_prometheus_exporter.exposition import RenderedExposition, render_families, start_exposition_server
+from aws_prometheus_exporter.instrumentation import CollectorInstrumentation, RequestCounter
+from aws_prometheus_exporter.ratelimit import AdaptiveRateLimiter
+from aws_prometheus_exporter.profiling import UpdateProfiler
+from aws_prometheus_exporter.persistence import load_snapshot_file, save_snapshot_file
+from aws_prometheus_exporter.samples import SampleTable, SampleTableBuilder
+from aws_prometheus_exporter.sharding import assign_shards
 
+__all__ = [
+    "AdaptiveRateLimiter",
+    "AwsMetric",
+    "AwsMetricsCollector",
+    "AwsTarget",
+    "ClientPool",
+    "CloudWatchQuery",
+    "Incremental",
+    "JmesPathSearch",
+    "MetricScheduler",
+    "MetricsFileReloader",
+    "RenderedExposition",
+    "SampleTable",
+    "Snapshot",
+    "UpdateProfiler",
+    "parse_aws_metrics",
+    "shard_metrics",
+    "start_exposition_server",
+]
+
+logger = logging.getLogger(__name__)
 
 VALID_METRIC_NAME_RE = re.compile("^[a-z_0-9]+$")
 
+METRICS_CHECK_SECONDS = 1.0  # see MetricScheduler.run()
+
 AwsMetric = namedtuple("AwsMetric", [
     "name",
     "description",
@@ -28,8 +70,17 @@ AwsMetric = namedtuple("AwsMetric", [
     "method_args",
     "use_paginator",
     "label_names",
-    "search"
-])
+    "search",
+    "interval",
+    "aggregate",
+    "method_args_expression",
+    "incremental",
+    "cost",
+    "max_age",
+    "cloudwatch",
+    "timeout",
+    "max_series"
+], defaults=(None, None, None, None, None, None, None, None, None))
 
 AwsMetric.__doc__ = """
 AwsMetric object describe a Gauge obtained from a boto3 API call.
@@ -40,8 +91,121 @@ service: the AWS service, as per boto3.Session::client(service)
 method: the name of the boto3 client method or paginator (e.g. 'list_objects' for the 's3' service)
 method_args: kwargs to be given to the client method or paginator
 use_paginator: set to True to use a paginator instead of a client method
-search: JMESPath expression used for client-side filtration and projection (must evaluate to a list of dicts)
+search: JMESPath expression used for client-side filtration and projection (must evaluate to a list of dicts),
+        as a JmesPathSearch (AwsMetricsCollector compiles plain str expressions itself)
 label_names: keys of the dicts returned by the JMESPath expression (also the label names of the Prometheus gauge)
+interval (optional): seconds between refreshes of this metric when run by a MetricScheduler
+aggregate (optional): one of AGGREGATE_FUNCTIONS, to export a single sample per distinct combination of label_names
+                      (the group-by labels) instead of one per search result, reducing their values with that function.
+                      'count' counts the search results of each group, which then need no 'value' property.
+method_args_expression (optional): a Python expression evaluating to the method_args dict, evaluated again before
+                                   every refresh (with access to datetime and timedelta), e.g. to move a time window
+incremental (optional): an Incremental object, to only fetch the items newer than those fetched by previous refreshes
+cost (optional): relative cost of collecting this metric (1 by default), used to balance shards (see shard_metrics())
+max_age (optional): seconds after which the samples of this metric get refreshed when scraped, instead of by a
+                    MetricScheduler (see AwsMetricsCollector.refresh_stale_metrics())
+cloudwatch (optional): a CloudWatchQuery, to export CloudWatch statistics instead of the results of method. service
+                       is then 'cloudwatch', method 'get_metric_data', search None, and label_names the dimension names
+timeout (optional): seconds allowed to collect this metric, after which it keeps its previous samples (see the
+                    metric_timeout of AwsMetricsCollector)
+max_series (optional): maximum number of samples exported per target, keeping those with the highest values (after
+                       aggregation, if any) and dropping the others
+"""
+
+Incremental = namedtuple("Incremental", [
+    "watermark_arg",
+    "items",
+    "timestamp",
+    "key"
+])
+
+Incremental.__doc__ = """
+Incremental objects describe how to refresh a metric incrementally, for APIs filtering items by time (e.g. the
+CreatedAfter argument of EMR list_clusters). The items fetched are cached along with the latest of their timestamps,
+the watermark. The next refresh passes the watermark as watermark_arg, so only newer items get fetched, and merged
+into the cached ones. Cached items older than the value of watermark_arg in method_args (or method_args_expression)
+expire. The search of the metric then applies to a single page holding every cached item.
+
+watermark_arg: the name of the method argument set to the watermark (e.g. 'CreatedAfter')
+items: the key of the list of items in each page (e.g. 'Clusters')
+timestamp: JMESPath expression of the timestamp of an item, as a JmesPathSearch
+           (e.g. 'Status.Timeline.CreationDateTime')
+key: JMESPath expression identifying an item, as a JmesPathSearch (e.g. 'Id')
+"""
+
+CloudWatchQuery = namedtuple("CloudWatchQuery", [
+    "namespace",
+    "metric_name",
+    "statistic",
+    "period",
+    "dimensions"
+])
+
+CloudWatchQuery.__doc__ = """
+CloudWatchQuery objects describe the CloudWatch statistics exported by a metric, one sample per set of dimensions,
+labelled with the dimension values. The queries of all the metrics sharing a namespace are packed into GetMetricData
+requests of up to 500 queries each, and each sample is the latest datapoint of its query.
+
+namespace: the CloudWatch namespace (e.g. 'AWS/EC2')
+metric_name: the CloudWatch metric name (e.g. 'CPUUtilization')
+statistic: the statistic to get (e.g. 'Average', 'Sum' or 'p99')
+period: the period of the statistic, in seconds
+dimensions: a list of dicts of dimension name to value, all with the same names, in the order of the label_names of
+            the metric
+"""
+
+METHOD_ARGS_GLOBALS = {"datetime": datetime.datetime, "timedelta": datetime.timedelta}
+
+AGGREGATE_FUNCTIONS = {
+    "sum": operator.add,
+    "count": operator.add,
+    "min": min,
+    "max": max,
+}
+
+class JmesPathSearch(str):
+    """
+    A JMESPath expression, compiled once when created. It behaves as the str of the expression everywhere else.
+    Raises jmespath.exceptions.ParseError if the expression is invalid.
+    """
+
+    def __new__(cls, expression):
+        search = super().__new__(cls, expression)
+        search.parsed = jmespath.compile(expression)
+        return search
+
+    def search(self, data):
+        return self.parsed.search(data)
+
+
+AwsTarget = namedtuple("AwsTarget", [
+    "region",
+    "role_arn"
+], defaults=(None,))
+
+AwsTarget.__doc__ = """
+AwsTarget objects describe a region and account to collect metrics from (see AwsMetricsCollector).
+
+region: the AWS region name (e.g. 'us-east-1')
+role_arn (optional): the ARN of a role to assume (e.g. in another account), or None to use the collector's session
+"""
+
+Snapshot = namedtuple("Snapshot", [
+    "data",
+    "timestamps",
+    "timestamp",
+    "stale"
+], defaults=(frozenset(),))
+
+Snapshot.__doc__ = """
+Snapshot objects hold the result of complete update cycles. They are never mutated once built:
+each update builds a new one and swaps it in, so collect() can keep serving the previous one meanwhile.
+
+data: dict of (target, metric_name) to SampleTable (which yields (label_values, value) samples), where target is an
+      AwsTarget (or None for metrics collected from the collector's session)
+timestamps: dict of (target, metric_name) to the time.time() at which its samples were collected
+timestamp: the oldest of timestamps, or None if no update has completed yet
+stale (optional): frozenset of the keys of data loaded from a persisted snapshot, and not refreshed since
 """
 
 
@@ -49,85 +213,1437 @@ class AwsMetricsCollector:
     """
     Prometheus Collector for AwsMetric objects. Must be registered with a CollectorRegistry.
     Call update() periodically to refresh the gauge values (this method is thread-safe).
+    collect() always serves the last complete snapshot, and only waits on AWS API calls to refresh the metrics with a
+    max_age, for at most scrape_timeout seconds.
     See __main__.py for an example of usage.
     """
 
-    def __init__(self, metrics, session, label_names=None, label_values=None):
+    def __init__(self, metrics, session, label_names=None, label_values=None,
+                 max_workers=1, max_workers_per_service=None, client_config=None, targets=None, rate_limits=None,
+                 snapshot_path=None, scrape_timeout=5.0, metric_timeout=None, cycle_budget=None, max_pages=None,
+                 exporter_metrics=True):
         """
         metrics: a list of AwsMetric objects
         session: a boto3 session with an AWS region_name configured
         label_names (optional): a list of extra labels names to add to the underlying GaugeMetricFamily
         label_values (optional): corresponding values for label_names
+        max_workers (optional): maximum number of metrics collected concurrently (1 collects them sequentially)
+        max_workers_per_service (optional): maximum number of concurrent collections per AWS service and target
+        client_config (optional): a botocore.config.Config for the boto3 clients, which are reused across updates
+        targets (optional): a list of AwsTarget objects to collect every metric from, instead of from session alone.
+                            session is then only used to assume the roles of the targets. 'region' and 'account'
+                            labels get added to every gauge, after label_names.
+        rate_limits (optional): enables adaptive rate limiting (see AdaptiveRateLimiter) of the API calls made to each
+                                target, with a dict of "service" or "service.OperationName" to requests per second.
+                                The "*" key sets the rate of the other APIs (10 requests per second by default).
+        snapshot_path (optional): the path of a file to persist every new snapshot to, and to load it from on startup
+                                  with load_snapshot()
+        scrape_timeout (optional): seconds a scrape waits for at most for the metrics with a max_age to be refreshed
+                                   (see refresh_stale_metrics())
+        metric_timeout (optional): seconds allowed to collect a metric which does not specify a timeout
+        cycle_budget (optional): seconds allowed to collect all the metrics of an update
+        max_pages (optional): maximum number of pages fetched by any one call, beyond which it counts as failed
+        exporter_metrics (optional): whether collect() and describe() yield the aws_prometheus_exporter_* metrics
+                                     describing the collector itself. Only one of the collectors registered with a
+                                     CollectorRegistry may yield them, as their names would be duplicated otherwise.
+        A metric exceeding its timeout or the cycle budget is stopped, keeps its previous samples, and gets counted
+        by the aws_prometheus_exporter_metric_timeouts_total metric. Metrics which did not start within the cycle
+        budget are skipped. Deadlines are checked between pages: a single hanging API call is bounded by the timeouts
+        of client_config instead, except with update_async(), which stops waiting for it.
         """
         super().__init__()
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        if max_workers_per_service is not None and max_workers_per_service < 1:
+            raise ValueError("max_workers_per_service must be at least 1")
+        if scrape_timeout < 0:
+            raise ValueError("scrape_timeout must not be negative")
+        for (name, value) in (("metric_timeout", metric_timeout), ("cycle_budget", cycle_budget)):
+            if value is not None and value <= 0:
+                raise ValueError("%s must be positive" % name)
+        if max_pages is not None and max_pages < 1:
+            raise ValueError("max_pages must be at least 1")
+        _validate_metrics(metrics)
         self._session = session
-        self._metrics = metrics
-        self._data_lock = Lock()
-        self._data = {}  # dict of metric_name to list of (label_values, value)
+        self._request_counter = RequestCounter()
+        self._clients = ClientPool(session, client_config, on_create=self._request_counter.register)
+        self._metrics_lock = Lock()  # serializes set_metrics()
+        self._metrics = [_compile_search(metric) for metric in metrics]
+        self._max_workers = max_workers
+        self._max_workers_per_service = max_workers_per_service
+        self._data_lock = Lock()  # guards the swap of self._snapshot only, never held during API calls
+        self._snapshot = Snapshot(data={}, timestamps={}, timestamp=None)
         self._label_names = label_names or []
         self._label_values = label_values or []
+        self._string_pool = {}  # interned label values, see SampleTableBuilder and _prune_string_pool()
+        self._incremental_lock = Lock()
+        self._incremental_states = {}  # dict of (target, call signature) to _IncrementalState
+        self._snapshot_path = snapshot_path
+        self._save_lock = Lock()
+        self._scrape_timeout = scrape_timeout
+        self._metric_timeout = metric_timeout
+        self._cycle_budget = cycle_budget
+        self._max_pages = max_pages
+        self._exporter_metrics = exporter_metrics
+        self._profiler_lock = Lock()
+        self._profiler = None  # the UpdateProfiler of the update cycles being profiled, if any
+        self._profile_report = None
+        self._flights_lock = Lock()
+        self._flights = {}  # dict of call signature to the Event set once its refresh on scrape completes
+
+        def target_state(target):
+            rate_limiter = None
+            if rate_limits is not None:
+                rates = {api: rate for (api, rate) in rate_limits.items() if api != "*"}
+                rate_limiter = AdaptiveRateLimiter(rates, default_rate=rate_limits.get("*", 10.0))
+            return _TargetState(target, session, self._clients, self._label_values, client_config, rate_limiter,
+                                self._request_counter)
+
+        self._target_label_names = [] if targets is None else ["region", "account"]
+        self._targets = [target_state(target) for target in (targets if targets is not None else [None])]
+        self._instrumentation = CollectorInstrumentation(self._label_names, self._target_label_names)
+        self._render_lock = Lock()
+        self._rendered_families = {}  # dict of metric_name to (tuple of the sample lists rendered, exposition text)
+        self._exposition = None
+        self._render_snapshot()
 
     def update(self):
         """
         Makes the boto3 API calls, collects the results, and stores them for use when collect() gets
         called by prometheus_client. Should be called regularly to maintain up-to-date metrics.
         Calling this too frequently may cause Rate Exceeded errors.
+        A new snapshot is built without holding any lock, then swapped in atomically once complete.
+        Metrics which fail to be collected (from a given target) are logged, and keep their previous samples.
+        This method is thread-safe.
+        """
+        self.update_metrics(self._metrics)
+
+    def update_metrics(self, metrics):
+        """
+        Same as update(), but only refreshes the given subset of the collector's AwsMetric objects.
+        The samples of other metrics are carried over from the current snapshot.
         This method is thread-safe.
         """
+        start_time = time.monotonic()
+        data = self._collect_metrics(metrics)
+        self._finish_update(data, start_time, metrics)
+
+    def set_metrics(self, metrics):
+        """
+        Replaces the AwsMetric objects collected by this collector, e.g. after reloading the metrics file.
+        Metrics which did not change keep their samples, clients and state. The samples of metrics which were removed
+        or changed are dropped, and samples being collected for them by an update in progress get discarded.
+        Returns the list of metrics which were added or changed, and have no samples until refreshed.
+        This method is thread-safe.
+        """
+        _validate_metrics(metrics)
+        with self._metrics_lock:
+            previous = {metric.name: metric for metric in self._metrics}
+            new_metrics = []
+            changed = []
+            for metric in (_compile_search(metric) for metric in metrics):
+                kept = previous.get(metric.name)
+                if kept is not None and _definition(kept) == _definition(metric):
+                    new_metrics.append(kept)
+                else:
+                    new_metrics.append(metric)
+                    changed.append(metric)
+            kept_names = {metric.name for metric in new_metrics} - {metric.name for metric in changed}
+            with self._data_lock:
+                self._metrics = new_metrics
+                data = {key: samples for (key, samples) in self._snapshot.data.items() if key[1] in kept_names}
+                timestamps = {key: t for (key, t) in self._snapshot.timestamps.items() if key[1] in kept_names}
+                self._snapshot = Snapshot(
+                    data=data,
+                    timestamps=timestamps,
+                    timestamp=min(timestamps.values()) if timestamps else None,
+                    stale=self._snapshot.stale.intersection(data)
+                )
+            signatures = {_call_signature(metric) for metric in new_metrics}
+            with self._incremental_lock:
+                self._incremental_states = {
+                    key: state for (key, state) in self._incremental_states.items() if key[1] in signatures
+                }
+            with self._render_lock:
+                for metric in changed:
+                    self._rendered_families.pop(metric.name, None)
+        self._render_snapshot()
+        return changed
+
+    def refresh_stale_metrics(self, timeout=None):
+        """
+        Refreshes the metrics with a max_age whose samples (from any target) are older than it, or missing, and waits
+        for them to be swapped in for at most timeout seconds (scrape_timeout by default). Refreshes which are not done
+        by then carry on in the background, and the current samples get served meanwhile.
+        Concurrent calls share the refreshes in flight instead of starting their own, so scrapes made at the same time
+        (e.g. by a pair of Prometheus servers) result in a single set of API calls.
+        Returns True if every refresh was done in time. This method is thread-safe, and called by collect().
+        """
+        deadline = time.monotonic() + (self._scrape_timeout if timeout is None else timeout)
+        flights = self._refreshes_in_flight(self._stale_call_groups())
+        return all(flight.wait(max(0.0, deadline - time.monotonic())) for flight in flights)
+
+    def _stale_call_groups(self):
+        snapshot = self.snapshot()
+        now = time.time()
+        stale = []
+        for metric in self._metrics:
+            if metric.max_age is None:
+                continue
+            timestamps = [snapshot.timestamps.get((target_state.target, metric.name)) for target_state in self._targets]
+            if any(timestamp is None or now - timestamp >= metric.max_age for timestamp in timestamps):
+                stale.append(metric)
+        return _group_by_call_signature(stale)
+
+    def _refreshes_in_flight(self, call_groups):
+        """
+        Returns the Events of the refreshes of call_groups in flight, starting a single refresh of those with none on a
+        new thread. That refresh collects them together, within max_workers and max_workers_per_service.
+        """
+        flights = set()
+        missing = []
+        with self._flights_lock:
+            for call_group in call_groups:
+                signature = _call_signature(call_group[0])
+                flight = self._flights.get(signature)
+                if flight is None:
+                    missing.append((signature, call_group))
+                else:
+                    flights.add(flight)
+            if missing:
+                flight = Event()
+                for (signature, _) in missing:
+                    self._flights[signature] = flight
+                flights.add(flight)
+                Thread(
+                    target=self._refresh_call_groups,
+                    args=(missing, flight),
+                    name="aws-collector-scrape",
+                    daemon=True
+                ).start()
+        return list(flights)
+
+    def _refresh_call_groups(self, call_groups, flight):
+        try:
+            self.update_metrics([metric for (_, call_group) in call_groups for metric in call_group])
+        finally:
+            with self._flights_lock:
+                for (signature, _) in call_groups:
+                    del self._flights[signature]
+            flight.set()
+
+    async def update_async(self, metrics=None, concurrency=10, call_timeout=None):
+        """
+        Coroutine version of update_metrics() (or of update() if metrics is None), for use in asyncio applications.
+        Up to concurrency call groups are collected at once, with at most max_workers_per_service of any given service
+        and target. Blocking boto3 calls run on a pool of concurrency threads, one page at a time, so the event loop
+        is never blocked by them, and cancellation takes effect between pages.
+        Builds and swaps in a new snapshot like update() does, which collect() then serves. If cancelled, the snapshot
+        is left as it was.
+        call_timeout (optional): seconds allowed to fetch and process any one page; a call group timing out keeps its
+                                 previous samples, like one exceeding its timeout or the cycle budget
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        start_time = time.monotonic()
+        cycle_deadline = self._cycle_deadline(start_time)
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="aws-collector-async")
+        try:
+            semaphore = asyncio.Semaphore(concurrency)
+            per_service = min(concurrency, self._max_workers_per_service or concurrency)
+            service_semaphores = {}
+            coroutines = []
+            for unit in self._units(self._metrics if metrics is None else metrics):
+                (target_state, call_group) = unit
+                service_semaphore = service_semaphores.setdefault(
+                    (id(target_state), call_group[0].service), asyncio.Semaphore(per_service)
+                )
+                coroutines.append(self._collect_unit_async(
+                    unit, loop, executor, semaphore, service_semaphore, call_timeout, cycle_deadline
+                ))
+            results = await asyncio.gather(*coroutines)
+            data = {}
+            for result in results:
+                data.update(result)
+            await loop.run_in_executor(
+                executor, self._finish_update, data, start_time, self._metrics if metrics is None else metrics
+            )
+        finally:
+            executor.shutdown(wait=False)
+
+    def load_snapshot(self):
+        """
+        Loads the snapshot persisted to snapshot_path (see the constructor), if any, and serves it until the metrics it
+        holds get refreshed, marked as stale (see Snapshot.stale and the aws_prometheus_exporter_snapshot_stale metric).
+        Samples keep the age they had, and only the samples of metrics and targets which are still configured the same
+        way are loaded. Returns the number of (target, metric) sample sets loaded. Invalid files are logged and ignored.
+        """
+        if self._snapshot_path is None:
+            raise ValueError("no snapshot_path was given to the collector")
+        if not os.path.exists(self._snapshot_path):
+            return 0
+        try:
+            entries = load_snapshot_file(self._snapshot_path)
+        except (OSError, ValueError):
+            logger.exception("failed to load the snapshot persisted to %s", self._snapshot_path)
+            return 0
+        targets = {_target_key(target_state.target): target_state.target for target_state in self._targets}
         with self._data_lock:
-            self._data = {}
-            for metric in self._metrics:
-                self._data[metric.name] = self._collect_metric(metric)
+            metric_keys = {_metric_key(metric): metric.name for metric in self._metrics}
+            data = dict(self._snapshot.data)
+            timestamps = dict(self._snapshot.timestamps)
+            loaded = set()
+            for (key, timestamp, table) in entries:
+                (metric_key, target_key) = (tuple(key[:2]), tuple(key[2:]))
+                if metric_key not in metric_keys or target_key not in targets:
+                    continue
+                data_key = (targets[target_key], metric_keys[metric_key])
+                if data_key in data:
+                    continue  # already collected
+                table.strings = [self._string_pool.setdefault(string, string) for string in table.strings]
+                data[data_key] = table
+                timestamps[data_key] = timestamp
+                loaded.add(data_key)
+            self._snapshot = Snapshot(
+                data=data,
+                timestamps=timestamps,
+                timestamp=min(timestamps.values()) if timestamps else None,
+                stale=self._snapshot.stale.union(loaded)
+            )
+        self._render_snapshot()
+        logger.info("loaded %d sample sets from the snapshot persisted to %s", len(loaded), self._snapshot_path)
+        return len(loaded)
+
+    def start_profiling(self, cycles=1, report_path=None):
+        """
+        Profiles the collection of metrics until the next cycles update cycles have completed (each call to update(),
+        update_metrics() or update_async() being a cycle), with cProfile and tracemalloc, breaking down time and memory
+        by metric and phase (see UpdateProfiler). The report is then written to report_path, if given, and returned by
+        profile_report(). Profiling slows collection down. Returns the UpdateProfiler.
+        """
+        profiler = UpdateProfiler(cycles, report_path)
+        with self._profiler_lock:
+            if self._profiler is not None:
+                raise ValueError("update cycles are already being profiled")
+            profiler.start()
+            self._profiler = profiler
+        return profiler
+
+    def profile_report(self):
+        """
+        Returns the text of the report of the last profiling completed (see start_profiling()), or None.
+        """
+        return self._profile_report
+
+    def _profiling_finished(self, profiler):
+        with self._profiler_lock:
+            if self._profiler is profiler:
+                self._profiler = None
+        self._profile_report = profiler.report()
+        logger.info("profiled %d update cycles%s", profiler.cycles,
+                    "" if profiler.report_path is None else ", see %s" % profiler.report_path)
+
+    def _save_snapshot(self):
+        with self._save_lock:
+            snapshot = self.snapshot()
+            metric_keys = {metric.name: _metric_key(metric) for metric in self._metrics}
+            entries = []
+            for (key, table) in snapshot.data.items():
+                target, metric_name = key
+                if metric_name in metric_keys:
+                    entries.append(
+                        (list(metric_keys[metric_name]) + list(_target_key(target)), snapshot.timestamps[key], table)
+                    )
+            try:
+                save_snapshot_file(self._snapshot_path, entries)
+            except OSError:
+                logger.exception("failed to persist the snapshot to %s", self._snapshot_path)
+
+    def _finish_update(self, data, start_time, metrics):
+        self._merge_snapshot(data, time.time(), metrics)
+        if self._snapshot_path is not None:
+            self._save_snapshot()
+        self._prune_string_pool()
+        self._render_snapshot()
+        self._instrumentation.observe_update(self._label_values, time.monotonic() - start_time)
+        profiler = self._profiler
+        if profiler is not None and profiler.cycle_finished():
+            self._profiling_finished(profiler)
+
+    @property
+    def metrics(self):
+        """
+        The list of AwsMetric objects collected by this collector.
+        """
+        return self._metrics
 
     def collect(self):
         """
-        Yields GaugeMetricFamily objects, as expected by CollectorRegistry.
+        Yields GaugeMetricFamily objects, as expected by CollectorRegistry, once the metrics with a max_age have been
+        refreshed (see refresh_stale_metrics()). This method is thread-safe.
+        """
+        self.refresh_stale_metrics()
+        yield from self.describe()
+
+    def describe(self):
+        """
+        Yields the same metric families as collect(), but without refreshing the metrics with a max_age first, so that
+        registering the collector with a CollectorRegistry makes no API calls. This method is thread-safe.
+        """
+        snapshot = self.snapshot()
+        for m in self._metrics:
+            yield self._metric_family(m, snapshot)
+        if self._exporter_metrics:
+            yield from self._collect_exporter_metrics(snapshot)
+
+    def exposition(self):
+        """
+        Returns the RenderedExposition of the metrics of the current snapshot, i.e. what collect() yields except for
+        the metrics describing the collector itself (see render_exporter_metrics()).
+        It is rendered once per snapshot swap, and only the metrics which changed get rendered again.
         This method is thread-safe.
         """
+        return self._exposition
+
+    def render_exporter_metrics(self):
+        """
+        Returns the exposition text of the metrics describing the collector itself, which change on every scrape.
+        """
+        return render_families(list(self._collect_exporter_metrics(self.snapshot())))
+
+    def _metric_family(self, metric, snapshot):
+        gauge = GaugeMetricFamily(
+            metric.name,
+            metric.description,
+            labels=self._label_names + self._target_label_names + metric.label_names
+        )
+        for target_state in self._targets:
+            for (label_values, value) in snapshot.data.get((target_state.target, metric.name), []):
+                gauge.add_metric(label_values, value)
+        return gauge
+
+    def _render_snapshot(self):
+        with self._render_lock:
+            snapshot = self.snapshot()
+            rendered_families = {}
+            for metric in self._metrics:
+                sources = tuple(snapshot.data.get((target_state.target, metric.name)) for target_state in self._targets)
+                rendered = self._rendered_families.get(metric.name)
+                if rendered is None or any(a is not b for (a, b) in zip(rendered[0], sources)):
+                    rendered = (sources, render_families([self._metric_family(metric, snapshot)]))
+                rendered_families[metric.name] = rendered
+            self._rendered_families = rendered_families
+            self._exposition = RenderedExposition(b"".join(text for (_, text) in rendered_families.values()))
+
+    def _collect_exporter_metrics(self, snapshot):
+        """
+        Yields the metrics describing the collector itself.
+        """
+        age = GaugeMetricFamily(
+            "aws_prometheus_exporter_snapshot_age_seconds",
+            "Seconds since the oldest samples of the snapshot currently being served were collected",
+            labels=self._label_names
+        )
+        if snapshot.timestamp is not None:
+            age.add_metric(self._label_values, max(0.0, time.time() - snapshot.timestamp))
+        yield age
+        stale = GaugeMetricFamily(
+            "aws_prometheus_exporter_snapshot_stale",
+            "1 while some of the samples being served were loaded from a persisted snapshot, and not refreshed since",
+            labels=self._label_names
+        )
+        stale.add_metric(self._label_values, 1 if snapshot.stale else 0)
+        yield stale
+        yield from self._instrumentation.collect()
+        rate_limited_targets = [t for t in self._targets if t.rate_limiter is not None]
+        if rate_limited_targets:
+            label_names = self._label_names + self._target_label_names + ["service", "operation"]
+            throttled = CounterMetricFamily(
+                "aws_prometheus_exporter_throttled_requests",
+                "Number of AWS API requests which got a throttling response",
+                labels=label_names
+            )
+            rate_limit = GaugeMetricFamily(
+                "aws_prometheus_exporter_api_rate_limit",
+                "Requests per second currently allowed by the adaptive rate limiter of each AWS API",
+                labels=label_names
+            )
+            for target_state in rate_limited_targets:
+                label_values = target_state.known_label_values()
+                if label_values is None:
+                    continue
+                for ((service, operation), count) in sorted(target_state.rate_limiter.throttled_counts().items()):
+                    throttled.add_metric(label_values + [service, operation], count)
+                for ((service, operation), rate) in sorted(target_state.rate_limiter.rates().items()):
+                    rate_limit.add_metric(label_values + [service, operation], rate)
+            yield throttled
+            yield rate_limit
+
+    def snapshot(self):
+        """
+        Returns the last complete Snapshot. This method is thread-safe.
+        """
         with self._data_lock:
-            for m in self._metrics:
-                gauge = GaugeMetricFamily(m.name, m.description, labels=self._label_names + m.label_names)
-                for (label_values, value) in self._data.get(m.name, []):
-                    gauge.add_metric(label_values, value)
-                yield gauge
-
-    def _collect_metric(self, metric):
-        responses = self._call_paginator(metric) if metric.use_paginator else self._call_service_method(metric)
-        assert all(isinstance(r, dict) for r in responses), "responses '%s' must a sequence of dicts" % responses
-        result = []
-        for response in responses:
-            assert "value" in response, "response object '%s' is missing a 'value' property" % response
-            assert isinstance(response["value"], (float, int)), "the `value` property must be a number"
-            value = response.pop("value")
-            labels = [response[label] if response[label] is not None else '<null>' for label in metric.label_names]
-            result.append((self._label_values + labels, value))
+            return self._snapshot
+
+    def _merge_snapshot(self, data, timestamp, metrics):
+        with self._data_lock:
+            current = {metric.name: _definition(metric) for metric in self._metrics}
+            # leaves out metrics which got removed or changed by set_metrics() while they were being collected
+            collected_names = {metric.name for metric in metrics if current.get(metric.name) == _definition(metric)}
+            data = {key: samples for (key, samples) in data.items() if key[1] in collected_names}
+            merged_data = dict(self._snapshot.data)
+            merged_data.update(data)
+            timestamps = dict(self._snapshot.timestamps)
+            timestamps.update((key, timestamp) for key in data)
+            self._snapshot = Snapshot(
+                data=merged_data,
+                timestamps=timestamps,
+                timestamp=min(timestamps.values()) if timestamps else None,
+                stale=self._snapshot.stale.difference(data)
+            )
+
+    def _prune_string_pool(self):
+        """
+        Drops the label values no longer found in the snapshot from the string pool, once it holds more than twice
+        as many strings as the snapshot, so label values of resources which went away do not accumulate.
+        """
+        tables = list(self.snapshot().data.values())
+        live_count = sum(len(table.strings) for table in tables)
+        if len(self._string_pool) > 2 * live_count + 1024:
+            self._string_pool = {string: string for table in tables for string in table.strings}
+
+    def _collect_metrics(self, metrics):
+        """
+        Returns a dict of (target, metric_name) to collected samples, leaving out the metrics which failed.
+        Metrics sharing the same API call (see _call_signature()) are collected together, fetching pages only once.
+        """
+        units = self._units(metrics)
+        cycle_deadline = self._cycle_deadline(time.monotonic())
+        if self._max_workers == 1:
+            results = [self._collect_unit(unit, cycle_deadline) for unit in units]
+        else:
+            results = self._collect_units_concurrently(units, cycle_deadline)
+        data = {}
+        for result in results:
+            data.update(result)
+        return data
+
+    def _cycle_deadline(self, start_time):
+        return None if self._cycle_budget is None else start_time + self._cycle_budget
+
+    def _unit_deadline(self, metrics, start_time, cycle_deadline):
+        """
+        Returns the time.monotonic() by which a call group must be collected, or None if it has no deadline.
+        """
+        timeouts = [metric.timeout or self._metric_timeout for metric in metrics]
+        deadlines = [start_time + timeout for timeout in timeouts if timeout is not None]
+        if cycle_deadline is not None:
+            deadlines.append(cycle_deadline)
+        return min(deadlines) if deadlines else None
+
+    def _units(self, metrics):
+        """
+        Returns the (target_state, call_group) units of work needed to collect metrics.
+        """
+        return [
+            (target_state, call_group)
+            for target_state in self._targets
+            for call_group in _group_by_call_signature(metrics)
+        ]
+
+    def _collect_units_concurrently(self, units, cycle_deadline=None):
+        """
+        Collects units on a pool of max_workers threads, with at most max_workers_per_service units of any given
+        service and target in flight at once. Units are only submitted once they are allowed to run, so a busy
+        service never holds threads that other services could use.
+        """
+        per_service = min(self._max_workers, self._max_workers_per_service or self._max_workers)
+        queues = {}
+        for (index, unit) in enumerate(units):
+            (target_state, call_group) = unit
+            queues.setdefault((id(target_state), call_group[0].service), deque()).append((index, unit))
+        results = [None] * len(units)
+        in_flight = {}  # future to queue key
+        running = {key: 0 for key in queues}
+        with ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="aws-collector") as executor:
+            while queues or in_flight:
+                submitted = True
+                while submitted and len(in_flight) < self._max_workers:
+                    submitted = False
+                    for key in list(queues):  # round-robin across services and targets
+                        if running[key] < per_service and len(in_flight) < self._max_workers:
+                            (index, unit) = queues[key].popleft()
+                            if not queues[key]:
+                                del queues[key]
+                            future = executor.submit(self._collect_unit, unit, cycle_deadline)
+                            in_flight[future] = (key, index)
+                            running[key] += 1
+                            submitted = True
+                (done, _) = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    (key, index) = in_flight.pop(future)
+                    running[key] -= 1
+                    results[index] = future.result()
+        return results
+
+    def _collect_unit(self, unit, cycle_deadline=None):
+        (target_state, metrics) = unit
+        start_time = time.monotonic()
+        pages = _PageCounter(self._max_pages)
+        deadline = self._unit_deadline(metrics, start_time, cycle_deadline)
+        try:
+            result = self._collect_call_group(target_state, metrics, pages, deadline)
+        except TimeoutError:
+            return self._unit_failed(unit, start_time, pages, timed_out=True)
+        except Exception:  # pylint: disable=broad-except
+            return self._unit_failed(unit, start_time, pages)
+        return self._unit_succeeded(unit, start_time, pages, result)
+
+    async def _collect_unit_async(self, unit, loop, executor, semaphore, service_semaphore, call_timeout,
+                                  cycle_deadline=None):
+        (target_state, metrics) = unit
+        async with semaphore, service_semaphore:
+            start_time = time.monotonic()
+            pages = _PageCounter(self._max_pages)
+            deadline = self._unit_deadline(metrics, start_time, cycle_deadline)
+            steps = self._call_group_steps(target_state, metrics, pages)
+            next_step = self._next_step_function(pages)
+            try:
+                while True:
+                    timeout = _time_left(deadline, call_timeout)
+                    (done, result) = await asyncio.wait_for(loop.run_in_executor(executor, next_step, steps), timeout)
+                    if done:
+                        break
+            except asyncio.CancelledError:
+                raise
+            except (TimeoutError, asyncio.TimeoutError):
+                return self._unit_failed(unit, start_time, pages, timed_out=True)
+            except Exception:  # pylint: disable=broad-except
+                return self._unit_failed(unit, start_time, pages)
+            return self._unit_succeeded(unit, start_time, pages, result)
+
+    def _unit_failed(self, unit, start_time, pages, timed_out=False):
+        (target_state, metrics) = unit
+        metric_names = [metric.name for metric in metrics]
+        if timed_out:
+            logger.warning("timed out collecting metrics %s from %s after %d pages, keeping their previous samples",
+                           metric_names, target_state.target or "the default session", pages.count)
+        else:
+            logger.exception("failed to collect metrics %s from %s", metric_names,
+                             target_state.target or "the default session")
+        try:
+            if timed_out:
+                self._instrumentation.observe_timeout(target_state.stats_label_values(), metric_names)
+            self._instrumentation.observe_collection(
+                target_state.stats_label_values(), metric_names, time.monotonic() - start_time, pages.count,
+                pages.requests
+            )
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("failed to record the collection of metrics %s", metric_names)
+        return {}
+
+    def _unit_succeeded(self, unit, start_time, pages, result):
+        """
+        Records the successful collection of unit, and returns its result. A failure to record it gets logged rather
+        than raised, so that it never discards the samples collected, nor those of other units.
+        """
+        (target_state, metrics) = unit
+        metric_names = [metric.name for metric in metrics]
+        try:
+            self._instrumentation.observe_collection(
+                target_state.stats_label_values(),
+                metric_names,
+                time.monotonic() - start_time,
+                pages.count,
+                pages.requests,
+                {metric_name: len(result[(target_state.target, metric_name)]) for metric_name in metric_names},
+                time.time()
+            )
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("failed to record the collection of metrics %s", metric_names)
         return result
 
-    def _call_paginator(self, metric):
-        service = self._session.client(metric.service)
+    def _collect_call_group(self, target_state, metrics, page_counter, deadline=None):
+        """
+        Fetches the pages of the API call shared by metrics once, and applies the search of every metric to each page.
+        Returns a dict of (target, metric_name) to collected samples, as SampleTable objects.
+        Raises TimeoutError if deadline (a time.monotonic() value) passes before the call is done.
+        """
+        steps = self._call_group_steps(target_state, metrics, page_counter)
+        next_step = self._next_step_function(page_counter)
+        while True:
+            _time_left(deadline)
+            (done, result) = next_step(steps)
+            if done:
+                return result
+
+    def _next_step_function(self, page_counter):
+        """
+        Returns _next_step(), counting the requests it sends into page_counter, and profiled with cProfile while update
+        cycles are being profiled.
+        """
+        next_step = functools.partial(self._request_counter.run, page_counter, _next_step)
+        profiler = self._profiler
+        if profiler is None:
+            return next_step
+        return functools.partial(profiler.run, next_step)
+
+    def _call_group_steps(self, target_state, metrics, page_counter):
+        """
+        Generator doing the work of _collect_call_group(), yielding after each page, and returning its result.
+        """
+        first = metrics[0]
+        profiler = self._profiler
+        if first.cloudwatch is not None:
+            return (yield from self._cloudwatch_steps(target_state, metrics, page_counter, profiler))
+        label_values = target_state.label_values()
+        method_args = _method_args(first)
+        incremental = None
+        call_args = method_args
+        if first.incremental is not None:
+            incremental = self._incremental_state(target_state, first)
+            call_args = incremental.method_args(method_args)
+        if first.use_paginator:
+            pages = page_counter.count_pages(self._call_paginator(target_state, first, call_args))
+        else:
+            pages = page_counter.count_pages(self._call_service_method(target_state, first, call_args))
+        if profiler is not None:
+            pages = profiler.timed_pages([metric.name for metric in metrics], pages)
+        if incremental is not None:
+            pages = incremental.merge(pages, method_args)
+        sinks = [(metric, self._sample_sink(metric, label_values), _label_getter(metric.label_names))
+                 for metric in metrics]
+        for page in pages:
+            for (metric, sink, get_labels) in sinks:
+                if profiler is None:
+                    self._collect_metric(metric, _search_page(metric, page), sink, get_labels)
+                else:
+                    # the search results get materialized, so that searching and converting are measured apart
+                    names = [metric.name]
+                    responses = profiler.measure(names, "search", list, _search_page(metric, page))
+                    profiler.measure(names, "convert", self._collect_metric, metric, responses, sink, get_labels)
+            yield
+        return self._build_samples(target_state, [(metric, sink) for (metric, sink, _) in sinks], profiler)
+
+    def _cloudwatch_steps(self, target_state, metrics, page_counter, profiler=None):
+        """
+        Generator doing the work of _call_group_steps() for metrics with a CloudWatchQuery, which share a namespace.
+        Their queries are packed into as few GetMetricData requests as possible (see get_metric_data_pages()), and the
+        latest value of each query becomes a sample. Queries without any recent datapoint produce no sample.
+        """
+        queries = []
+        query_samples = []  # (metric_name, label values) of each query
+        for metric in metrics:
+            cloudwatch = metric.cloudwatch
+            for dimensions in cloudwatch.dimensions:
+                queries.append(metric_data_query("q%d" % len(queries), cloudwatch.namespace, cloudwatch.metric_name,
+                                                 dimensions, cloudwatch.statistic, cloudwatch.period))
+                query_samples.append((metric.name, tuple(dimensions.values())))
+        values = {}
+        pages = page_counter.count_pages(get_metric_data_pages(target_state.client("cloudwatch"), queries))
+        if profiler is not None:
+            pages = profiler.timed_pages([metric.name for metric in metrics], pages)
+        for page in pages:
+            merge_latest_values(values, page)
+            yield
+        label_values = target_state.label_values()
+        sinks = {metric.name: self._sample_sink(metric, label_values) for metric in metrics}
+        for (query, (metric_name, labels)) in zip(queries, query_samples):
+            value = values.get(query["Id"])
+            if value is not None:
+                sinks[metric_name].add(labels, value)
+        return self._build_samples(target_state, [(metric, sinks[metric.name]) for metric in metrics], profiler)
+
+    def _sample_sink(self, metric, label_values):
+        """
+        Returns the object collecting the samples of metric, with the same interface as SampleTableBuilder.
+        """
+        sink = SampleTableBuilder(label_values, len(metric.label_names), self._string_pool)
+        if metric.max_series is not None:
+            sink = _TopSeries(metric.max_series, sink)
+        if metric.aggregate is not None:
+            sink = _Aggregation(metric.aggregate, sink)
+        return sink
+
+    def _build_samples(self, target_state, sinks, profiler=None):
+        """
+        Returns a dict of (target, metric_name) to the SampleTable built by each sink, given a list of (metric, sink),
+        and records the number of series dropped for the metrics with a max_series.
+        """
+        result = {}
+        for (metric, sink) in sinks:
+            if profiler is None:
+                result[(target_state.target, metric.name)] = sink.build()
+            else:
+                result[(target_state.target, metric.name)] = profiler.measure([metric.name], "build", sink.build)
+            if metric.max_series is not None:
+                self._instrumentation.observe_dropped_series(target_state.stats_label_values(), metric.name,
+                                                             sink.dropped)
+        return result
+
+    def _collect_metric(self, metric, responses, sink, get_labels):
+        """
+        Adds the dicts found by the search of metric to sink, as (labels, value) samples.
+        The labels of each dict are read at once by get_labels (see _label_getter()), and its value is only checked
+        when it gets added to sink.
+        """
+        counting = metric.aggregate == "count"
+        try:
+            for response in responses:
+                sink.add(get_labels(response), 1 if counting else response["value"])
+        except (KeyError, TypeError) as e:
+            raise ValueError("the search results of metric '%s' must be dicts with the keys %s%s and a number as "
+                             "value (%s: %s)" % (metric.name, metric.label_names, "" if counting else " + 'value'",
+                                                 type(e).__name__, e))
+
+    def _incremental_state(self, target_state, metric):
+        key = (target_state.target, _call_signature(metric))
+        with self._incremental_lock:
+            return self._incremental_states.setdefault(key, _IncrementalState(metric.incremental))
+
+    def _call_paginator(self, target_state, metric, method_args):
+        service = target_state.client(metric.service)
         paginator = service.get_paginator(metric.method)
-        paginate_response_iterator = paginator.paginate(**metric.method_args)
-        return list(paginate_response_iterator.search(metric.search))
+        return iter(paginator.paginate(**method_args))
 
-    def _call_service_method(self, metric):
-        service = self._session.client(metric.service)
+    def _call_service_method(self, target_state, metric, method_args):
+        service = target_state.client(metric.service)
         service_method = getattr(service, metric.method)
         next_token = ''
-        responses = []
-        kwargs = dict(**metric.method_args)
+        kwargs = dict(**method_args)
         while next_token is not None:
             response = service_method(**kwargs)
             next_token = response.get('NextToken', None)
-            responses += jmespath.search(metric.search, response)
+            yield response
             kwargs["NextToken"] = next_token
-        return responses
 
 
-def parse_aws_metrics(yaml_string):
+class _TargetState:
+    """
+    The clients and label values of an AwsTarget, or of the collector's own session if target is None.
+    """
+
+    def __init__(self, target, session, base_clients, label_values, client_config=None, rate_limiter=None,
+                 request_counter=None):
+        self.target = target
+        self.rate_limiter = rate_limiter
+        self._label_values = label_values
+        self._account = None
+        self._lock = Lock()
+
+        def on_create(client):
+            for hooks in (rate_limiter, request_counter):
+                if hooks is not None:
+                    hooks.register(client)
+
+        if target is None or target.role_arn is None:
+            self._clients = ClientPool(session, client_config, on_create=on_create, lock=base_clients.lock)
+        else:
+            self._account = account_from_role_arn(target.role_arn)
+            credentials = AssumedRoleCredentials(base_clients.client("sts", target.region), target.role_arn)
+            self._clients = ClientPool(None, client_config, credentials, on_create=on_create)
+        self._base_clients = base_clients
+
+    def client(self, service):
+        return self._clients.client(service, self.target.region if self.target else None)
+
+    def label_values(self):
+        """
+        Returns the label values prepended to the labels of every sample collected from this target.
+        Looks up the account of targets without a role once, using sts:GetCallerIdentity.
+        """
+        if self.target is None:
+            return self._label_values
+        with self._lock:
+            if self._account is None:
+                sts = self._base_clients.client("sts", self.target.region)
+                self._account = sts.get_caller_identity()["Account"]
+        return self._label_values + [self.target.region, self._account]
+
+    def stats_label_values(self):
+        """
+        Same as label_values(), but with an empty account instead of looking it up.
+        """
+        if self.target is None:
+            return self._label_values
+        return self._label_values + [self.target.region, self._account or ""]
+
+    def known_label_values(self):
+        """
+        Same as label_values(), but returns None instead of looking up the account.
+        """
+        if self.target is not None and self._account is None:
+            return None
+        return self.label_values()
+
+
+class _IncrementalState:
+    """
+    The watermark and cached items of a call group refreshed incrementally (see Incremental), for a given target.
+    """
+
+    def __init__(self, incremental):
+        self._incremental = incremental
+        self._watermark = None  # the latest timestamp of the cached items, in seconds since the epoch
+        self._watermark_value = None  # the same, as found in the item
+        self._items = {}  # dict of item key to item
+
+    def method_args(self, method_args):
+        """
+        Returns method_args, with watermark_arg moved up to the watermark if there is one.
+        """
+        window_start = _epoch_seconds(method_args.get(self._incremental.watermark_arg))
+        if self._watermark is not None and (window_start is None or self._watermark > window_start):
+            method_args = dict(method_args)
+            method_args[self._incremental.watermark_arg] = self._watermark_value
+        return method_args
+
+    def merge(self, pages, method_args):
+        """
+        Merges the items of pages into the cached items, drops those older than watermark_arg in method_args (before
+        it got moved up by method_args()), and yields a single page holding every cached item.
+        The state is only updated once every page has been fetched.
+        """
+        incremental = self._incremental
+        window_start = _epoch_seconds(method_args.get(incremental.watermark_arg))
+        items = dict(self._items)
+        (watermark, watermark_value) = (self._watermark, self._watermark_value)
+        for page in pages:
+            for item in page.get(incremental.items) or []:
+                items[incremental.key.search(item)] = item
+                timestamp = incremental.timestamp.search(item)
+                seconds = _epoch_seconds(timestamp)
+                if seconds is not None and (watermark is None or seconds > watermark):
+                    (watermark, watermark_value) = (seconds, timestamp)
+        if window_start is not None:
+            items = {key: item for (key, item) in items.items() if not _expired(incremental, item, window_start)}
+        (self._items, self._watermark, self._watermark_value) = (items, watermark, watermark_value)
+        yield {incremental.items: list(items.values())}
+
+
+def _expired(incremental, item, window_start):
+    seconds = _epoch_seconds(incremental.timestamp.search(item))
+    return seconds is not None and seconds < window_start
+
+
+def _epoch_seconds(value):
+    """
+    Returns a datetime (naive ones being UTC, as per botocore) or number as seconds since the epoch, or None.
+    """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.timestamp()
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return None
+
+
+def _method_args(metric):
+    """
+    Returns the method_args of metric, evaluating its method_args_expression again if it has one.
+    """
+    if metric.method_args_expression is None:
+        return metric.method_args
+    return _eval_method_args(metric.method_args_expression)
+
+
+def _eval_method_args(expression):
+    # pylint: disable=eval-used
+    method_args = eval(expression, dict(METHOD_ARGS_GLOBALS))
+    if not isinstance(method_args, dict):
+        raise ValueError("paginator_args '%s' should eval to a dict" % expression)
+    return method_args
+
+
+def _next_step(steps):
+    """
+    Runs a generator until its next yield. Returns (False, None), or (True, its return value) once it is exhausted.
+    """
+    try:
+        next(steps)
+    except StopIteration as stop:
+        return (True, stop.value)
+    return (False, None)
+
+
+def _time_left(deadline, timeout=None):
+    """
+    Returns the seconds left until deadline (a time.monotonic() value), or until timeout seconds from now if that is
+    sooner. Returns timeout if deadline is None, and raises TimeoutError if deadline has passed.
+    """
+    if deadline is None:
+        return timeout
+    time_left = deadline - time.monotonic()
+    if time_left <= 0:
+        raise TimeoutError("deadline exceeded")
+    return time_left if timeout is None else min(time_left, timeout)
+
+
+class _PageCounter:
+    """
+    Counts the pages going through count_pages(), which raises a ValueError past max_pages, and the API requests sent
+    to fetch them (see RequestCounter).
+    """
+
+    def __init__(self, max_pages=None):
+        self.count = 0
+        self.requests = 0
+        self._max_pages = max_pages
+
+    def count_pages(self, pages):
+        for page in pages:
+            if self._max_pages is not None and self.count >= self._max_pages:
+                raise ValueError("more than max_pages (%d) pages were returned" % self._max_pages)
+            self.count += 1
+            yield page
+
+
+def _check_number(value):
+    """
+    Raises TypeError if value is not a number (bool values are not numbers either).
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise TypeError("value %r is not a number" % (value,))
+
+
+class _Aggregation:
+    """
+    Reduces the samples of an aggregated metric (see AwsMetric.aggregate) as they are collected, keeping only one value
+    per group of label values, which are added to builder once built. Has the same interface as SampleTableBuilder.
+    """
+
+    def __init__(self, function, builder):
+        self._reduce = AGGREGATE_FUNCTIONS[function]
+        self._builder = builder
+        self._groups = {}  # dict of tuple of label values to reduced value
+
+    @property
+    def dropped(self):
+        return self._builder.dropped
+
+    def add(self, labels, value):
+        _check_number(value)
+        current = self._groups.get(labels)
+        self._groups[labels] = value if current is None else self._reduce(current, value)
+
+    def build(self):
+        for (labels, value) in self._groups.items():
+            self._builder.add(labels, value)
+        return self._builder.build()
+
+
+class _TopSeries:
+    """
+    Keeps the max_series samples with the highest values out of those added, in a bounded min-heap, so that memory
+    does not grow with the number of samples added. The samples kept are added to builder once built, in the order
+    they were added, and the others are counted as dropped. Among samples of equal value, the first ones are kept.
+    Has the same interface as SampleTableBuilder.
+    """
+
+    def __init__(self, max_series, builder):
+        self._max_series = max_series
+        self._builder = builder
+        self._heap = []  # min-heap of (value, -sequence number, labels)
+        self._sequence = itertools.count()
+        self.dropped = 0
+
+    def add(self, labels, value):
+        _check_number(value)
+        entry = (value, -next(self._sequence), labels)
+        if len(self._heap) < self._max_series:
+            heapq.heappush(self._heap, entry)
+            return
+        self.dropped += 1
+        if entry > self._heap[0]:
+            heapq.heapreplace(self._heap, entry)
+
+    def build(self):
+        for (value, _, labels) in sorted(self._heap, key=operator.itemgetter(1), reverse=True):
+            self._builder.add(labels, value)
+        return self._builder.build()
+
+
+def _label_getter(label_names):
+    """
+    Returns a function returning the tuple of the values of label_names in a dict.
+    """
+    if len(label_names) == 1:
+        get_label = operator.itemgetter(label_names[0])
+        return lambda response: (get_label(response),)
+    if not label_names:
+        return lambda response: ()
+    return operator.itemgetter(*label_names)
+
+
+def _search_page(metric, page):
+    """
+    Yields the results of the compiled search of metric on a single page, as PageIterator.search() does.
+    """
+    found = metric.search.search(page)
+    if isinstance(found, list):
+        yield from found
+    elif found is not None:
+        yield found
+
+
+class MetricScheduler:
+    """
+    Refreshes the metrics of an AwsMetricsCollector, each on its own interval (see AwsMetric.interval).
+    Every metric is refreshed once on startup. After that, the next due time of each call group is kept in a
+    priority queue, and the call groups sharing an interval are spread evenly across it rather than refreshed in
+    a single burst. Metrics sharing both a call signature and an interval are refreshed together, sharing their pages;
+    metrics sharing a call signature but with different intervals are refreshed separately, each fetching its own.
+    Metrics with a max_age are left out: they get refreshed when scraped instead.
+    Use run() from a thread, or run_async() from an asyncio event loop.
+    """
+
+    def __init__(self, collector, default_interval, clock=time.monotonic, startup_jitter=0, jitter=random.random):
+        """
+        collector: an AwsMetricsCollector
+        default_interval: seconds between refreshes of metrics which do not specify an interval
+        clock (optional): a function returning the current time in seconds, used to compute due times
+        startup_jitter (optional): maximum number of seconds to wait for before the first refresh, chosen at random so
+                                   that replicas starting together do not all call AWS APIs at once
+        jitter (optional): a function returning a random number between 0 and 1 (for testing)
+        """
+        if default_interval <= 0:
+            raise ValueError("default_interval must be positive")
+        if startup_jitter < 0:
+            raise ValueError("startup_jitter must not be negative")
+        self._collector = collector
+        self._default_interval = default_interval
+        self._clock = clock
+        self._startup_jitter = startup_jitter
+        self._jitter = jitter
+        self._start_time = None
+        self._queue = []  # heap of (due_time, sequence_number, interval, list of AwsMetric)
+        self._sequence = itertools.count()
+        self._started = False
+        self._scheduled_metrics = None  # the collector's list of metrics when the queue was last built
+
+    def run(self, stop_event=None):
+        """
+        Refreshes metrics as they become due, until stop_event (a threading.Event) is set.
+        Changes to the metrics of the collector (see AwsMetricsCollector.set_metrics()) are picked up within
+        METRICS_CHECK_SECONDS.
+        """
+        stop_event = stop_event or Event()
+        while not stop_event.is_set():
+            stop_event.wait(min(self.run_pending(), METRICS_CHECK_SECONDS))
+
+    def run_pending(self):
+        """
+        Refreshes the metrics which are due, and returns the number of seconds until the next ones are.
+        """
+        if not self._started:
+            startup_delay = self._startup_delay()
+            if startup_delay > 0:
+                return startup_delay
+            metrics = self._collector.metrics
+            scheduled = _scheduled_metrics(metrics)
+            if len(scheduled) == len(metrics):
+                self._collector.update()
+            elif scheduled:
+                self._collector.update_metrics(scheduled)
+            self._schedule_all(self._clock())
+            self._started = True
+        else:
+            self._reschedule_changed_metrics()
+            due = self._pop_due()
+            if due:
+                self._collector.update_metrics([metric for (_, _, _, metrics) in due for metric in metrics])
+                self._reschedule(due)
+        return self._next_delay()
+
+    async def run_async(self, stop_event=None, concurrency=10, call_timeout=None):
+        """
+        Coroutine version of run(), refreshing metrics with AwsMetricsCollector.update_async() until stop_event
+        (an asyncio.Event) is set, or until cancelled.
+        concurrency, call_timeout (optional): see AwsMetricsCollector.update_async()
+        """
+        stop_event = stop_event or asyncio.Event()
+        while not stop_event.is_set():
+            delay = await self.run_pending_async(concurrency, call_timeout)
+            try:
+                await asyncio.wait_for(stop_event.wait(), min(delay, METRICS_CHECK_SECONDS))
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_pending_async(self, concurrency=10, call_timeout=None):
+        """
+        Coroutine version of run_pending().
+        """
+        if not self._started:
+            startup_delay = self._startup_delay()
+            if startup_delay > 0:
+                return startup_delay
+            metrics = self._collector.metrics
+            scheduled = _scheduled_metrics(metrics)
+            if scheduled:
+                await self._collector.update_async(
+                    None if len(scheduled) == len(metrics) else scheduled, concurrency, call_timeout
+                )
+            self._schedule_all(self._clock())
+            self._started = True
+        else:
+            self._reschedule_changed_metrics()
+            due = self._pop_due()
+            if due:
+                metrics = [metric for (_, _, _, metrics) in due for metric in metrics]
+                try:
+                    await self._collector.update_async(metrics, concurrency, call_timeout)
+                finally:
+                    self._reschedule(due)
+        return self._next_delay()
+
+    def _startup_delay(self):
+        if self._start_time is None:
+            self._start_time = self._clock() + self._startup_jitter * self._jitter()
+        return self._start_time - self._clock()
+
+    def _pop_due(self):
+        now = self._clock()
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            due.append(heapq.heappop(self._queue))
+        return due
+
+    def _reschedule(self, due):
+        now = self._clock()
+        for (due_time, _, interval, metrics) in due:
+            due_time += interval
+            if due_time <= now:
+                due_time = now + interval  # fell behind by a whole interval: skip rather than burst
+            heapq.heappush(self._queue, (due_time, next(self._sequence), interval, metrics))
+
+    def _next_delay(self):
+        return max(0.0, self._queue[0][0] - self._clock()) if self._queue else self._default_interval
+
+    def _schedule_all(self, start_time):
+        self._scheduled_metrics = self._collector.metrics
+        for interval, call_groups in self._call_groups_by_interval(self._scheduled_metrics).items():
+            for index, metrics in enumerate(call_groups):
+                due_time = start_time + interval + interval * index / len(call_groups)
+                heapq.heappush(self._queue, (due_time, next(self._sequence), interval, metrics))
+
+    def _reschedule_changed_metrics(self):
+        """
+        Rebuilds the queue if the metrics of the collector changed: call groups which did not change keep their due
+        time, and the others are due immediately.
+        """
+        metrics = self._collector.metrics
+        if metrics is self._scheduled_metrics:
+            return
+        now = self._clock()
+        due_times = {
+            (interval, tuple(id(metric) for metric in group)): due_time
+            for (due_time, _, interval, group) in self._queue
+        }
+        self._queue = []
+        for interval, call_groups in self._call_groups_by_interval(metrics).items():
+            for group in call_groups:
+                due_time = due_times.get((interval, tuple(id(metric) for metric in group)), now)
+                heapq.heappush(self._queue, (due_time, next(self._sequence), interval, group))
+        self._scheduled_metrics = metrics
+
+    def _call_groups_by_interval(self, metrics):
+        """
+        Returns a dict of interval to list of call groups.
+        """
+        by_interval = {}
+        for call_group in _group_by_call_signature(_scheduled_metrics(metrics)):
+            for metric in call_group:
+                interval = metric.interval or self._default_interval
+                by_interval.setdefault(interval, {}).setdefault(_call_signature(metric), []).append(metric)
+        return {interval: list(call_groups.values()) for (interval, call_groups) in by_interval.items()}
+
+
+class MetricsFileReloader:
+    """
+    Reloads the metrics of an AwsMetricsCollector from a YAML metrics file (see parse_aws_metrics() and
+    AwsMetricsCollector.set_metrics()) on request, or when the file gets modified. An invalid file is logged and
+    rejected: the collector then keeps its current metrics. A MetricScheduler running the collector picks up the
+    changes on its own, refreshing the metrics added or changed right away.
+    """
+
+    def __init__(self, path, collector, shard_index=0, shard_count=1):
+        """
+        path: the path of the metrics file
+        collector: the AwsMetricsCollector to reload the metrics of
+        shard_index, shard_count (optional): see parse_aws_metrics()
+        """
+        self._path = path
+        self._collector = collector
+        self._shard_index = shard_index
+        self._shard_count = shard_count
+        self._file_state = self._stat()
+        self._reload_requested = Event()
+
+    def reload(self):
+        """
+        Reloads the metrics file. Returns the list of metrics added or changed, or None if the file was rejected.
+        """
+        self._file_state = self._stat()
+        try:
+            with open(self._path) as metrics_file:
+                metrics = parse_aws_metrics(metrics_file.read(), self._shard_index, self._shard_count)
+            previous_names = {metric.name for metric in self._collector.metrics}
+            changed = self._collector.set_metrics(metrics)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("rejected metrics file %s, keeping the current metrics", self._path)
+            return None
+        logger.info("reloaded metrics file %s: %d metrics, %d added or changed, %d removed", self._path,
+                    len(metrics), len(changed), len(previous_names - {metric.name for metric in metrics}))
+        return changed
+
+    def request_reload(self):
+        """
+        Makes watch() reload the metrics file. Safe to call from a signal handler.
+        """
+        self._reload_requested.set()
+
+    def watch(self, interval=None, stop_event=None):
+        """
+        Reloads the metrics file whenever request_reload() gets called, and also when the file gets modified if an
+        interval (in seconds) to check it at is given, until stop_event (a threading.Event) is set.
+        """
+        stop_event = stop_event or Event()
+        next_check = None if interval is None else time.monotonic() + interval
+        while not stop_event.is_set():
+            if self._reload_requested.wait(min(interval or METRICS_CHECK_SECONDS, METRICS_CHECK_SECONDS)):
+                self._reload_requested.clear()
+                self.reload()
+            elif next_check is not None and time.monotonic() >= next_check:
+                next_check = time.monotonic() + interval
+                if self._stat() not in (None, self._file_state):
+                    self.reload()
+
+    def start(self, interval=None):
+        """
+        Runs watch() on a daemon thread, and returns the thread.
+        """
+        thread = Thread(target=self.watch, args=(interval,), name="metrics-file-reloader", daemon=True)
+        thread.start()
+        return thread
+
+    def _stat(self):
+        try:
+            stat = os.stat(self._path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _scheduled_metrics(metrics):
+    """
+    Returns the metrics refreshed by a MetricScheduler, rather than on scrape.
+    """
+    return [metric for metric in metrics if metric.max_age is None]
+
+
+def _validate_metrics(metrics):
+    for metric in metrics:
+        if metric.aggregate is not None and metric.aggregate not in AGGREGATE_FUNCTIONS:
+            raise ValueError("metric '%s' has an invalid aggregate function '%s'" % (metric.name, metric.aggregate))
+
+
+def _definition(metric):
+    """
+    Returns what identifies the definition of metric: the metric itself, but without the method_args evaluated from
+    its method_args_expression, which differ whenever it gets parsed again.
+    """
+    if metric.method_args_expression is not None:
+        return metric._replace(method_args=None)
+    return metric
+
+
+def _metric_key(metric):
+    """
+    Returns the (name, fingerprint of the definition) of metric, identifying its samples in persisted snapshots.
+    """
+    definition = _definition(metric)._replace(interval=None, cost=None, max_age=None, timeout=None)
+    return (metric.name, hashlib.sha1(repr(tuple(definition)).encode("utf-8")).hexdigest())
+
+
+def _target_key(target):
+    """
+    Returns a tuple of str identifying target (an AwsTarget or None) in persisted snapshots.
+    """
+    if target is None:
+        return ("", "", "")
+    return ("1", target.region, target.role_arn or "")
+
+
+def _compile_search(metric):
+    if metric.search is None or isinstance(metric.search, JmesPathSearch):
+        return metric
+    return metric._replace(search=JmesPathSearch(metric.search))
+
+
+def _call_signature(metric):
+    """
+    Returns a hashable key identifying the API call made to collect metric.
+    Metrics with the same call signature can share the pages returned by a single call. CloudWatch metrics share
+    their GetMetricData requests with the other metrics of the same namespace.
+    """
+    def freeze(value):
+        if isinstance(value, dict):
+            return tuple(sorted((key, freeze(item)) for key, item in value.items()))
+        if isinstance(value, (list, tuple)):
+            return tuple(freeze(item) for item in value)
+        return value
+
+    if metric.cloudwatch is not None:
+        return (metric.service, metric.method, metric.cloudwatch.namespace)
+
+    method_args = metric.method_args_expression or freeze(metric.method_args)
+    return (metric.service, metric.method, metric.use_paginator, method_args, freeze(metric.incremental))
+
+
+def _group_by_call_signature(metrics):
+    """
+    Groups metrics by _call_signature(), preserving the order in which signatures first appear.
+    Returns a list of non-empty lists of AwsMetric objects.
+    """
+    call_groups = {}
+    for metric in metrics:
+        call_groups.setdefault(_call_signature(metric), []).append(metric)
+    return list(call_groups.values())
+
+
+def shard_metrics(metrics, shard_index, shard_count):
+    """
+    Returns the metrics assigned to shard number shard_index (from 0) out of shard_count, so that several exporters
+    given the same metrics can split the work between them. Metrics sharing a call signature are kept together, and
+    call groups are assigned using consistent hashing weighted by the cost of their metrics (see assign_shards()), so
+    adding a shard moves few metrics between shards.
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError("shard_index must be between 0 and shard_count - 1")
+    call_groups = _group_by_call_signature(metrics)
+    shards = assign_shards(
+        [
+            (repr(_call_signature(call_group[0])), max(metric.cost or 1 for metric in call_group))
+            for call_group in call_groups
+        ],
+        shard_count
+    )
+    selected = set()
+    for (call_group, shard) in zip(call_groups, shards):
+        if shard == shard_index:
+            selected.update(metric.name for metric in call_group)
+    return [metric for metric in metrics if metric.name in selected]
+
+
+def parse_aws_metrics(yaml_string, shard_index=0, shard_count=1):
     """
     Parses a YAML-formatted document and returns a list of AwsMetric objects.
+    shard_index, shard_count (optional): only returns the metrics of this shard (see shard_metrics())
     """
-    parsed_yaml = yaml.load(yaml_string)
+    parsed_yaml = yaml.safe_load(yaml_string)
     metrics = []
 
     def get_field(field_name, metric_name, parsed_metric):
@@ -136,20 +1652,156 @@ def parse_aws_metrics(yaml_string):
             raise ValueError("metric '%s' is missing mandatory field '%s'" % (metric_name, field_name))
         return field_value
 
+    def get_seconds(field_name, metric_name, parsed_metric):
+        seconds = parsed_metric.get(field_name)
+        if seconds is None:
+            return None
+        if isinstance(seconds, bool) or not isinstance(seconds, (int, float)) or seconds <= 0:
+            raise ValueError("metric '%s' has an invalid %s '%s' (must be a positive number of seconds)"
+                             % (metric_name, field_name, seconds))
+        return seconds
+
+    def get_cost(metric_name, parsed_metric):
+        cost = parsed_metric.get("cost")
+        if cost is None:
+            return None
+        if isinstance(cost, bool) or not isinstance(cost, (int, float)) or cost <= 0:
+            raise ValueError("metric '%s' has an invalid cost '%s' (must be a positive number)" % (metric_name, cost))
+        return cost
+
+    def get_max_series(metric_name, parsed_metric):
+        max_series = parsed_metric.get("max_series")
+        if max_series is None:
+            return None
+        if isinstance(max_series, bool) or not isinstance(max_series, int) or max_series < 1:
+            raise ValueError("metric '%s' has an invalid max_series '%s' (must be a positive integer)"
+                             % (metric_name, max_series))
+        return max_series
+
+    def get_aggregate(metric_name, parsed_metric):
+        """
+        Returns (label_names, aggregate function name) of metric.
+        """
+        aggregate = parsed_metric.get("aggregate")
+        if aggregate is None:
+            return (get_field("label_names", metric_name, parsed_metric), None)
+        if not isinstance(aggregate, dict):
+            raise ValueError("metric '%s' has an invalid aggregate '%s' (must be a dict with 'by' and 'function')"
+                             % (metric_name, aggregate))
+        function = aggregate.get("function")
+        if function not in AGGREGATE_FUNCTIONS:
+            raise ValueError("metric '%s' has an invalid aggregate function '%s' (must be one of %s)"
+                             % (metric_name, function, ", ".join(sorted(AGGREGATE_FUNCTIONS))))
+        label_names = parsed_metric.get("label_names")
+        by = aggregate.get("by", label_names)
+        if not isinstance(by, list) or not all(isinstance(label, str) for label in by):
+            raise ValueError("metric '%s' has an invalid aggregate 'by' '%s' (must be a list of label names)"
+                             % (metric_name, by))
+        if label_names is not None and label_names != by:
+            raise ValueError("metric '%s' has label_names %s which differ from its aggregate 'by' %s"
+                             % (metric_name, label_names, by))
+        return (by, function)
+
+    def compile_search(metric_name, parsed_metric):
+        expression = get_field("search", metric_name, parsed_metric).strip()
+        try:
+            return JmesPathSearch(expression)
+        except jmespath.exceptions.JMESPathError as e:
+            raise ValueError("metric '%s' has an invalid search expression: %s" % (metric_name, e))
+
     def eval_paginator_args(paginator_args):
-        # pylint: disable=eval-used
+        """
+        Returns (method_args, method_args_expression).
+        """
         if isinstance(paginator_args, dict):
-            return paginator_args
+            return (paginator_args, None)
         if isinstance(paginator_args, str):
-            paginator_args = eval(paginator_args, {"datetime": datetime.datetime, "timedelta": datetime.timedelta})
-            if not isinstance(paginator_args, dict):
-                raise ValueError("paginator_args '%s' should eval to a dict" % paginator_args)
-            return paginator_args
+            return (_eval_method_args(paginator_args), paginator_args)
         raise ValueError("paginator_args '%s' is not a str or dict" % paginator_args)
 
+    def get_incremental(metric_name, parsed_metric):
+        incremental = parsed_metric.get("incremental")
+        if incremental is None:
+            return None
+        if not isinstance(incremental, dict):
+            raise ValueError("metric '%s' has an invalid incremental '%s' (must be a dict)"
+                             % (metric_name, incremental))
+        fields = {}
+        for field in Incremental._fields:
+            value = incremental.get(field)
+            if not isinstance(value, str) or not value.strip():
+                raise ValueError("metric '%s' is missing mandatory incremental field '%s'" % (metric_name, field))
+            fields[field] = value.strip()
+        for field in ("timestamp", "key"):
+            try:
+                fields[field] = JmesPathSearch(fields[field])
+            except jmespath.exceptions.JMESPathError as e:
+                raise ValueError("metric '%s' has an invalid incremental %s expression: %s" % (metric_name, field, e))
+        return Incremental(**fields)
+
+    def get_cloudwatch(metric_name, parsed_metric):
+        """
+        Returns (label_names, CloudWatchQuery) of metric.
+        """
+        cloudwatch = parsed_metric["cloudwatch"]
+        if not isinstance(cloudwatch, dict):
+            raise ValueError("metric '%s' has an invalid cloudwatch '%s' (must be a dict)" % (metric_name, cloudwatch))
+        for field_name in ("paginator", "method", "search", "aggregate", "incremental"):
+            if field_name in parsed_metric:
+                raise ValueError("metric '%s' cannot have both 'cloudwatch' and '%s'" % (metric_name, field_name))
+        fields = {}
+        for field in ("namespace", "metric_name", "statistic"):
+            value = cloudwatch.get(field)
+            if not isinstance(value, str) or not value.strip():
+                raise ValueError("metric '%s' is missing mandatory cloudwatch field '%s'" % (metric_name, field))
+            fields[field] = value.strip()
+        period = cloudwatch.get("period", 300)
+        if isinstance(period, bool) or not isinstance(period, int) or period <= 0:
+            raise ValueError("metric '%s' has an invalid cloudwatch period '%s' (must be a positive number of seconds)"
+                             % (metric_name, period))
+        dimensions = cloudwatch.get("dimensions", {})
+        if isinstance(dimensions, dict):
+            dimensions = [dimensions]
+        if not isinstance(dimensions, list) or not dimensions or not all(isinstance(d, dict) for d in dimensions):
+            raise ValueError("metric '%s' has invalid cloudwatch dimensions '%s' (must be a dict of dimension name to "
+                             "value, or a list of such dicts)" % (metric_name, dimensions))
+        dimension_names = list(dimensions[0])
+        for dimension_set in dimensions:
+            if set(dimension_set) != set(dimension_names):
+                raise ValueError("metric '%s' has cloudwatch dimensions with different names: %s and %s"
+                                 % (metric_name, dimension_names, list(dimension_set)))
+        label_names = parsed_metric.get("label_names", dimension_names)
+        if not isinstance(label_names, list) or len(label_names) != len(dimension_names):
+            raise ValueError("metric '%s' has label_names %s which do not match its cloudwatch dimensions %s"
+                             % (metric_name, label_names, dimension_names))
+        fields["period"] = period
+        fields["dimensions"] = [
+            {name: str(dimension_set[name]) for name in dimension_names} for dimension_set in dimensions
+        ]
+        return (label_names, CloudWatchQuery(**fields))
+
     for metric_name, parsed_metric in parsed_yaml.items():
         if not VALID_METRIC_NAME_RE.match(metric_name):
             raise ValueError("metric name '%s' does not match ^[a-z_0-9]+$" % metric_name)
+        if 'cloudwatch' in parsed_metric:
+            (label_names, cloudwatch) = get_cloudwatch(metric_name, parsed_metric)
+            metrics.append(AwsMetric(
+                name=metric_name,
+                description=get_field("description", metric_name, parsed_metric).strip(),
+                service="cloudwatch",
+                method="get_metric_data",
+                method_args={},
+                use_paginator=False,
+                label_names=label_names,
+                search=None,
+                interval=get_seconds("interval", metric_name, parsed_metric),
+                cost=get_cost(metric_name, parsed_metric),
+                max_age=get_seconds("max_age", metric_name, parsed_metric),
+                cloudwatch=cloudwatch,
+                timeout=get_seconds("timeout", metric_name, parsed_metric),
+                max_series=get_max_series(metric_name, parsed_metric),
+            ))
+            continue
         if 'paginator' in parsed_metric:
             method_field = "paginator"
             method_args_field = "paginator_args"
@@ -159,16 +1811,29 @@ def parse_aws_metrics(yaml_string):
             method_args_field = "method_args"
             use_paginator = False
         else:
-            raise ValueError("metric name '%s' does not have a 'paginator' or 'method' property" % metric_name)
+            raise ValueError("metric name '%s' does not have a 'paginator', 'method' or 'cloudwatch' property"
+                             % metric_name)
+        (label_names, aggregate) = get_aggregate(metric_name, parsed_metric)
+        (method_args, method_args_expression) = eval_paginator_args(parsed_metric.get(method_args_field, {}))
         metrics.append(AwsMetric(
             name=metric_name,
             description=get_field("description", metric_name, parsed_metric).strip(),
             service=get_field("service", metric_name, parsed_metric).strip(),
             method=get_field(method_field, metric_name, parsed_metric).strip(),
-            method_args=eval_paginator_args(parsed_metric.get(method_args_field, {})),
+            method_args=method_args,
             use_paginator=use_paginator,
-            label_names=get_field("label_names", metric_name, parsed_metric),
-            search=get_field("search", metric_name, parsed_metric).strip(),
+            label_names=label_names,
+            search=compile_search(metric_name, parsed_metric),
+            interval=get_seconds("interval", metric_name, parsed_metric),
+            aggregate=aggregate,
+            method_args_expression=method_args_expression,
+            incremental=get_incremental(metric_name, parsed_metric),
+            cost=get_cost(metric_name, parsed_metric),
+            max_age=get_seconds("max_age", metric_name, parsed_metric),
+            timeout=get_seconds("timeout", metric_name, parsed_metric),
+            max_series=get_max_series(metric_name, parsed_metric),
         ))
 
+    if shard_count != 1 or shard_index != 0:
+        return shard_metrics(metrics, shard_index, shard_count)
     return metrics
@@ -1,12 +1,38 @@
 # -*- coding: utf-8 -*-
 
-import time
+import signal
 import argparse
 
 import boto3
+from botocore.config import Config
 
-from aws_prometheus_exporter import AwsMetric, AwsMetricsCollector, parse_aws_metrics
-from prometheus_client import REGISTRY, start_http_server
+from aws_prometheus_exporter import AwsMetric, AwsMetricsCollector, AwsTarget, MetricScheduler, parse_aws_metrics
+from aws_prometheus_exporter import MetricsFileReloader, start_exposition_server
+from prometheus_client import REGISTRY
+
+
+def parse_target(target):
+    region, _, role_arn = target.partition(",")
+    return AwsTarget(region=region.strip(), role_arn=role_arn.strip() or None)
+
+
+def parse_rate_limit(rate_limit):
+    api, _, rate = rate_limit.partition("=")
+    try:
+        return api.strip(), float(rate)
+    except ValueError:
+        raise argparse.ArgumentTypeError("'%s' is not of the form API=RATE" % rate_limit)
+
+
+def client_config(args):
+    """
+    Returns the botocore Config of the boto3 clients. tcp_keepalive is only given to versions of botocore supporting it
+    (1.27 onwards), which older ones reject: their connections are never kept alive at the TCP level.
+    """
+    kwargs = {"max_pool_connections": args.max_pool_connections}
+    if "tcp_keepalive" in Config.OPTION_DEFAULTS:
+        kwargs["tcp_keepalive"] = args.tcp_keepalive
+    return Config(**kwargs)
 
 
 def parse_args():
@@ -36,27 +62,210 @@ def parse_args():
         required=False,
         type=int,
         default=300,
-        help='seconds between metric refreshes'
+        help='seconds between refreshes of metrics which do not specify an interval'
+    )
+    parser.add_argument(
+        '-w', '--max-workers',
+        metavar='COUNT',
+        dest="max_workers",
+        required=False,
+        type=int,
+        default=1,
+        help='maximum number of metrics collected concurrently'
     )
-    return parser.parse_args()
+    parser.add_argument(
+        '--max-workers-per-service',
+        metavar='COUNT',
+        dest="max_workers_per_service",
+        required=False,
+        type=int,
+        default=None,
+        help='maximum number of metrics collected concurrently for a given AWS service'
+    )
+    parser.add_argument(
+        '-t', '--target',
+        metavar='REGION[,ROLE_ARN]',
+        dest="targets",
+        required=False,
+        type=parse_target,
+        action='append',
+        help='collect metrics from this region, assuming this role if given (may be repeated)'
+    )
+    parser.add_argument(
+        '-r', '--rate-limit',
+        metavar='API=RATE',
+        dest="rate_limits",
+        required=False,
+        type=parse_rate_limit,
+        action='append',
+        help='enable adaptive rate limiting, allowing at most RATE requests per second to API, which is either a '
+             'service (e.g. ec2), an operation (e.g. ec2.DescribeInstances), or * for all others (may be repeated)'
+    )
+    parser.add_argument(
+        '--max-pool-connections',
+        metavar='COUNT',
+        dest="max_pool_connections",
+        required=False,
+        type=int,
+        default=10,
+        help='maximum number of connections kept alive by each boto3 client'
+    )
+    parser.add_argument(
+        '--no-tcp-keepalive',
+        dest="tcp_keepalive",
+        action='store_false',
+        help='disable TCP keep-alive on boto3 client connections (only enabled with botocore 1.27 onwards)'
+    )
+    parser.add_argument(
+        '--shard-index',
+        metavar='INDEX',
+        dest="shard_index",
+        required=False,
+        type=int,
+        default=0,
+        help='only collect the metrics of this shard, from 0 to --shard-count - 1'
+    )
+    parser.add_argument(
+        '--shard-count',
+        metavar='COUNT',
+        dest="shard_count",
+        required=False,
+        type=int,
+        default=1,
+        help='number of exporters splitting the metrics of the metrics file between them'
+    )
+    parser.add_argument(
+        '--watch-interval',
+        metavar='SECONDS',
+        dest="watch_interval",
+        required=False,
+        type=float,
+        default=None,
+        help='check the metrics file for changes every SECONDS, and reload it when modified '
+             '(it is always reloaded on SIGHUP)'
+    )
+    parser.add_argument(
+        '--snapshot-file',
+        metavar='PATH',
+        dest="snapshot_path",
+        required=False,
+        type=str,
+        default=None,
+        help='persist every new snapshot to this file, and serve the persisted snapshot (marked stale) on startup '
+             'until it gets refreshed'
+    )
+    parser.add_argument(
+        '--startup-jitter',
+        metavar='SECONDS',
+        dest="startup_jitter",
+        required=False,
+        type=float,
+        default=0,
+        help='wait for a random number of seconds, up to SECONDS, before the first refresh'
+    )
+    parser.add_argument(
+        '--scrape-timeout',
+        metavar='SECONDS',
+        dest="scrape_timeout",
+        required=False,
+        type=float,
+        default=5.0,
+        help='seconds a scrape waits for at most for metrics with a max_age to be refreshed, before being served '
+             'their previous samples'
+    )
+    parser.add_argument(
+        '--metric-timeout',
+        metavar='SECONDS',
+        dest="metric_timeout",
+        required=False,
+        type=float,
+        default=None,
+        help='seconds allowed to collect a metric which does not specify a timeout, after which it keeps its '
+             'previous samples'
+    )
+    parser.add_argument(
+        '--cycle-budget',
+        metavar='SECONDS',
+        dest="cycle_budget",
+        required=False,
+        type=float,
+        default=None,
+        help='seconds allowed to collect all the metrics due at once, after which the others keep their previous '
+             'samples'
+    )
+    parser.add_argument(
+        '--max-pages',
+        metavar='COUNT',
+        dest="max_pages",
+        required=False,
+        type=int,
+        default=10000,
+        help='maximum number of pages fetched by any one API call, beyond which the call counts as failed'
+    )
+    parser.add_argument(
+        '--profile',
+        metavar='CYCLES',
+        dest="profile_cycles",
+        required=False,
+        type=int,
+        default=None,
+        help='profile the first CYCLES update cycles with cProfile and tracemalloc, and serve the report on '
+             '/debug/profile'
+    )
+    parser.add_argument(
+        '--profile-file',
+        metavar='PATH',
+        dest="profile_path",
+        required=False,
+        type=str,
+        default=None,
+        help='also write the report of --profile to this file'
+    )
+    args = parser.parse_args()
+    if not 0 <= args.shard_index < args.shard_count:
+        parser.error("--shard-index must be between 0 and --shard-count - 1")
+    if args.profile_cycles is not None and args.profile_cycles < 1:
+        parser.error("--profile must be at least 1")
+    if args.profile_path is not None and args.profile_cycles is None:
+        parser.error("--profile-file requires --profile")
+    return args
 
 
 def main(args):
     port = int(args.port)
     with open(args.metrics_file_path) as metrics_file:
         metrics_yaml = metrics_file.read()
-    metrics = parse_aws_metrics(metrics_yaml)
-    collector = AwsMetricsCollector(metrics, boto3.Session())
-    REGISTRY.register(collector)
-    start_http_server(port)
+    metrics = parse_aws_metrics(metrics_yaml, args.shard_index, args.shard_count)
+    collector = AwsMetricsCollector(
+        metrics,
+        boto3.Session(),
+        max_workers=args.max_workers,
+        max_workers_per_service=args.max_workers_per_service,
+        client_config=client_config(args),
+        targets=args.targets,
+        rate_limits=dict(args.rate_limits) if args.rate_limits else None,
+        snapshot_path=args.snapshot_path,
+        scrape_timeout=args.scrape_timeout,
+        metric_timeout=args.metric_timeout,
+        cycle_budget=args.cycle_budget,
+        max_pages=args.max_pages
+    )
+    if args.snapshot_path:
+        collector.load_snapshot()
+    if args.profile_cycles:
+        collector.start_profiling(args.profile_cycles, args.profile_path)
+    # the collector isn't registered with REGISTRY: its pre-rendered exposition is served along with REGISTRY's metrics
+    start_exposition_server(port, collector, REGISTRY)
     print("Serving at port: %s" % port)
-    while True:
-        try:
-            collector.update()
-            time.sleep(args.period_seconds)
-        except KeyboardInterrupt:
-            print("Caught SIGTERM - stopping...")
-            break
+    reloader = MetricsFileReloader(args.metrics_file_path, collector, args.shard_index, args.shard_count)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda *_: reloader.request_reload())
+    reloader.start(args.watch_interval)
+    scheduler = MetricScheduler(collector, args.period_seconds, startup_jitter=args.startup_jitter)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        print("Caught SIGTERM - stopping...")
     print("Done.")
 
 
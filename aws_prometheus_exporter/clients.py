@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import time
+from threading import Lock
+
+import boto3
+
+__all__ = ["AssumedRoleCredentials", "ClientPool", "account_from_role_arn"]
+
+
+class ClientPool:
+    """
+    Thread-safe cache of boto3 clients, keyed by (service, region_name, config).
+    Creating a client loads its service model and builds a new connection pool, so clients are created once and then
+    reused across refreshes: connections are kept alive between calls instead of paying for new TLS handshakes.
+    boto3 sessions are not thread-safe, so clients are created under a lock; the clients themselves are thread-safe.
+    Pools created from the same session must share that lock (see the lock argument).
+    """
+
+    def __init__(self, session, config=None, credentials=None, on_create=None, lock=None):
+        """
+        session: the boto3 session used to create clients
+        config (optional): a botocore.config.Config given to every client, e.g. to tune max_pool_connections
+        credentials (optional): an AssumedRoleCredentials; clients are then created from a session using these
+                                credentials instead, and created again whenever the credentials get refreshed
+        on_create (optional): a function called with every new client, e.g. to register event hooks on it
+        lock (optional): the lock serializing the use of session, i.e. the lock attribute of another pool created from
+                         the same session; a new lock by default
+        """
+        self._session = session
+        self._config = config
+        self._credentials = credentials
+        self._on_create = on_create
+        self._session_credentials = None
+        self._clients = {}
+        self.lock = lock if lock is not None else Lock()
+
+    def client(self, service, region_name=None):
+        """
+        Returns the cached client for service in region_name (the session's region by default), creating it if needed.
+        """
+        if self._credentials is not None:
+            self._refresh_session()
+        key = (service, region_name, self._config)
+        client = self._clients.get(key)
+        if client is None:
+            with self.lock:
+                client = self._clients.get(key)
+                if client is None:
+                    kwargs = {}
+                    if region_name is not None:
+                        kwargs["region_name"] = region_name
+                    if self._config is not None:
+                        kwargs["config"] = self._config
+                    client = self._session.client(service, **kwargs)
+                    if self._on_create is not None:
+                        self._on_create(client)
+                    self._clients[key] = client
+        return client
+
+    def clear(self):
+        """
+        Drops every cached client, so the next call to client() creates new ones.
+        """
+        with self.lock:
+            self._clients = {}
+
+    def _refresh_session(self):
+        credentials = self._credentials.get()
+        if credentials is not self._session_credentials:
+            with self.lock:
+                if credentials is not self._session_credentials:
+                    self._session = boto3.Session(**credentials)
+                    self._session_credentials = credentials
+                    self._clients = {}
+
+
+class AssumedRoleCredentials:
+    """
+    Thread-safe cache of the STS credentials of an assumed role.
+    Credentials are kept until refresh_margin seconds before they expire, and only then is the role assumed again.
+    """
+
+    def __init__(self, sts_client, role_arn, session_name="aws-prometheus-exporter", refresh_margin=300,
+                 clock=time.time):
+        """
+        sts_client: a boto3 STS client, used to assume the role
+        role_arn: the ARN of the role to assume
+        session_name (optional): the RoleSessionName given to sts:AssumeRole
+        refresh_margin (optional): seconds before expiration at which the credentials are refreshed
+        clock (optional): a function returning the current epoch time in seconds
+        """
+        self._sts_client = sts_client
+        self._role_arn = role_arn
+        self._session_name = session_name
+        self._refresh_margin = refresh_margin
+        self._clock = clock
+        self._credentials = None
+        self._expiration = None
+        self._lock = Lock()
+
+    def get(self):
+        """
+        Returns the current credentials, as a dict of boto3.Session kwargs. The same dict is returned until the
+        credentials get refreshed.
+        """
+        with self._lock:
+            if self._credentials is None or self._clock() >= self._expiration - self._refresh_margin:
+                response = self._sts_client.assume_role(RoleArn=self._role_arn, RoleSessionName=self._session_name)
+                credentials = response["Credentials"]
+                self._credentials = {
+                    "aws_access_key_id": credentials["AccessKeyId"],
+                    "aws_secret_access_key": credentials["SecretAccessKey"],
+                    "aws_session_token": credentials["SessionToken"],
+                }
+                self._expiration = credentials["Expiration"].timestamp()
+            return self._credentials
+
+
+def account_from_role_arn(role_arn):
+    """
+    Returns the AWS account id of a role ARN such as arn:aws:iam::123456789012:role/name.
+    """
+    parts = role_arn.split(":")
+    if len(parts) < 6 or parts[0] != "arn" or not parts[4]:
+        raise ValueError("'%s' is not a valid role ARN" % role_arn)
+    return parts[4]
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+__all__ = ["MAX_QUERIES_PER_REQUEST", "get_metric_data_pages", "merge_latest_values", "metric_data_query"]
+
+MAX_QUERIES_PER_REQUEST = 500  # GetMetricData limit
+LOOKBACK_PERIODS = 3  # datapoints are requested for this many periods, as the latest ones may not be published yet
+
+
+def metric_data_query(query_id, namespace, metric_name, dimensions, statistic, period):
+    """
+    Returns a GetMetricData query of the statistic of a metric, for a dict of dimension name to value.
+    query_id must start with a lowercase letter, and be unique within a request.
+    """
+    return {
+        "Id": query_id,
+        "MetricStat": {
+            "Metric": {
+                "Namespace": namespace,
+                "MetricName": metric_name,
+                "Dimensions": [{"Name": name, "Value": value} for (name, value) in dimensions.items()],
+            },
+            "Period": period,
+            "Stat": statistic,
+        },
+        "ReturnData": True,
+    }
+
+
+def get_metric_data_pages(client, queries, end_time=None):
+    """
+    Calls GetMetricData on a boto3 CloudWatch client with queries, packed into requests of up to
+    MAX_QUERIES_PER_REQUEST queries each, and yields the response pages of every request in turn, following NextToken.
+    Datapoints are requested for the LOOKBACK_PERIODS longest periods of the queries of a request which ended by
+    end_time (now by default), latest first. Requests end on a whole multiple of that period, so that the latest
+    datapoint is of a complete period rather than of the period still in progress, whose Sum and SampleCount would be
+    under-reported.
+    """
+    end_time = end_time or datetime.datetime.now(datetime.timezone.utc)
+    for start in range(0, len(queries), MAX_QUERIES_PER_REQUEST):
+        batch = queries[start:start + MAX_QUERIES_PER_REQUEST]
+        period = max(query["MetricStat"]["Period"] for query in batch)
+        batch_end_time = _round_down(end_time, period)
+        kwargs = {
+            "MetricDataQueries": batch,
+            "StartTime": batch_end_time - datetime.timedelta(seconds=LOOKBACK_PERIODS * period),
+            "EndTime": batch_end_time,
+            "ScanBy": "TimestampDescending",
+        }
+        while True:
+            response = client.get_metric_data(**kwargs)
+            yield response
+            next_token = response.get("NextToken")
+            if not next_token:
+                break
+            kwargs["NextToken"] = next_token
+
+
+def _round_down(time, seconds):
+    """
+    Returns the aware datetime time rounded down to a whole multiple of seconds since the epoch.
+    """
+    return time - datetime.timedelta(seconds=time.timestamp() % seconds)
+
+
+def merge_latest_values(values, page):
+    """
+    Records the latest value of each query found in a GetMetricData response page into values, a dict of query id
+    to value, unless values already holds one (pages being scanned latest first).
+    """
+    for result in page.get("MetricDataResults", []):
+        if result["Id"] not in values and result.get("Values"):
+            values[result["Id"]] = result["Values"][0]
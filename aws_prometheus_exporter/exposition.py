@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from prometheus_client import REGISTRY
+from prometheus_client.exposition import CONTENT_TYPE_LATEST, generate_latest
+
+__all__ = ["RenderedExposition", "render_families", "start_exposition_server"]
+
+GZIP_LEVEL = 6
+
+
+class _StaticCollector:
+    def __init__(self, families):
+        self._families = families
+
+    def collect(self):
+        return self._families
+
+
+def render_families(families):
+    """
+    Returns the exposition text of a list of metric families, as bytes.
+    """
+    return generate_latest(_StaticCollector(families))
+
+
+class RenderedExposition:
+    """
+    The exposition text of a snapshot, rendered once, along with its gzip-compressed form.
+    The compressor is kept primed with the text, so that a few more bytes (e.g. metrics which change on every scrape)
+    can be appended to the cached compressed bytes without compressing the whole text again.
+    """
+
+    def __init__(self, text):
+        """
+        text: the exposition text, as bytes
+        """
+        self.text = text
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._gzip_prefix = self._compressor.compress(text) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def body(self, suffix=b"", gzip=False):
+        """
+        Returns the exposition text followed by suffix, gzip-compressed if gzip is True.
+        Only suffix gets compressed: the compressed text is reused as is. This method is thread-safe.
+        """
+        if not gzip:
+            return self.text + suffix
+        compressor = self._compressor.copy()
+        return self._gzip_prefix + compressor.compress(suffix) + compressor.flush()
+
+
+def accepts_gzip(accept_encoding):
+    """
+    Returns True if an Accept-Encoding header value allows a gzip-encoded response. An explicit gzip (or x-gzip) coding
+    takes precedence over "*", which only applies when gzip is not listed.
+    """
+    qualities = {}
+    for coding in (accept_encoding or "").split(","):
+        name, _, params = coding.partition(";")
+        name = name.strip().lower()
+        if name not in ("gzip", "x-gzip", "*"):
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name] = max(quality, qualities.get(name, 0.0))
+    gzip_qualities = [qualities[name] for name in ("gzip", "x-gzip") if name in qualities]
+    if gzip_qualities:
+        return max(gzip_qualities) > 0
+    return qualities.get("*", 0.0) > 0
+
+
+def _handler_class(collector, registry):
+
+    class ExpositionHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            self._respond(include_body=True)
+
+        def do_HEAD(self):  # pylint: disable=invalid-name
+            self._respond(include_body=False)
+
+        def _respond(self, include_body):
+            path = self.path.split("?", 1)[0]
+            if path == "/debug/profile":
+                self._respond_profile_report(include_body)
+                return
+            if path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            collector.refresh_stale_metrics()
+            gzip = accepts_gzip(self.headers.get("Accept-Encoding"))
+            suffix = collector.render_exporter_metrics()
+            if registry is not None:
+                suffix += generate_latest(registry)
+            body = collector.exposition().body(suffix, gzip)
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE_LATEST)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Vary", "Accept-Encoding")
+            if gzip:
+                self.send_header("Content-Encoding", "gzip")
+            self.end_headers()
+            if include_body:
+                self.wfile.write(body)
+
+        def _respond_profile_report(self, include_body):
+            report = collector.profile_report()
+            if report is None:
+                self.send_error(404, "No profile report yet (see AwsMetricsCollector.start_profiling())")
+                return
+            body = report.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if include_body:
+                self.wfile.write(body)
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            pass
+
+    return ExpositionHandler
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_exposition_server(port, collector, registry=REGISTRY, addr=""):
+    """
+    Starts an HTTP server on a daemon thread, serving the pre-rendered exposition of an AwsMetricsCollector
+    (see AwsMetricsCollector.exposition()) followed by the metrics of registry, on / and /metrics.
+    The collector must not be registered with registry, or its metrics would be served twice.
+    Metrics with a max_age are refreshed first if needed (see AwsMetricsCollector.refresh_stale_metrics()).
+    Responses are gzip-compressed when the client accepts it. The report of the last profiling of the collector
+    (see AwsMetricsCollector.start_profiling()) is served on /debug/profile. Returns the HTTPServer.
+    """
+    server = _ThreadingHTTPServer((addr, port), _handler_class(collector, registry))
+    thread = threading.Thread(target=server.serve_forever, name="exposition-server", daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from prometheus_client import Counter, Gauge, Histogram
+
+__all__ = ["CollectorInstrumentation", "RequestCounter"]
+
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float("inf"))
+
+
+class CollectorInstrumentation:
+    """
+    Metrics describing the work of an AwsMetricsCollector, labelled by the name of each AwsMetric.
+    The underlying prometheus_client metrics are not registered with any registry: collect() yields them instead.
+    """
+
+    def __init__(self, label_names, target_label_names=()):
+        """
+        label_names: the names of the labels identifying the collector
+        target_label_names (optional): the names of the labels identifying a target, added after label_names and
+                                       before the 'metric' label of per-metric metrics
+        """
+        metric_label_names = list(label_names) + list(target_label_names) + ["metric"]
+        self._collection_duration = Histogram(
+            "aws_prometheus_exporter_metric_collection_duration_seconds",
+            "Seconds spent collecting a metric, including the API calls shared with other metrics",
+            labelnames=metric_label_names,
+            buckets=DURATION_BUCKETS,
+            registry=None
+        )
+        self._api_calls = Counter(
+            "aws_prometheus_exporter_metric_api_calls",
+            "Number of AWS API requests sent to collect a metric, including retries and STS calls",
+            labelnames=metric_label_names,
+            registry=None
+        )
+        self._pages = Counter(
+            "aws_prometheus_exporter_metric_pages",
+            "Number of pages of results fetched to collect a metric",
+            labelnames=metric_label_names,
+            registry=None
+        )
+        self._series = Gauge(
+            "aws_prometheus_exporter_metric_series",
+            "Number of series produced by the last successful collection of a metric",
+            labelnames=metric_label_names,
+            registry=None
+        )
+        self._dropped_series = Gauge(
+            "aws_prometheus_exporter_metric_dropped_series",
+            "Number of series dropped by the last successful collection of a metric for exceeding its max_series",
+            labelnames=metric_label_names,
+            registry=None
+        )
+        self._last_success = Gauge(
+            "aws_prometheus_exporter_metric_last_success_timestamp_seconds",
+            "Unix time of the last successful collection of a metric",
+            labelnames=metric_label_names,
+            registry=None
+        )
+        self._errors = Counter(
+            "aws_prometheus_exporter_metric_errors",
+            "Number of failed collections of a metric",
+            labelnames=metric_label_names,
+            registry=None
+        )
+        self._timeouts = Counter(
+            "aws_prometheus_exporter_metric_timeouts",
+            "Number of collections of a metric stopped for exceeding its timeout or the update cycle budget",
+            labelnames=metric_label_names,
+            registry=None
+        )
+        self._update_duration = Histogram(
+            "aws_prometheus_exporter_update_duration_seconds",
+            "Seconds spent refreshing metrics in an update cycle",
+            labelnames=list(label_names),
+            buckets=DURATION_BUCKETS,
+            registry=None
+        )
+
+    def observe_collection(self, label_values, metric_names, duration, pages, requests, series_counts=None,
+                           timestamp=None):
+        """
+        Records the collection of metrics sharing the same API call.
+        label_values: values of the label_names and target_label_names given to the constructor
+        metric_names: names of the metrics collected together
+        duration: seconds spent collecting them
+        pages: number of pages fetched
+        requests: number of API requests sent (see RequestCounter)
+        series_counts (optional): dict of metric name to number of series produced, or None if the collection failed
+        timestamp (optional): time of the successful collection
+        """
+        failed = series_counts is None
+        for metric_name in metric_names:
+            labels = list(label_values) + [metric_name]
+            self._collection_duration.labels(*labels).observe(duration)
+            self._api_calls.labels(*labels).inc(requests)
+            self._pages.labels(*labels).inc(pages)
+            if failed:
+                self._errors.labels(*labels).inc()
+            else:
+                self._series.labels(*labels).set(series_counts[metric_name])
+                self._last_success.labels(*labels).set(timestamp)
+
+    def observe_timeout(self, label_values, metric_names):
+        """
+        Records the collection of metrics sharing the same API call being stopped by a timeout (which also gets
+        recorded by observe_collection() as failed).
+        label_values: values of the label_names and target_label_names given to the constructor
+        metric_names: names of the metrics collected together
+        """
+        for metric_name in metric_names:
+            self._timeouts.labels(*(list(label_values) + [metric_name])).inc()
+
+    def observe_dropped_series(self, label_values, metric_name, count):
+        """
+        Records the number of series dropped by the collection of a metric with a max_series.
+        label_values: values of the label_names and target_label_names given to the constructor
+        """
+        self._dropped_series.labels(*(list(label_values) + [metric_name])).set(count)
+
+    def observe_update(self, label_values, duration):
+        """
+        Records the duration of an update cycle.
+        label_values: values of the label_names given to the constructor
+        """
+        histogram = self._update_duration.labels(*label_values) if label_values else self._update_duration
+        histogram.observe(duration)
+
+    def collect(self):
+        """
+        Yields the metric families of every metric, as expected by CollectorRegistry.
+        """
+        for metric in (self._collection_duration, self._api_calls, self._pages, self._series, self._dropped_series,
+                       self._last_success, self._errors, self._timeouts, self._update_duration):
+            yield from metric.collect()
+
+
+class RequestCounter:
+    """
+    Counts the requests sent by boto3 clients, retries included, into the counts given to run() by the thread sending
+    them. Requests sent outside of run() are not counted.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def register(self, client):
+        """
+        Registers the counter on the event hooks of a boto3 client.
+        """
+        client.meta.events.register_first("before-send", self._before_send)
+
+    def run(self, counts, function, *args):
+        """
+        Calls function with args, and returns its result, adding the number of requests it sent to the requests
+        attribute of counts.
+        """
+        previous = getattr(self._local, "counts", None)
+        self._local.counts = counts
+        try:
+            return function(*args)
+        finally:
+            self._local.counts = previous
+
+    def _before_send(self, **_):
+        counts = getattr(self._local, "counts", None)
+        if counts is not None:
+            counts.requests += 1
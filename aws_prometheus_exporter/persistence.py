@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import mmap
+import struct
+from array import array
+
+from aws_prometheus_exporter.samples import SampleTable
+
+__all__ = ["load_snapshot_file", "save_snapshot_file"]
+
+MAGIC = b"APESNAP1"
+_HEADER = struct.Struct("<8sI4x")  # magic, number of entries
+_ENTRY = struct.Struct("<dII")  # timestamp, number of samples, number of label columns
+_COUNT = struct.Struct("<I")
+_ALIGNMENT = 8
+
+
+def save_snapshot_file(path, entries):
+    """
+    Writes entries to path, atomically replacing it, in a compact binary format meant to be memory-mapped:
+
+    header: magic (8 bytes), number of entries (uint32), padding (4 bytes)
+    each entry: key, timestamp (float64), number of samples (uint32), number of label columns (uint32),
+                label values, strings, one column of uint32 string indexes per label, values (float64)
+
+    Keys, label values and strings are lists of str, stored as their number (uint32), the byte length of each
+    (uint32) and their UTF-8 bytes. Every section starts on an 8-byte boundary, and numbers are little-endian.
+
+    entries: a list of (key, timestamp, SampleTable), where key is a list of str
+    """
+    temporary_path = "%s.tmp.%d" % (path, os.getpid())
+    try:
+        with open(temporary_path, "wb") as out:
+            out.write(_HEADER.pack(MAGIC, len(entries)))
+            for (key, timestamp, table) in entries:
+                _write_strings(out, key)
+                out.write(_ENTRY.pack(timestamp, len(table), len(table.columns)))
+                _write_strings(out, table.label_values)
+                _write_strings(out, table.strings)
+                for column in table.columns:
+                    _write_array(out, array("I", column))
+                _write_array(out, array("d", table.values))
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+
+def load_snapshot_file(path):
+    """
+    Reads the entries written by save_snapshot_file() from path, as a list of (key, timestamp, SampleTable).
+    The file is memory-mapped, and the columns and values of the tables are read from it without being copied
+    (on little-endian machines). Raises ValueError if the file is not a valid snapshot file.
+    """
+    with open(path, "rb") as snapshot_file:
+        if os.fstat(snapshot_file.fileno()).st_size < _HEADER.size:
+            raise ValueError("%s is not a snapshot file" % path)
+        buffer = memoryview(mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ))
+    try:
+        (magic, entry_count) = _HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a snapshot file" % path)
+        offset = _HEADER.size
+        entries = []
+        for _ in range(entry_count):
+            (key, offset) = _read_strings(buffer, offset)
+            (timestamp, sample_count, column_count) = _ENTRY.unpack_from(buffer, offset)
+            offset += _ENTRY.size
+            (label_values, offset) = _read_strings(buffer, offset)
+            (strings, offset) = _read_strings(buffer, offset)
+            columns = []
+            for _ in range(column_count):
+                (column, offset) = _read_array(buffer, offset, "I", sample_count)
+                columns.append(column)
+            (values, offset) = _read_array(buffer, offset, "d", sample_count)
+            entries.append((key, timestamp, SampleTable(label_values, strings, columns, values)))
+        return entries
+    except (struct.error, UnicodeDecodeError, TypeError) as e:
+        raise ValueError("%s is not a valid snapshot file: %s" % (path, e))
+
+
+def _padding(length):
+    return b"\0" * (-length % _ALIGNMENT)
+
+
+def _write_strings(out, strings):
+    encoded = [str(string).encode("utf-8") for string in strings]
+    lengths = array("I", [len(string) for string in encoded])
+    if sys.byteorder != "little":
+        lengths.byteswap()
+    header = _COUNT.pack(len(encoded)) + lengths.tobytes()
+    data = b"".join(encoded)
+    out.write(header + _padding(len(header)) + data + _padding(len(data)))
+
+
+def _read_strings(buffer, offset):
+    (count,) = _COUNT.unpack_from(buffer, offset)
+    header_length = _COUNT.size + 4 * count
+    lengths = array("I")
+    lengths.frombytes(buffer[offset + _COUNT.size:offset + header_length])
+    if sys.byteorder != "little":
+        lengths.byteswap()
+    offset += header_length + (-header_length % _ALIGNMENT)
+    strings = []
+    position = offset
+    for length in lengths:
+        strings.append(str(buffer[position:position + length], "utf-8"))
+        position += length
+    return (strings, position + (-(position - offset) % _ALIGNMENT))
+
+
+def _write_array(out, values):
+    if sys.byteorder != "little":
+        values.byteswap()
+    data = values.tobytes()
+    out.write(data + _padding(len(data)))
+
+
+def _read_array(buffer, offset, typecode, length):
+    size = array(typecode).itemsize * length
+    if offset + size > len(buffer):
+        raise ValueError("truncated snapshot file")
+    view = buffer[offset:offset + size]
+    if sys.byteorder == "little":
+        values = view.cast(typecode)
+    else:
+        values = array(typecode)
+        values.frombytes(view)
+        values.byteswap()
+    return (values, offset + size + (-size % _ALIGNMENT))
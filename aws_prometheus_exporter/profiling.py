@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+import io
+import time
+import pstats
+import cProfile
+import tracemalloc
+from threading import Event, Lock
+
+__all__ = ["PHASES", "UpdateProfiler"]
+
+PHASES = ("fetch", "search", "convert", "build")
+TOP_ALLOCATION_SITES = 20
+TOP_FUNCTIONS = 40
+
+_END = object()
+
+
+class UpdateProfiler:
+    """
+    Profiles the collection of metrics over a number of update cycles of an AwsMetricsCollector (see
+    AwsMetricsCollector.start_profiling()), with cProfile and tracemalloc. Time and memory are broken down by metric
+    and by phase:
+    - fetch: waiting for the pages of API calls, i.e. network I/O and botocore response parsing (the cProfile
+             statistics tell these apart); metrics sharing a call are each attributed the whole time of the call
+    - search: evaluating the JMESPath search of a metric on each page
+    - convert: converting the search results into samples
+    - build: building the SampleTable of a metric once every page has been converted
+    Memory is the net size of the blocks allocated by a phase, as traced by tracemalloc. It is approximate when
+    metrics are collected concurrently, as the allocations of other threads get counted as well. Likewise, the cProfile
+    statistics only cover one thread at a time when metrics are collected concurrently (see run()).
+    """
+
+    def __init__(self, cycles, report_path=None):
+        """
+        cycles: the number of update cycles to profile
+        report_path (optional): the path of a file to write the report to once done
+        """
+        if cycles < 1:
+            raise ValueError("cycles must be at least 1")
+        self.cycles = cycles
+        self._cycles_left = cycles
+        self.report_path = report_path
+        self._lock = Lock()
+        self._profile_lock = Lock()  # held by the thread being profiled with cProfile, see run()
+        self._stats = None  # pstats.Stats merging the profiles of every step
+        self._phases = {}  # dict of (metric_name, phase) to [calls, seconds, bytes]
+        self._start_time = None
+        self._start_snapshot = None
+        self._started_tracing = False
+        self._report = None
+        self.done = Event()
+
+    def start(self):
+        """
+        Starts tracing memory allocations, unless tracemalloc already is.
+        """
+        self._start_time = time.perf_counter()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        self._start_snapshot = tracemalloc.take_snapshot()
+
+    def run(self, function, *args):
+        """
+        Calls function with args under cProfile, and returns its result. This method is thread-safe, but only profiles
+        one call at a time, as Python 3.12+ allows a single active profiler: calls made by other threads meanwhile, or
+        while another profiling tool is active, are run without cProfile (measure() still accounts for them).
+        """
+        if not self._profile_lock.acquire(blocking=False):
+            return function(*args)
+        try:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:  # another profiling tool is already active
+                return function(*args)
+            try:
+                return function(*args)
+            finally:
+                profile.disable()
+                self._add_stats(profile)
+        finally:
+            self._profile_lock.release()
+
+    def _add_stats(self, profile):
+        profile.create_stats()
+        if profile.stats:
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+
+    def measure(self, metric_names, phase, function, *args):
+        """
+        Calls function with args, and returns its result, attributing the time it took and the memory it allocated
+        to phase of each of metric_names. This method is thread-safe.
+        """
+        start_size = tracemalloc.get_traced_memory()[0]
+        start_time = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            seconds = time.perf_counter() - start_time
+            allocated = tracemalloc.get_traced_memory()[0] - start_size
+            with self._lock:
+                for metric_name in metric_names:
+                    totals = self._phases.setdefault((metric_name, phase), [0, 0.0, 0])
+                    totals[0] += 1
+                    totals[1] += seconds
+                    totals[2] += allocated
+
+    def timed_pages(self, metric_names, pages):
+        """
+        Yields pages, measuring the time spent fetching each as the fetch phase of metric_names.
+        """
+        pages = iter(pages)
+        while True:
+            page = self.measure(metric_names, "fetch", next, pages, _END)
+            if page is _END:
+                return
+            yield page
+
+    def cycle_finished(self):
+        """
+        Records the end of an update cycle. Returns True when it was the last cycle to profile, once the report is
+        ready (and written to report_path, if given). This method is thread-safe.
+        """
+        with self._lock:
+            if self._cycles_left == 0:
+                return False
+            self._cycles_left -= 1
+            if self._cycles_left > 0:
+                return False
+        allocation_sites = tracemalloc.take_snapshot().compare_to(self._start_snapshot, "lineno")
+        if self._started_tracing:
+            tracemalloc.stop()
+        self._report = self._format_report(allocation_sites)
+        if self.report_path is not None:
+            with open(self.report_path, "w") as report_file:
+                report_file.write(self._report)
+        self.done.set()
+        return True
+
+    def report(self):
+        """
+        Returns the text of the report, or None until the last cycle has finished.
+        """
+        return self._report
+
+    def _format_report(self, allocation_sites):
+        out = io.StringIO()
+        out.write("Profile of %d update cycles, over %.3f seconds\n\n" % (
+            self.cycles, time.perf_counter() - self._start_time
+        ))
+        out.write("Time and memory by metric and phase:\n")
+        out.write("%-50s %-8s %10s %12s %14s\n" % ("metric", "phase", "calls", "seconds", "net bytes"))
+        with self._lock:
+            phases = sorted(self._phases.items(), key=lambda item: (item[0][0], PHASES.index(item[0][1])))
+            stats = self._stats
+        for ((metric_name, phase), (calls, seconds, allocated)) in phases:
+            out.write("%-50s %-8s %10d %12.6f %14d\n" % (metric_name, phase, calls, seconds, allocated))
+        out.write("\nTop %d allocation sites (net change since profiling started):\n" % TOP_ALLOCATION_SITES)
+        for site in allocation_sites[:TOP_ALLOCATION_SITES]:
+            out.write("%s\n" % site)
+        out.write("\nTop %d functions by cumulative time (cProfile):\n" % TOP_FUNCTIONS)
+        if stats is not None:
+            stats.stream = out
+            stats.sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        return out.getvalue()
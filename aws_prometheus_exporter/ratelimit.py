@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+import time
+import random
+from threading import Lock, RLock
+
+__all__ = ["AdaptiveRateLimiter", "TokenBucket", "THROTTLING_ERROR_CODES"]
+
+THROTTLING_ERROR_CODES = frozenset([
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "ProvisionedThroughputExceededException",
+    "TransactionInProgressException",
+    "RequestLimitExceeded",
+    "BandwidthLimitExceeded",
+    "LimitExceededException",
+    "RequestThrottled",
+    "SlowDown",
+    "PriorRequestNotComplete",
+    "EC2ThrottledException",
+])
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket, refilled continuously at rate tokens per second, up to capacity tokens.
+    The rate can be changed at any time (see AdaptiveRateLimiter).
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        """
+        rate: tokens added per second
+        capacity (optional): maximum number of tokens, i.e. the largest burst allowed (defaults to max(1, rate))
+        clock (optional): a function returning the current time in seconds
+        sleep (optional): a function sleeping for the given number of seconds
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self._capacity = capacity or max(1.0, rate)
+        self._tokens = self._capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated_at = clock()
+        self._lock = Lock()
+
+    def acquire(self):
+        """
+        Takes a token, sleeping until one is available. Returns the number of seconds spent waiting.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            self._sleep(delay)
+            waited += delay
+
+
+class AdaptiveRateLimiter:
+    """
+    Rate limits AWS API calls with one TokenBucket per (service, operation), whose rate adapts to throttling responses
+    using AIMD: every throttling response divides the rate by 2 (at most once per second), and every successful
+    response increases it by increase_per_second / rate, i.e. by about increase_per_second every second.
+    Throttled attempts are also retried, with a full-jitter exponential backoff, until max_attempts is reached.
+    This takes over from botocore's own retries for throttling responses only; other errors are left to botocore.
+
+    Call register() on a boto3 client to rate limit every HTTP request it sends, including paginator pages and retries.
+    """
+
+    def __init__(self, rates=None, default_rate=10.0, min_rate=0.5, increase_per_second=0.5, max_attempts=8,
+                 base_delay=0.25, max_delay=20.0, clock=time.monotonic, sleep=time.sleep, jitter=random.random):
+        """
+        rates (optional): dict of "service" or "service.OperationName" (e.g. "ec2.DescribeInstances") to the initial
+                          and maximum number of requests per second allowed for that API
+        default_rate (optional): requests per second allowed for the APIs not found in rates
+        min_rate (optional): the rate is never decreased below this number of requests per second
+        increase_per_second (optional): additive increase of the rate, in requests per second, per second of success
+        max_attempts (optional): maximum number of attempts of a throttled request, including the first one
+        base_delay (optional): seconds of backoff after the first throttled attempt, doubled after each attempt
+        max_delay (optional): maximum seconds of backoff before an attempt
+        clock, sleep, jitter (optional): time, sleep and random functions (for testing)
+        """
+        self._rates = dict(rates or {})
+        self._default_rate = default_rate
+        self._min_rate = min_rate
+        self._increase_per_second = increase_per_second
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._clock = clock
+        self._sleep = sleep
+        self._jitter = jitter
+        self._buckets = {}  # dict of (service, operation) to [TokenBucket, max_rate, time of last decrease]
+        self._throttled = {}  # dict of (service, operation) to number of throttling responses
+        self._lock = RLock()
+
+    def register(self, client):
+        """
+        Registers the rate limiter on the event hooks of a boto3 client.
+        """
+        service = client.meta.service_model.service_name
+        service_event_name = client.meta.service_model.service_id.hyphenize()
+        client.meta.events.register(
+            "before-send.%s" % service_event_name,
+            lambda event_name, **_: self._before_send(service, event_name)
+        )
+        # botocore registers its own retry handler on this same event name: ours must come first to take precedence
+        client.meta.events.register_first(
+            "needs-retry.%s" % service_event_name,
+            lambda **kwargs: self._needs_retry(service, **kwargs)
+        )
+
+    def acquire(self, service, operation):
+        """
+        Waits until a request to service.operation is allowed. Returns the number of seconds spent waiting.
+        """
+        return self._bucket(service, operation)[0].acquire()
+
+    def on_success(self, service, operation):
+        with self._lock:
+            state = self._bucket(service, operation)
+            bucket = state[0]
+            bucket.rate = min(state[1], bucket.rate + self._increase_per_second / bucket.rate)
+
+    def on_throttle(self, service, operation):
+        with self._lock:
+            key = (service, operation)
+            self._throttled[key] = self._throttled.get(key, 0) + 1
+            state = self._bucket(service, operation)
+            now = self._clock()
+            if state[2] is None or now - state[2] >= 1.0:
+                state[0].rate = max(self._min_rate, state[0].rate / 2)
+                state[2] = now
+
+    def backoff(self, attempts):
+        """
+        Returns the seconds to wait before the attempt following attempt number attempts (starting at 1).
+        """
+        return self._jitter() * min(self._max_delay, self._base_delay * 2 ** (attempts - 1))
+
+    def throttled_counts(self):
+        """
+        Returns a dict of (service, operation) to the number of throttling responses received so far.
+        """
+        with self._lock:
+            return dict(self._throttled)
+
+    def rates(self):
+        """
+        Returns a dict of (service, operation) to the number of requests per second currently allowed.
+        """
+        with self._lock:
+            return {key: state[0].rate for (key, state) in self._buckets.items()}
+
+    def _bucket(self, service, operation):
+        key = (service, operation)
+        state = self._buckets.get(key)
+        if state is None:
+            with self._lock:
+                state = self._buckets.get(key)
+                if state is None:
+                    rate = self._rates.get("%s.%s" % key, self._rates.get(service, self._default_rate))
+                    state = [TokenBucket(rate, clock=self._clock, sleep=self._sleep), rate, None]
+                    self._buckets[key] = state
+        return state
+
+    def _before_send(self, service, event_name):
+        self.acquire(service, event_name.rsplit(".", 1)[-1])
+
+    def _needs_retry(self, service, response=None, operation=None, attempts=None, **_):
+        if response is None or operation is None:
+            return None  # connection errors are left to botocore
+        (http_response, parsed) = response
+        code = parsed.get("Error", {}).get("Code")
+        if code in THROTTLING_ERROR_CODES or http_response.status_code == 429:
+            self.on_throttle(service, operation.name)
+            if attempts < self._max_attempts:
+                return self.backoff(attempts)
+            return False  # gives up, rather than letting botocore's own retry handler retry throttled requests
+        elif http_response.status_code < 400:
+            self.on_success(service, operation.name)
+        return None
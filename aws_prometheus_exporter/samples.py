@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+from array import array
+
+__all__ = ["SampleTable", "SampleTableBuilder", "NULL_LABEL_VALUE"]
+
+NULL_LABEL_VALUE = "<null>"
+
+
+class SampleTable:
+    """
+    The samples of a metric collected from a target, stored in columns:
+    - label_values: the label values common to every sample (e.g. those of the collector and target), stored once
+    - strings: the distinct values of the other labels
+    - columns: one array of indexes into strings per label name of the metric
+    - values: an array of doubles
+    Iterating yields (label_values, value) samples, with label_values as a list. SampleTable objects are never mutated.
+    """
+
+    __slots__ = ("label_values", "strings", "columns", "values")
+
+    def __init__(self, label_values, strings, columns, values):
+        self.label_values = list(label_values)
+        self.strings = strings
+        self.columns = columns
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        strings = self.strings
+        label_values = self.label_values
+        if not self.columns:
+            for value in self.values:
+                yield (list(label_values), value)
+            return
+        for (codes, value) in zip(zip(*self.columns), self.values):
+            yield (label_values + [strings[code] for code in codes], value)
+
+    def __eq__(self, other):
+        return isinstance(other, SampleTable) and list(self) == list(other)
+
+    def __repr__(self):
+        return "SampleTable(%r)" % list(self)
+
+
+class SampleTableBuilder:
+    """
+    Builds a SampleTable one sample at a time.
+    Label values are interned through string_pool (a dict of str to itself, shared across metrics and refresh cycles),
+    so a label value seen by many metrics or many cycles is only kept once in memory. None label values are stored as
+    NULL_LABEL_VALUE.
+    """
+
+    def __init__(self, label_values, label_count, string_pool=None):
+        """
+        label_values: the label values common to every sample
+        label_count: the number of other label values of each sample
+        string_pool (optional): a dict of str to itself, updated with the label values added
+        """
+        self._label_values = label_values
+        self._string_pool = string_pool if string_pool is not None else {}
+        self._codes = {}  # dict of label value to index in self._strings
+        self._strings = []
+        self._columns = [array("I") for _ in range(label_count)]
+        self._values = array("d")
+
+    def add(self, labels, value):
+        """
+        Adds a sample, given the values of its labels (in label_names order) and its value (a number).
+        """
+        self._values.append(value)  # raises TypeError if value is not a number
+        codes = self._codes
+        for (column, label) in zip(self._columns, labels):
+            code = codes.get(label)
+            if code is None:
+                code = codes[label] = len(self._strings)
+                if label is None:
+                    self._strings.append(NULL_LABEL_VALUE)
+                else:
+                    self._strings.append(self._string_pool.setdefault(label, label))
+            column.append(code)
+
+    def build(self):
+        return SampleTable(self._label_values, self._strings, self._columns, self._values)
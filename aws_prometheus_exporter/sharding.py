@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import functools
+
+__all__ = ["assign_shards"]
+
+DEFAULT_LOAD_FACTOR = 1.25
+
+
+def _score(key, shard):
+    digest = hashlib.sha1(("%s\0%d" % (key, shard)).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def assign_shards(items, shard_count, load_factor=DEFAULT_LOAD_FACTOR):
+    """
+    Assigns weighted items to shards, using rendezvous hashing with bounded loads: each item goes to the shard ranking
+    it highest, unless that shard's load would exceed load_factor times the average load, in which case it goes to the
+    next shard in its ranking. Items are placed heaviest first, in a deterministic order, so every process assigns the
+    same items the same way. Going from n to n + 1 shards only moves about 1 / (n + 1) of the items.
+
+    items: a list of (key, cost), where key is a str identifying the item, and cost a positive number
+    shard_count: the number of shards
+    Returns a list of shard indexes, in the same order as items.
+    """
+    if shard_count < 1:
+        raise ValueError("shard_count must be at least 1")
+    if load_factor < 1:
+        raise ValueError("load_factor must be at least 1")
+    total_cost = sum(cost for (_, cost) in items)
+    max_load = load_factor * total_cost / shard_count
+    loads = [0.0] * shard_count
+    shards = [None] * len(items)
+    order = sorted(range(len(items)), key=lambda index: (-items[index][1], items[index][0]))
+    for index in order:
+        (key, cost) = items[index]
+        ranking = sorted(range(shard_count), key=functools.partial(_score, key), reverse=True)
+        shard = next(
+            (shard for shard in ranking if loads[shard] + cost <= max_load),
+            min(ranking, key=lambda shard: loads[shard])
+        )
+        loads[shard] += cost
+        shards[index] = shard
+    return shards
@@ -4,10 +4,19 @@ from unittest import mock
 from unittest.mock import call
 
 from collections import namedtuple
+import asyncio
 import datetime
+import threading
+import time
 
-from prometheus_client.core import Sample
-from aws_prometheus_exporter import parse_aws_metrics, AwsMetric, AwsMetricsCollector
+from botocore.awsrequest import AWSResponse
+from prometheus_client.core import CollectorRegistry, Sample
+import boto3
+import pytest
+import aws_prometheus_exporter
+from aws_prometheus_exporter import (
+    parse_aws_metrics, AwsMetric, AwsMetricsCollector, AwsTarget, JmesPathSearch, MetricScheduler, shard_metrics
+)
 
 # pylint: disable=protected-access
 
@@ -123,7 +132,8 @@ def test_load_single_aws_metric_needing_eval():
         },
         use_paginator=True,
         label_names=["id"],
-        search="Clusters[].{id: Id, value: `1`}"
+        search="Clusters[].{id: Id, value: `1`}",
+        method_args_expression='{\n    "CreatedAfter": datetime(2018,1,1) - timedelta(weeks=4)\n}\n'
     )
 
 
@@ -176,12 +186,12 @@ SessionMocksUsingPaginator = namedtuple("SessionMocksUsingPaginator", [
 ])
 
 
-def create_session_mocks_using_paginator(search_response_iterator):
+def create_session_mocks_using_paginator(pages):
     session = mock.NonCallableMagicMock()
     paginator = mock.NonCallableMagicMock()
     service = mock.NonCallableMagicMock()
     paginate_response_iterator = mock.NonCallableMagicMock()
-    paginate_response_iterator.search = mock.Mock(return_value=search_response_iterator)
+    paginate_response_iterator.__iter__ = mock.Mock(side_effect=lambda: iter(pages))
     paginator.paginate = mock.Mock(return_value=paginate_response_iterator)
     service.get_paginator = mock.Mock(return_value=paginator)
     session.client = mock.Mock(return_value=service)
@@ -190,9 +200,8 @@ def create_session_mocks_using_paginator(search_response_iterator):
 
 def test_collect_metric():
     mocks = create_session_mocks_using_paginator([
-        {"id": "instance_id_1", "value": 1},
-        {"id": "instance_id_2", "value": 1},
-        {"id": "instance_id_3", "value": 1}
+        {"Reservations": [{"Instances": [{"InstanceId": "instance_id_1"}, {"InstanceId": "instance_id_2"}]}]},
+        {"Reservations": [{"Instances": [{"InstanceId": "instance_id_3"}]}]},
     ])
     metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR)
     collector = AwsMetricsCollector(metrics, mocks.session)
@@ -204,7 +213,7 @@ def test_collect_metric():
         "Name": "instance-state-name",
         "Values": ["Running"]
     }])
-    mocks.paginate_response_iterator.search.assert_called_once_with(metrics[0].search)
+    mocks.paginate_response_iterator.__iter__.assert_called_once_with()
     assert gauge_family.samples == [
         Sample("ec2_instance_ids", {"id": "instance_id_1"}, 1),
         Sample("ec2_instance_ids", {"id": "instance_id_2"}, 1),
@@ -266,9 +275,7 @@ def test_collect_metric_using_service_method():
 
 def test_collect_metric_convert_nulls():
     mocks = create_session_mocks_using_paginator([
-        {"id": None, "value": 1},
-        {"id": "", "value": 1},
-        {"id": "instance_id_3", "value": 1}
+        {"Reservations": [{"Instances": [{"InstanceId": None}, {"InstanceId": ""}, {"InstanceId": "instance_id_3"}]}]},
     ])
     metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR)
     collector = AwsMetricsCollector(metrics, mocks.session)
@@ -280,7 +287,7 @@ def test_collect_metric_convert_nulls():
         "Name": "instance-state-name",
         "Values": ["Running"]
     }])
-    mocks.paginate_response_iterator.search.assert_called_once_with(metrics[0].search)
+    mocks.paginate_response_iterator.__iter__.assert_called_once_with()
     assert gauge_family.samples == [
         Sample("ec2_instance_ids", {"id": "<null>"}, 1),
         Sample("ec2_instance_ids", {"id": ""}, 1),
@@ -290,9 +297,8 @@ def test_collect_metric_convert_nulls():
 
 def test_collect_metric_with_extra_labels():
     mocks = create_session_mocks_using_paginator([
-        {"id": "instance_id_1", "value": 1},
-        {"id": "instance_id_2", "value": 1},
-        {"id": "instance_id_3", "value": 1}
+        {"Reservations": [{"Instances": [{"InstanceId": "instance_id_1"}, {"InstanceId": "instance_id_2"}]}]},
+        {"Reservations": [{"Instances": [{"InstanceId": "instance_id_3"}]}]},
     ])
     metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR)
     collector = AwsMetricsCollector(metrics, mocks.session, ["region_name", "env"], ["us-east-1", "dev"])
@@ -304,9 +310,1005 @@ def test_collect_metric_with_extra_labels():
         "Name": "instance-state-name",
         "Values": ["Running"]
     }])
-    mocks.paginate_response_iterator.search.assert_called_once_with(metrics[0].search)
+    mocks.paginate_response_iterator.__iter__.assert_called_once_with()
     assert gauge_family.samples == [
         Sample("ec2_instance_ids", {"region_name": "us-east-1", "env": "dev", "id": "instance_id_1"}, 1),
         Sample("ec2_instance_ids", {"region_name": "us-east-1", "env": "dev", "id": "instance_id_2"}, 1),
         Sample("ec2_instance_ids", {"region_name": "us-east-1", "env": "dev", "id": "instance_id_3"}, 1)
     ]
+
+
+def instance_pages(*instance_ids):
+    return [{"Reservations": [{"Instances": [{"InstanceId": instance_id} for instance_id in instance_ids]}]}]
+
+
+def test_collect_serves_previous_snapshot_during_update():
+    mocks = create_session_mocks_using_paginator(instance_pages("instance_id_1"))
+    metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR)
+    collector = AwsMetricsCollector(metrics, mocks.session)
+    collector.update()
+
+    update_started = threading.Event()
+    release_update = threading.Event()
+
+    def blocking_iter():
+        update_started.set()
+        release_update.wait(5)
+        return iter(instance_pages("instance_id_2"))
+
+    mocks.paginate_response_iterator.__iter__ = mock.Mock(side_effect=blocking_iter)
+    update_thread = threading.Thread(target=collector.update)
+    update_thread.start()
+    try:
+        assert update_started.wait(5)
+        gauge_family = list(collector.collect())[0]
+        assert gauge_family.samples == [Sample("ec2_instance_ids", {"id": "instance_id_1"}, 1)]
+    finally:
+        release_update.set()
+        update_thread.join(5)
+    gauge_family = list(collector.collect())[0]
+    assert gauge_family.samples == [Sample("ec2_instance_ids", {"id": "instance_id_2"}, 1)]
+
+
+def test_collect_reports_snapshot_age():
+    mocks = create_session_mocks_using_paginator(instance_pages("instance_id_1"))
+    metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR)
+    collector = AwsMetricsCollector(metrics, mocks.session)
+    age_family = list(collector.collect())[1]
+    assert age_family.name == "aws_prometheus_exporter_snapshot_age_seconds"
+    assert age_family.samples == []
+    with mock.patch("time.time", return_value=1000.0):
+        collector.update()
+    with mock.patch("time.time", return_value=1042.0):
+        age_family = list(collector.collect())[1]
+    assert age_family.samples == [Sample("aws_prometheus_exporter_snapshot_age_seconds", {}, 42.0)]
+
+
+def test_snapshot_age_is_labelled_with_the_collector_labels():
+    mocks = create_session_mocks_using_paginator(instance_pages("instance_id_1"))
+    metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR)
+    collector = AwsMetricsCollector(metrics, mocks.session, label_names=["region"], label_values=["eu-west-1"])
+    with mock.patch("time.time", return_value=1000.0):
+        collector.update()
+    with mock.patch("time.time", return_value=1042.0):
+        age_family = list(collector.collect())[1]
+    assert age_family.samples == [
+        Sample("aws_prometheus_exporter_snapshot_age_seconds", {"region": "eu-west-1"}, 42.0)
+    ]
+
+
+MANY_EC2_METRICS_YAML = "".join("""
+ec2_instance_ids_%d:
+  description: EC2 instance ids
+  service: ec2
+  paginator: describe_instances
+  paginator_args:
+    MaxResults: %d
+  label_names:
+    - id
+  search: |
+    Reservations[].Instances[].{id: InstanceId, value: `%d`}[]
+""" % (i, 1000 + i, i) for i in range(8))
+
+
+def create_session_mocks_with_slow_paginator(pages, on_paginate=None):
+    mocks = create_session_mocks_using_paginator(pages)
+
+    def paginate(**_):
+        if on_paginate:
+            on_paginate()
+        time.sleep(0.02)
+        return mocks.paginate_response_iterator
+
+    mocks.paginator.paginate = mock.Mock(side_effect=paginate)
+    return mocks
+
+
+def test_concurrent_collection_matches_sequential_collection():
+    metrics = parse_aws_metrics(MANY_EC2_METRICS_YAML + MULTIPLE_METRICS_YAML)
+    samples = []
+    for max_workers in (1, 4):
+        mocks = create_session_mocks_with_slow_paginator(instance_pages("instance_id_1", "instance_id_2"))
+        mocks.paginate_response_iterator.__iter__ = mock.Mock(side_effect=lambda: iter(instance_pages(
+            "instance_id_1", "instance_id_2"
+        ) + [{"InstanceInformationList": [{"InstanceId": "instance_id_3"}]}]))
+        collector = AwsMetricsCollector(metrics, mocks.session, max_workers=max_workers)
+        collector.update()
+        samples.append([family.samples for family in collector.collect()][:len(metrics)])
+    assert samples[0] == samples[1]
+    assert len(samples[0]) == 10
+    assert samples[0][-1] == [Sample("ssm_agents_ec2_instance_ids", {"id": "instance_id_3"}, 1)]
+
+
+def test_concurrent_collection_honours_per_service_limit():
+    in_flight = {"count": 0, "max": 0}
+    in_flight_lock = threading.Lock()
+
+    def on_paginate():
+        with in_flight_lock:
+            in_flight["count"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["count"])
+        time.sleep(0.02)
+        with in_flight_lock:
+            in_flight["count"] -= 1
+
+    mocks = create_session_mocks_with_slow_paginator([], on_paginate)
+    metrics = parse_aws_metrics(MANY_EC2_METRICS_YAML)
+    collector = AwsMetricsCollector(metrics, mocks.session, max_workers=8, max_workers_per_service=2)
+    collector.update()
+    assert in_flight["max"] == 2
+    assert mocks.paginator.paginate.call_count == 8
+
+
+def test_metrics_sharing_a_call_signature_fetch_pages_once():
+    yaml_string = SINGLE_METRIC_YAML_WITH_PAGINATOR + """
+ec2_instance_count:
+  description: Number of EC2 instances
+  service: ec2
+  paginator: describe_instances
+  paginator_args:
+    Filters:
+      - Name: instance-state-name
+        Values: [ "Running" ]
+  label_names: []
+  search: |
+    Reservations[].{value: length(Instances)}
+"""
+    mocks = create_session_mocks_using_paginator(
+        instance_pages("instance_id_1", "instance_id_2") + instance_pages("instance_id_3")
+    )
+    metrics = parse_aws_metrics(yaml_string)
+    collector = AwsMetricsCollector(metrics, mocks.session)
+    collector.update()
+    ids_family, count_family = list(collector.collect())[:2]
+    mocks.paginator.paginate.assert_called_once_with(Filters=[{
+        "Name": "instance-state-name",
+        "Values": ["Running"]
+    }])
+    mocks.paginate_response_iterator.__iter__.assert_called_once_with()
+    assert [sample.labels["id"] for sample in ids_family.samples] == ["instance_id_1", "instance_id_2", "instance_id_3"]
+    assert count_family.samples == [
+        Sample("ec2_instance_count", {}, 2),
+        Sample("ec2_instance_count", {}, 1),
+    ]
+
+
+def test_load_aws_metric_with_interval():
+    metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR + "  interval: 3600\n")
+    assert metrics[0].interval == 3600
+    assert parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR)[0].interval is None
+    try:
+        parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR + "  interval: -1\n")
+        assert False, "negative intervals should be rejected"
+    except ValueError:
+        pass
+
+
+def test_scheduler_refreshes_each_metric_on_its_own_interval():
+    metrics = parse_aws_metrics(MANY_EC2_METRICS_YAML)
+    metrics = [m._replace(interval=100) if i < 4 else m for (i, m) in enumerate(metrics)]
+    collector = mock.NonCallableMagicMock()
+    collector.metrics = metrics
+    now = {"time": 0.0}
+    scheduler = MetricScheduler(collector, default_interval=400, clock=lambda: now["time"])
+
+    assert scheduler.run_pending() == 100
+    collector.update.assert_called_once_with()
+
+    refreshed = []
+    collector.update_metrics.side_effect = lambda due: refreshed.append((now["time"], [m.name for m in due]))
+    while now["time"] < 800:
+        now["time"] += scheduler.run_pending()
+    # the 4 metrics with a 100s interval are spread 25s apart, the 4 others 100s apart
+    assert refreshed[:6] == [
+        (100, ["ec2_instance_ids_0"]),
+        (125, ["ec2_instance_ids_1"]),
+        (150, ["ec2_instance_ids_2"]),
+        (175, ["ec2_instance_ids_3"]),
+        (200, ["ec2_instance_ids_0"]),
+        (225, ["ec2_instance_ids_1"]),
+    ]
+    refresh_counts = {}
+    for (_, names) in refreshed:
+        for name in names:
+            refresh_counts[name] = refresh_counts.get(name, 0) + 1
+    assert [refresh_counts[m.name] for m in metrics] == [7, 7, 7, 7, 1, 1, 1, 1]
+
+
+def snapshot_samples(snapshot):
+    return {key: list(samples) for (key, samples) in snapshot.data.items()}
+
+
+def test_update_metrics_carries_over_other_metrics():
+    def public_instance_pages(instance_id):
+        return [{"Reservations": [{"Instances": [{"InstanceId": instance_id, "PublicIpAddress": "10.0.0.1"}]}]}]
+
+    mocks = create_session_mocks_using_paginator(
+        public_instance_pages("instance_id_1") + [{"InstanceInformationList": [{"InstanceId": "instance_id_2"}]}]
+    )
+    metrics = parse_aws_metrics(MULTIPLE_METRICS_YAML)
+    collector = AwsMetricsCollector(metrics, mocks.session)
+    with mock.patch("time.time", return_value=1000.0):
+        collector.update()
+    mocks.paginate_response_iterator.__iter__ = mock.Mock(
+        side_effect=lambda: iter(public_instance_pages("instance_id_3"))
+    )
+    with mock.patch("time.time", return_value=1100.0):
+        collector.update_metrics(metrics[:1])
+    snapshot = collector.snapshot()
+    assert snapshot_samples(snapshot) == {
+        (None, "public_ec2_instance_ids"): [(["instance_id_3"], 1)],
+        (None, "ssm_agents_ec2_instance_ids"): [(["instance_id_2"], 1)],
+    }
+    assert snapshot.timestamps == {
+        (None, "public_ec2_instance_ids"): 1100.0,
+        (None, "ssm_agents_ec2_instance_ids"): 1000.0,
+    }
+    assert snapshot.timestamp == 1000.0
+
+
+def test_clients_are_reused_across_updates():
+    mocks = create_session_mocks_using_paginator(instance_pages("instance_id_1"))
+    metrics = parse_aws_metrics(MULTIPLE_METRICS_YAML)
+    collector = AwsMetricsCollector(metrics, mocks.session)
+    collector.update()
+    collector.update()
+    assert mocks.session.client.call_args_list == [call("ec2"), call("ssm")]
+
+
+def test_load_compiles_search_expressions():
+    metric = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR)[0]
+    assert isinstance(metric.search, JmesPathSearch)
+    assert metric.search.search({"Reservations": [{"Instances": [{"InstanceId": "i-1"}]}]}) == [
+        {"id": "i-1", "value": 1}
+    ]
+    with pytest.raises(ValueError, match="invalid search expression"):
+        parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR.replace("{id: InstanceId", "{id: InstanceId,,"))
+
+
+def test_collect_streams_pages_through_compiled_searches():
+    fetched = []
+
+    def pages():
+        for i in range(3):
+            fetched.append(i)
+            yield instance_pages("instance_id_%d" % i)[0]
+
+    mocks = create_session_mocks_using_paginator([])
+    mocks.paginate_response_iterator.__iter__ = mock.Mock(side_effect=pages)
+    metrics = [m._replace(search=str(m.search)) for m in parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR)]
+    collector = AwsMetricsCollector(metrics, mocks.session)
+    assert isinstance(collector.metrics[0].search, JmesPathSearch)
+    with mock.patch("jmespath.search", side_effect=AssertionError("expressions should not be parsed again")):
+        collector.update()
+    assert fetched == [0, 1, 2]
+    assert list(collector.snapshot().data[(None, "ec2_instance_ids")]) == [
+        (["instance_id_0"], 1),
+        (["instance_id_1"], 1),
+        (["instance_id_2"], 1),
+    ]
+
+
+def create_region_session_mock(region_pages, account="111111111111"):
+    """
+    Returns a session mock whose ec2 paginator yields region_pages[region_name], or raises if that is an exception.
+    """
+    def client(service, region_name=None, **_):
+        client_mock = mock.NonCallableMagicMock()
+        if service == "sts":
+            client_mock.get_caller_identity = mock.Mock(return_value={"Account": account})
+            client_mock.assume_role = mock.Mock(return_value={"Credentials": {
+                "AccessKeyId": "key",
+                "SecretAccessKey": "secret",
+                "SessionToken": "token",
+                "Expiration": datetime.datetime(2100, 1, 1, tzinfo=datetime.timezone.utc),
+            }})
+            return client_mock
+
+        def paginate(**_):
+            pages = region_pages[region_name]
+            if isinstance(pages, Exception):
+                raise pages
+            return pages
+
+        client_mock.get_paginator.return_value.paginate = mock.Mock(side_effect=paginate)
+        return client_mock
+
+    session = mock.NonCallableMagicMock()
+    session.client = mock.Mock(side_effect=client)
+    return session
+
+
+def test_collect_from_multiple_targets():
+    session = create_region_session_mock({
+        "us-east-1": instance_pages("instance_id_1"),
+        "eu-west-1": instance_pages("instance_id_2"),
+    })
+    role_session = create_region_session_mock({"eu-west-1": instance_pages("instance_id_3")})
+    metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR)
+    with mock.patch("aws_prometheus_exporter.clients.boto3.Session", return_value=role_session) as session_class:
+        collector = AwsMetricsCollector(metrics, session, ["env"], ["dev"], max_workers=4, targets=[
+            AwsTarget("us-east-1"),
+            AwsTarget("eu-west-1"),
+            AwsTarget("eu-west-1", "arn:aws:iam::222222222222:role/exporter"),
+        ])
+        collector.update()
+        collector.update()
+    session_class.assert_called_once_with(
+        aws_access_key_id="key",
+        aws_secret_access_key="secret",
+        aws_session_token="token"
+    )
+    gauge_family = list(collector.collect())[0]
+    assert gauge_family.samples == [
+        Sample("ec2_instance_ids", {"env": "dev", "region": "us-east-1", "account": "111111111111",
+                                    "id": "instance_id_1"}, 1),
+        Sample("ec2_instance_ids", {"env": "dev", "region": "eu-west-1", "account": "111111111111",
+                                    "id": "instance_id_2"}, 1),
+        Sample("ec2_instance_ids", {"env": "dev", "region": "eu-west-1", "account": "222222222222",
+                                    "id": "instance_id_3"}, 1),
+    ]
+
+
+def test_failing_target_keeps_previous_samples_without_dropping_others():
+    region_pages = {
+        "us-east-1": instance_pages("instance_id_1"),
+        "eu-west-1": instance_pages("instance_id_2"),
+    }
+    session = create_region_session_mock(region_pages)
+    metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR)
+    collector = AwsMetricsCollector(metrics, session, targets=[AwsTarget("us-east-1"), AwsTarget("eu-west-1")])
+    collector.update()
+    region_pages["us-east-1"] = instance_pages("instance_id_3")
+    region_pages["eu-west-1"] = RuntimeError("eu-west-1 is down")
+    collector.update()
+    gauge_family = list(collector.collect())[0]
+    assert [sample.labels["id"] for sample in gauge_family.samples] == ["instance_id_3", "instance_id_2"]
+
+
+def test_collect_reports_throttled_requests():
+    mocks = create_session_mocks_using_paginator(instance_pages("instance_id_1"))
+    metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR)
+    collector = AwsMetricsCollector(metrics, mocks.session, ["env"], ["dev"], rate_limits={"*": 4, "ec2": 8})
+    collector.update()
+    rate_limiter = collector._targets[0].rate_limiter
+    rate_limiter.on_throttle("ec2", "DescribeInstances")
+    rate_limiter.on_throttle("ec2", "DescribeInstances")
+    families = {family.name: family for family in collector.collect()}
+    assert families["aws_prometheus_exporter_throttled_requests"].samples[0] == Sample(
+        "aws_prometheus_exporter_throttled_requests_total",
+        {"env": "dev", "service": "ec2", "operation": "DescribeInstances"},
+        2
+    )
+    assert families["aws_prometheus_exporter_api_rate_limit"].samples == [
+        Sample("aws_prometheus_exporter_api_rate_limit",
+               {"env": "dev", "service": "ec2", "operation": "DescribeInstances"}, 4)
+    ]
+
+
+def sample_values(families, family_name, sample_name=None):
+    family = next(family for family in families if family.name == family_name)
+    return {
+        sample.labels["metric"]: sample.value
+        for sample in family.samples
+        if sample.name == (sample_name or family_name)
+    }
+
+
+def test_collect_reports_per_metric_instrumentation():
+    mocks = create_session_mocks_using_paginator(
+        instance_pages("instance_id_1", "instance_id_2") + instance_pages("instance_id_3")
+    )
+    metrics = parse_aws_metrics(MULTIPLE_METRICS_YAML + SINGLE_METRIC_YAML_WITH_PAGINATOR)
+    collector = AwsMetricsCollector(metrics, mocks.session)
+    mocks.service.get_paginator.side_effect = lambda method: mocks.paginator if method == "describe_instances" else 1
+    with mock.patch("time.time", return_value=1000.0):
+        collector.update()
+    families = list(collector.collect())
+    assert sample_values(
+        families, "aws_prometheus_exporter_metric_pages", "aws_prometheus_exporter_metric_pages_total"
+    ) == {"public_ec2_instance_ids": 2, "ec2_instance_ids": 2, "ssm_agents_ec2_instance_ids": 0}
+    assert sample_values(
+        families, "aws_prometheus_exporter_metric_api_calls", "aws_prometheus_exporter_metric_api_calls_total"
+    ) == {"public_ec2_instance_ids": 0, "ec2_instance_ids": 0, "ssm_agents_ec2_instance_ids": 0}  # mocks send nothing
+    assert sample_values(families, "aws_prometheus_exporter_metric_series") == {
+        "public_ec2_instance_ids": 0,
+        "ec2_instance_ids": 3,
+    }
+    assert sample_values(families, "aws_prometheus_exporter_metric_last_success_timestamp_seconds") == {
+        "public_ec2_instance_ids": 1000.0,
+        "ec2_instance_ids": 1000.0,
+    }
+    assert sample_values(
+        families, "aws_prometheus_exporter_metric_errors", "aws_prometheus_exporter_metric_errors_total"
+    ) == {"ssm_agents_ec2_instance_ids": 1}
+    assert sample_values(
+        families,
+        "aws_prometheus_exporter_metric_collection_duration_seconds",
+        "aws_prometheus_exporter_metric_collection_duration_seconds_count"
+    ) == {"public_ec2_instance_ids": 1, "ec2_instance_ids": 1, "ssm_agents_ec2_instance_ids": 1}
+    update_duration = next(f for f in families if f.name == "aws_prometheus_exporter_update_duration_seconds")
+    assert [s.value for s in update_duration.samples if s.name.endswith("_count")] == [1]
+
+
+
+
+def test_collect_keeps_samples_when_recording_instrumentation_fails():
+    mocks = create_session_mocks_using_paginator(instance_pages("instance_id_1"))
+    metrics = parse_aws_metrics(MULTIPLE_METRICS_YAML + SINGLE_METRIC_YAML_WITH_PAGINATOR)
+    mocks.service.get_paginator.side_effect = lambda method: mocks.paginator if method == "describe_instances" else 1
+    collector = AwsMetricsCollector(metrics, mocks.session, max_workers=2)
+    with mock.patch.object(collector._instrumentation, "observe_collection", side_effect=ValueError("bad labels")):
+        collector.update()
+    assert list(collector.snapshot().data[(None, "ec2_instance_ids")]) == [(["instance_id_1"], 1)]
+
+
+class RawBody:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **_):
+        yield self.body
+
+
+def test_collect_counts_the_api_requests_sent_including_retries():
+    session = boto3.Session(aws_access_key_id="key", aws_secret_access_key="secret", region_name="us-east-1")
+    responses = [
+        (503, b"<Response><Errors><Error><Code>InternalError</Code><Message>Oops</Message></Error></Errors>"
+              b"<RequestID>1</RequestID></Response>"),
+        (200, b'<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/"><requestId>2</requestId>'
+              b'<reservationSet/></DescribeInstancesResponse>'),
+    ]
+
+    def respond(request, **_):
+        (status, body) = responses.pop(0)
+        return AWSResponse(request.url, status, {}, RawBody(body))
+
+    def create_client(service, **kwargs):
+        client = boto3.Session.client(session, service, **kwargs)
+        client.meta.events.register("before-send", respond)
+        return client
+
+    metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR_WITH_SERVICE_METHOD)
+    collector = AwsMetricsCollector(metrics, session)
+    with mock.patch.object(session, "client", side_effect=create_client):
+        collector.update()
+    families = list(collector.collect())
+    assert responses == []
+    assert sample_values(
+        families, "aws_prometheus_exporter_metric_api_calls", "aws_prometheus_exporter_metric_api_calls_total"
+    ) == {"ec2_instance_ids": 2}
+    assert sample_values(
+        families, "aws_prometheus_exporter_metric_pages", "aws_prometheus_exporter_metric_pages_total"
+    ) == {"ec2_instance_ids": 1}
+
+
+AGGREGATED_METRICS_YAML = """
+ec2_instance_count:
+  description: Number of EC2 instances by type
+  service: ec2
+  paginator: describe_instances
+  search: |
+    Reservations[].Instances[].{instance_type: InstanceType}
+  aggregate:
+    by:
+      - instance_type
+    function: count
+
+ec2_largest_cpu_count:
+  description: Largest number of CPU cores of EC2 instances by type
+  service: ec2
+  paginator: describe_instances
+  label_names:
+    - instance_type
+  search: |
+    Reservations[].Instances[].{instance_type: InstanceType, value: CpuOptions.CoreCount}
+  aggregate:
+    function: max
+"""
+
+
+def test_load_aggregated_aws_metrics():
+    metrics = parse_aws_metrics(AGGREGATED_METRICS_YAML)
+    assert [(m.label_names, m.aggregate) for m in metrics] == [(["instance_type"], "count"), (["instance_type"], "max")]
+    with pytest.raises(ValueError, match="invalid aggregate function 'avg'"):
+        parse_aws_metrics(AGGREGATED_METRICS_YAML.replace("function: count", "function: avg"))
+    with pytest.raises(ValueError, match="differ from its aggregate 'by'"):
+        parse_aws_metrics(AGGREGATED_METRICS_YAML.replace("function: max", "by: [id]\n    function: max"))
+
+
+def test_collect_aggregates_samples_across_pages():
+    def instance(instance_type, core_count):
+        return {"InstanceType": instance_type, "CpuOptions": {"CoreCount": core_count}}
+
+    mocks = create_session_mocks_using_paginator([
+        {"Reservations": [{"Instances": [instance("t3.micro", 1), instance("m5.large", 2)]}]},
+        {"Reservations": [{"Instances": [instance("t3.micro", 1)]}, {"Instances": [instance("m5.large", 4)]}]},
+    ])
+    collector = AwsMetricsCollector(parse_aws_metrics(AGGREGATED_METRICS_YAML), mocks.session, ["env"], ["dev"])
+    collector.update()
+    mocks.paginate_response_iterator.__iter__.assert_called_once_with()
+    assert snapshot_samples(collector.snapshot()) == {
+        (None, "ec2_instance_count"): [(["dev", "t3.micro"], 2), (["dev", "m5.large"], 2)],
+        (None, "ec2_largest_cpu_count"): [(["dev", "t3.micro"], 1), (["dev", "m5.large"], 4)],
+    }
+
+
+def test_snapshot_stores_samples_in_columns_of_interned_label_values():
+    mocks = create_session_mocks_using_paginator([
+        {"Reservations": [{"Instances": [{"InstanceId": "i-1"}, {"InstanceId": "i-2"}, {"InstanceId": None}]}]},
+    ])
+    metrics = parse_aws_metrics(MULTIPLE_METRICS_YAML.replace("[?PublicIpAddress]", "[]") + """
+ec2_instance_ids:
+  description: EC2 instance ids
+  service: ec2
+  paginator: describe_instances
+  label_names:
+    - id
+  search: |
+    Reservations[].Instances[].{id: InstanceId, value: `2`}
+""")
+    collector = AwsMetricsCollector(metrics, mocks.session, ["env"], ["dev"])
+    collector.update()
+    first = collector.snapshot().data[(None, "public_ec2_instance_ids")]
+    collector.update()
+    second = collector.snapshot().data[(None, "public_ec2_instance_ids")]
+    other = collector.snapshot().data[(None, "ec2_instance_ids")]
+    assert list(second) == [(["dev", "i-1"], 1), (["dev", "i-2"], 1), (["dev", "<null>"], 1)]
+    assert list(second.columns[0]) == [0, 1, 2] and second.values.typecode == "d"
+    assert second.strings[0] is first.strings[0] is other.strings[0]
+
+
+def test_collect_rejects_search_results_without_labels():
+    mocks = create_session_mocks_using_paginator([{"InstanceInformationList": [{"value": 1}]}])
+    metrics = [parse_aws_metrics(MULTIPLE_METRICS_YAML)[1]._replace(search="InstanceInformationList")]
+    collector = AwsMetricsCollector(metrics, mocks.session)
+    with pytest.raises(ValueError, match="must be dicts with the keys \\['id'\\] \\+ 'value'"):
+        collector._collect_call_group(collector._targets[0], collector.metrics, mock.Mock(count_pages=iter))
+
+
+def test_collect_rejects_aggregated_values_which_are_not_numbers():
+    metrics = [parse_aws_metrics(AGGREGATED_METRICS_YAML)[1]._replace(aggregate="sum")]
+    mocks = create_session_mocks_using_paginator([{"Reservations": [{"Instances": [
+        {"InstanceType": "t3.micro", "CpuOptions": {"CoreCount": "1"}},
+        {"InstanceType": "t3.micro", "CpuOptions": {"CoreCount": "2"}},
+    ]}]}])
+    collector = AwsMetricsCollector(metrics, mocks.session)
+    with pytest.raises(ValueError, match="metric 'ec2_largest_cpu_count' must be dicts .* value '1' is not a number"):
+        collector._collect_call_group(collector._targets[0], collector.metrics, mock.Mock(count_pages=iter))
+
+
+INCREMENTAL_METRIC_YAML = """
+emr_cluster_ids:
+  description: EMR cluster ids
+  service: emr
+  paginator: list_clusters
+  paginator_args: |
+    {"CreatedAfter": datetime.now() - timedelta(days=7)}
+  label_names:
+    - id
+  search: |
+    Clusters[].{id: Id, value: `1`}
+  incremental:
+    watermark_arg: CreatedAfter
+    items: Clusters
+    timestamp: Status.Timeline.CreationDateTime
+    key: Id
+"""
+
+
+def test_collect_evaluates_paginator_args_on_every_refresh():
+    now = [datetime.datetime(2020, 1, 10)]
+
+    class FakeDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now[0]
+
+    mocks = create_session_mocks_using_paginator([])
+    metrics = [m._replace(incremental=None) for m in parse_aws_metrics(INCREMENTAL_METRIC_YAML)]
+    collector = AwsMetricsCollector(metrics, mocks.session)
+    with mock.patch.dict(aws_prometheus_exporter.METHOD_ARGS_GLOBALS, {"datetime": FakeDatetime}):
+        collector.update()
+        now[0] = datetime.datetime(2020, 1, 11)
+        collector.update()
+    assert mocks.paginator.paginate.call_args_list == [
+        call(CreatedAfter=datetime.datetime(2020, 1, 3)),
+        call(CreatedAfter=datetime.datetime(2020, 1, 4)),
+    ]
+
+
+def test_incremental_collection_fetches_items_newer_than_the_watermark():
+    def cluster(cluster_id, day):
+        created = datetime.datetime(2020, 1, day, tzinfo=datetime.timezone.utc)
+        return {"Id": cluster_id, "Status": {"Timeline": {"CreationDateTime": created}}}
+
+    now = [datetime.datetime(2020, 1, 10)]
+
+    class FakeDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now[0]
+
+    responses = [
+        [{"Clusters": [cluster("j-1", 3)]}, {"Clusters": [cluster("j-2", 5)]}],
+        [{"Clusters": [cluster("j-2", 5), cluster("j-3", 11)]}],
+    ]
+    mocks = create_session_mocks_using_paginator([])
+    mocks.paginate_response_iterator.__iter__ = mock.Mock(side_effect=lambda: iter(responses.pop(0)))
+    collector = AwsMetricsCollector(parse_aws_metrics(INCREMENTAL_METRIC_YAML), mocks.session)
+    with mock.patch.dict(aws_prometheus_exporter.METHOD_ARGS_GLOBALS, {"datetime": FakeDatetime}):
+        collector.update()
+        now[0] = datetime.datetime(2020, 1, 11)
+        collector.update()
+    assert mocks.paginator.paginate.call_args_list == [
+        call(CreatedAfter=datetime.datetime(2020, 1, 3)),
+        call(CreatedAfter=datetime.datetime(2020, 1, 5, tzinfo=datetime.timezone.utc)),
+    ]
+    assert list(collector.snapshot().data[(None, "emr_cluster_ids")]) == [(["j-2"], 1), (["j-3"], 1)]
+
+
+def test_update_async_matches_update():
+    metrics = parse_aws_metrics(MANY_EC2_METRICS_YAML + MULTIPLE_METRICS_YAML)
+    samples = []
+    for use_async in (False, True):
+        mocks = create_session_mocks_with_slow_paginator([])
+        mocks.paginate_response_iterator.__iter__ = mock.Mock(side_effect=lambda: iter(instance_pages(
+            "instance_id_1", "instance_id_2"
+        ) + [{"InstanceInformationList": [{"InstanceId": "instance_id_3"}]}]))
+        collector = AwsMetricsCollector(metrics, mocks.session, max_workers_per_service=2)
+        if use_async:
+            asyncio.run(collector.update_async(concurrency=4))
+        else:
+            collector.update()
+        samples.append([family.samples for family in collector.collect()][:len(metrics)])
+    assert samples[0] == samples[1]
+
+
+def test_update_async_times_out_slow_calls_and_keeps_previous_samples():
+    mocks = create_session_mocks_using_paginator(instance_pages("instance_id_1"))
+    metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR)
+    collector = AwsMetricsCollector(metrics, mocks.session)
+    asyncio.run(collector.update_async())
+    release = threading.Event()
+
+    def slow_paginate(**_):
+        release.wait(5)
+        return mocks.paginate_response_iterator
+
+    mocks.paginator.paginate.side_effect = slow_paginate
+    try:
+        asyncio.run(collector.update_async(call_timeout=0.05))
+    finally:
+        release.set()
+    assert [s.labels["id"] for s in list(collector.collect())[0].samples] == ["instance_id_1"]
+    families = list(collector.collect())
+    assert sample_values(
+        families, "aws_prometheus_exporter_metric_errors", "aws_prometheus_exporter_metric_errors_total"
+    ) == {"ec2_instance_ids": 1}
+
+
+def test_cancelled_update_async_leaves_snapshot_unchanged():
+    started = threading.Event()
+    release = threading.Event()
+    mocks = create_session_mocks_using_paginator(instance_pages("instance_id_1"))
+
+    def slow_paginate(**_):
+        started.set()
+        release.wait(5)
+        return mocks.paginate_response_iterator
+
+    mocks.paginator.paginate.side_effect = slow_paginate
+    collector = AwsMetricsCollector(parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR), mocks.session)
+    snapshot = collector.snapshot()
+
+    async def cancel_update():
+        task = asyncio.ensure_future(collector.update_async())
+        while not started.is_set():
+            await asyncio.sleep(0.001)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    try:
+        asyncio.run(cancel_update())
+    finally:
+        release.set()
+    assert collector.snapshot() is snapshot
+
+
+def test_scheduler_runs_async():
+    mocks = create_session_mocks_using_paginator(instance_pages("instance_id_1"))
+    collector = AwsMetricsCollector(parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR), mocks.session)
+    scheduler = MetricScheduler(collector, 0.01)
+
+    async def run_briefly():
+        stop_event = asyncio.Event()
+        asyncio.get_running_loop().call_later(0.1, stop_event.set)
+        await scheduler.run_async(stop_event)
+
+    asyncio.run(run_briefly())
+    assert mocks.paginator.paginate.call_count > 2
+    assert [s.labels["id"] for s in list(collector.collect())[0].samples] == ["instance_id_1"]
+
+
+def many_metrics_yaml(count):
+    return "".join("""
+metric_%d:
+  description: Metric %d
+  service: ec2
+  paginator: describe_instances
+  paginator_args:
+    MaxResults: %d
+  label_names:
+    - id
+  search: |
+    Reservations[].Instances[].{id: InstanceId, value: `1`}
+  cost: %d
+""" % (index, index, index, 1 + index % 5) for index in range(count))
+
+
+def test_shards_split_metrics_by_cost():
+    metrics_yaml = many_metrics_yaml(200) + SINGLE_METRIC_YAML_WITH_PAGINATOR.replace("ec2_instance_ids", "shared")
+    metrics_yaml += SINGLE_METRIC_YAML_WITH_PAGINATOR
+    all_metrics = parse_aws_metrics(metrics_yaml)
+    shards = [parse_aws_metrics(metrics_yaml, shard_index, 4) for shard_index in range(4)]
+    assert sorted(m.name for shard in shards for m in shard) == sorted(m.name for m in all_metrics)
+    assert any({"shared", "ec2_instance_ids"} <= {m.name for m in shard} for shard in shards)
+    total_cost = sum(m.cost or 1 for m in all_metrics)
+    for shard in shards:
+        assert sum(m.cost or 1 for m in shard) <= 1.25 * total_cost / 4
+
+
+def test_adding_a_shard_moves_few_metrics():
+    metrics = parse_aws_metrics(many_metrics_yaml(400))
+
+    def assignments(shard_count):
+        return {
+            metric.name: shard_index
+            for shard_index in range(shard_count)
+            for metric in shard_metrics(metrics, shard_index, shard_count)
+        }
+
+    (before, after) = (assignments(4), assignments(5))
+    moved = [name for name in before if before[name] != after[name]]
+    assert len(moved) < 0.35 * len(before)
+    with pytest.raises(ValueError, match="shard_index"):
+        shard_metrics(metrics, 5, 5)
+
+
+def test_set_metrics_keeps_state_of_unchanged_metrics():
+    mocks = create_session_mocks_using_paginator(
+        instance_pages("instance_id_1") + [{"InstanceInformationList": [{"InstanceId": "instance_id_2"}]}]
+    )
+    metrics = parse_aws_metrics(MULTIPLE_METRICS_YAML.replace("[?PublicIpAddress]", "[]"))
+    collector = AwsMetricsCollector(metrics, mocks.session)
+    now = {"time": 0.0}
+    scheduler = MetricScheduler(collector, default_interval=100, clock=lambda: now["time"])
+    scheduler.run_pending()
+    unchanged = collector.metrics[0]
+
+    reloaded = parse_aws_metrics(
+        MULTIPLE_METRICS_YAML.replace("[?PublicIpAddress]", "[]").replace("SSM agent", "an SSM agent")
+        + SINGLE_METRIC_YAML_WITH_PAGINATOR_WITH_SERVICE_METHOD
+    )
+    changed = collector.set_metrics(reloaded)
+    assert [m.name for m in changed] == ["ssm_agents_ec2_instance_ids", "ec2_instance_ids"]
+    assert collector.metrics[0] is unchanged
+    assert set(collector.snapshot().data) == {(None, "public_ec2_instance_ids")}
+    assert b"an SSM agent" in collector.exposition().text
+
+    refreshed = []
+    collector.update_metrics = lambda due: refreshed.append([m.name for m in due])
+    now["time"] = 10.0
+    assert scheduler.run_pending() == 90.0
+    assert refreshed == [["ssm_agents_ec2_instance_ids", "ec2_instance_ids"]]
+
+
+def test_reloader_rejects_invalid_metrics_file(tmp_path):
+    metrics_file = tmp_path / "metrics.yaml"
+    metrics_file.write_text(SINGLE_METRIC_YAML_WITH_PAGINATOR)
+    mocks = create_session_mocks_using_paginator(instance_pages("instance_id_1"))
+    collector = AwsMetricsCollector(parse_aws_metrics(metrics_file.read_text()), mocks.session)
+    collector.update()
+    reloader = aws_prometheus_exporter.MetricsFileReloader(str(metrics_file), collector)
+
+    metrics_file.write_text(SINGLE_METRIC_YAML_WITH_PAGINATOR.replace("search:", "searches:"))
+    assert reloader.reload() is None
+    assert [m.name for m in collector.metrics] == ["ec2_instance_ids"]
+    assert list(collector.snapshot().data) == [(None, "ec2_instance_ids")]
+
+    metrics_file.write_text(SINGLE_METRIC_YAML_WITH_PAGINATOR + MULTIPLE_METRICS_YAML)
+    assert [m.name for m in reloader.reload()] == ["public_ec2_instance_ids", "ssm_agents_ec2_instance_ids"]
+    assert list(collector.snapshot().data) == [(None, "ec2_instance_ids")]
+
+
+def test_scrapes_share_a_single_refresh_of_metrics_older_than_max_age():
+    metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR + "  max_age: 60\n")
+    assert metrics[0].max_age == 60
+    release_refresh = threading.Event()
+    mocks = create_session_mocks_with_slow_paginator(
+        instance_pages("instance_id_1"), on_paginate=lambda: release_refresh.wait(5)
+    )
+    collector = AwsMetricsCollector(metrics, mocks.session, scrape_timeout=0.05)
+
+    scrapes = [threading.Thread(target=lambda: list(collector.collect())) for _ in range(2)]
+    for scrape in scrapes:
+        scrape.start()
+    for scrape in scrapes:
+        scrape.join(5)
+    # both scrapes timed out, and were served the (empty) previous samples meanwhile
+    assert collector.snapshot().data == {}
+    release_refresh.set()
+    assert collector.refresh_stale_metrics(timeout=5)
+    assert mocks.paginator.paginate.call_count == 1
+    assert list(collector.collect())[0].samples == [Sample("ec2_instance_ids", {"id": "instance_id_1"}, 1)]
+    assert mocks.paginator.paginate.call_count == 1
+
+    with mock.patch("time.time", return_value=time.time() + 60):
+        assert collector.refresh_stale_metrics(timeout=5)
+    assert mocks.paginator.paginate.call_count == 2
+
+
+def test_scrapes_refresh_stale_metrics_in_a_single_bounded_update():
+    metrics = parse_aws_metrics("".join(
+        SINGLE_METRIC_YAML_WITH_PAGINATOR.replace("ec2_instance_ids:", "ec2_instance_ids_%d:" % index)
+                                         .replace('"Running"', '"state_%d"' % index) + "  max_age: 60\n"
+        for index in range(20)
+    ))
+    mocks = create_session_mocks_using_paginator(instance_pages("instance_id_1"))
+    lock = threading.Lock()
+    active = []
+    peak = []
+
+    def paginate(**_):
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        time.sleep(0.01)
+        with lock:
+            active.pop()
+        return mocks.paginate_response_iterator
+
+    mocks.paginator.paginate = mock.Mock(side_effect=paginate)
+    collector = AwsMetricsCollector(metrics, mocks.session, max_workers=2, max_workers_per_service=1)
+    with mock.patch.object(collector, "_finish_update", wraps=collector._finish_update) as finish_update:
+        assert collector.refresh_stale_metrics(timeout=5)
+    assert mocks.paginator.paginate.call_count == 20
+    assert max(peak) == 1
+    assert finish_update.call_count == 1
+    assert len(collector.snapshot().data) == 20
+
+
+def test_registering_the_collector_makes_no_api_calls():
+    mocks = create_session_mocks_using_paginator(instance_pages("instance_id_1"))
+    metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR + "  max_age: 60\n")
+    collector = AwsMetricsCollector(metrics, mocks.session)
+    registry = CollectorRegistry(auto_describe=True)  # as the default REGISTRY is
+    registry.register(collector)
+    mocks.session.client.assert_not_called()
+    assert registry.get_sample_value("ec2_instance_ids", {"id": "instance_id_1"}) == 1
+    assert mocks.paginator.paginate.call_count == 1
+
+
+def test_collectors_sharing_a_registry_yield_the_exporter_metrics_once():
+    registry = CollectorRegistry()
+    collectors = [
+        AwsMetricsCollector(parse_aws_metrics(yaml), create_session_mocks_using_paginator([]).session,
+                            exporter_metrics=exporter_metrics)
+        for (yaml, exporter_metrics) in ((SINGLE_METRIC_YAML_WITH_PAGINATOR, True), (MULTIPLE_METRICS_YAML, False))
+    ]
+    registry.register(collectors[0])
+    registry.register(collectors[1])
+    assert [family.name for family in collectors[1].describe()] == [
+        "public_ec2_instance_ids", "ssm_agents_ec2_instance_ids"
+    ]
+    with pytest.raises(ValueError, match="Duplicated timeseries"):
+        registry.register(AwsMetricsCollector([], create_session_mocks_using_paginator([]).session))
+
+
+def test_scheduler_leaves_metrics_with_max_age_to_scrapes():
+    metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR + "  max_age: 60\n" + MULTIPLE_METRICS_YAML)
+    collector = mock.NonCallableMagicMock()
+    collector.metrics = metrics
+    now = {"time": 0.0}
+    scheduler = MetricScheduler(collector, default_interval=100, clock=lambda: now["time"])
+    assert scheduler.run_pending() == 100.0
+    collector.update_metrics.assert_called_once_with(metrics[1:])
+    now["time"] = 200.0
+    scheduler.run_pending()
+    refreshed = [m.name for (args, _) in collector.update_metrics.call_args_list for m in args[0]]
+    assert sorted(set(refreshed)) == ["public_ec2_instance_ids", "ssm_agents_ec2_instance_ids"]
+
+
+def endless_describe_instances(delay=0):
+    def describe_instances(**_):
+        time.sleep(delay)
+        return {"Reservations": [{"Instances": [{"InstanceId": "instance_id_2"}]}], "NextToken": "more"}
+    return describe_instances
+
+
+def test_metrics_exceeding_their_timeout_keep_previous_samples():
+    metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR_WITH_SERVICE_METHOD + "  timeout: 0.1\n")
+    assert metrics[0].timeout == 0.1
+    session = mock.NonCallableMagicMock()
+    service = session.client.return_value
+    service.describe_instances.return_value = instance_pages("instance_id_1")[0]
+    collector = AwsMetricsCollector(metrics, session)
+    collector.update()
+
+    service.describe_instances.side_effect = endless_describe_instances(delay=0.01)
+    start_time = time.monotonic()
+    collector.update()
+    assert time.monotonic() - start_time < 2
+    families = list(collector.collect())
+    assert [s.labels["id"] for s in families[0].samples] == ["instance_id_1"]
+    assert sample_values(
+        families, "aws_prometheus_exporter_metric_timeouts", "aws_prometheus_exporter_metric_timeouts_total"
+    ) == {"ec2_instance_ids": 1}
+
+
+def test_calls_returning_more_than_max_pages_fail():
+    metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR_WITH_SERVICE_METHOD)
+    session = mock.NonCallableMagicMock()
+    session.client.return_value.describe_instances.side_effect = endless_describe_instances()
+    collector = AwsMetricsCollector(metrics, session, max_pages=3)
+    collector.update()
+    assert session.client.return_value.describe_instances.call_count == 4
+    families = list(collector.collect())
+    assert families[0].samples == []
+    assert sample_values(
+        families, "aws_prometheus_exporter_metric_errors", "aws_prometheus_exporter_metric_errors_total"
+    ) == {"ec2_instance_ids": 1}
+
+
+def test_metrics_not_collected_within_the_cycle_budget_are_skipped():
+    metrics = parse_aws_metrics(SINGLE_METRIC_YAML_WITH_PAGINATOR_WITH_SERVICE_METHOD + MULTIPLE_METRICS_YAML)
+    mocks = create_session_mocks_using_paginator(instance_pages("instance_id_1"))
+    mocks.service.describe_instances.side_effect = endless_describe_instances(delay=0.01)
+    collector = AwsMetricsCollector(metrics, mocks.session, cycle_budget=0.1)
+    collector.update()
+    families = list(collector.collect())
+    assert all(family.samples == [] for family in families[:3])
+    assert sample_values(
+        families, "aws_prometheus_exporter_metric_timeouts", "aws_prometheus_exporter_metric_timeouts_total"
+    ) == {"ec2_instance_ids": 1, "public_ec2_instance_ids": 1, "ssm_agents_ec2_instance_ids": 1}
+    mocks.paginator.paginate.assert_not_called()
+
+
+def test_max_series_keeps_the_series_with_the_highest_values():
+    metrics_yaml = """
+ec2_cpu_count:
+  description: Number of CPU cores of EC2 instances
+  service: ec2
+  paginator: describe_instances
+  label_names:
+    - id
+  search: |
+    Reservations[].Instances[].{id: InstanceId, value: CpuOptions.CoreCount}
+  max_series: 3
+""" + AGGREGATED_METRICS_YAML.replace("    function: count\n", "    function: count\n  max_series: 1\n")
+    metrics = parse_aws_metrics(metrics_yaml)
+    assert [m.max_series for m in metrics] == [3, 1, None]
+    with pytest.raises(ValueError, match="invalid max_series '0'"):
+        parse_aws_metrics(metrics_yaml.replace("max_series: 3", "max_series: 0"))
+
+    def instance(instance_id, instance_type, core_count):
+        return {"InstanceId": instance_id, "InstanceType": instance_type, "CpuOptions": {"CoreCount": core_count}}
+
+    mocks = create_session_mocks_using_paginator([
+        {"Reservations": [{"Instances": [instance("i-1", "t3.micro", 1), instance("i-2", "m5.large", 8)]}]},
+        {"Reservations": [{"Instances": [instance("i-3", "t3.micro", 2), instance("i-4", "t3.micro", 4)]}]},
+        {"Reservations": [{"Instances": [instance("i-5", "m5.large", 4), instance("i-6", "m5.large", 1)]}]},
+    ])
+    collector = AwsMetricsCollector(metrics, mocks.session)
+    collector.update()
+    assert snapshot_samples(collector.snapshot()) == {
+        (None, "ec2_cpu_count"): [(["i-2"], 8), (["i-4"], 4), (["i-5"], 4)],
+        (None, "ec2_instance_count"): [(["t3.micro"], 3)],
+        (None, "ec2_largest_cpu_count"): [(["t3.micro"], 4), (["m5.large"], 8)],
+    }
+    families = list(collector.collect())
+    assert sample_values(families, "aws_prometheus_exporter_metric_dropped_series") == {
+        "ec2_cpu_count": 3, "ec2_instance_count": 1
+    }
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import threading
+from unittest import mock
+
+import pytest
+
+from aws_prometheus_exporter.clients import AssumedRoleCredentials, ClientPool, account_from_role_arn
+
+
+def test_client_pool_reuses_clients():
+    session = mock.NonCallableMagicMock()
+    session.client = mock.Mock(side_effect=lambda service, **_: mock.NonCallableMagicMock(name=service))
+    pool = ClientPool(session)
+    ec2 = pool.client("ec2")
+    assert pool.client("ec2") is ec2
+    assert pool.client("ec2", "eu-west-1") is not ec2
+    assert pool.client("s3") is not ec2
+    assert session.client.call_args_list == [
+        mock.call("ec2"),
+        mock.call("ec2", region_name="eu-west-1"),
+        mock.call("s3"),
+    ]
+    pool.clear()
+    assert pool.client("ec2") is not ec2
+
+
+def test_client_pool_passes_config_to_clients():
+    session = mock.NonCallableMagicMock()
+    config = mock.sentinel.config
+    ClientPool(session, config).client("ec2")
+    session.client.assert_called_once_with("ec2", config=config)
+
+
+def test_client_pool_creates_each_client_once_across_threads():
+    session = mock.NonCallableMagicMock()
+    session.client = mock.Mock(side_effect=lambda service, **_: object())
+    pool = ClientPool(session)
+    barrier = threading.Barrier(8)
+    clients = []
+
+    def get_client():
+        barrier.wait()
+        clients.append(pool.client("ec2"))
+
+    threads = [threading.Thread(target=get_client) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert session.client.call_count == 1
+    assert len(set(id(client) for client in clients)) == 1
+
+
+def test_client_pools_sharing_a_lock_never_use_the_session_concurrently():
+    active = []
+    overlaps = []
+
+    def create_client(service, **_):
+        active.append(service)
+        if len(active) > 1:
+            overlaps.append(list(active))
+        threading.Event().wait(0.01)
+        active.remove(service)
+        return object()
+
+    session = mock.NonCallableMagicMock()
+    session.client = mock.Mock(side_effect=create_client)
+    first = ClientPool(session)
+    second = ClientPool(session, lock=first.lock)
+    assert second.lock is first.lock
+    barrier = threading.Barrier(2)
+
+    def get_client(pool, region_name):
+        barrier.wait()
+        pool.client("ec2", region_name)
+
+    threads = [threading.Thread(target=get_client, args=args)
+               for args in ((first, "eu-west-1"), (second, "us-east-1"))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert session.client.call_count == 2
+    assert overlaps == []
+
+
+def assume_role_response(access_key_id, expiration):
+    return {"Credentials": {
+        "AccessKeyId": access_key_id,
+        "SecretAccessKey": "secret",
+        "SessionToken": "token",
+        "Expiration": datetime.datetime.fromtimestamp(expiration, datetime.timezone.utc),
+    }}
+
+
+def test_assumed_role_credentials_are_cached_until_they_expire():
+    sts = mock.NonCallableMagicMock()
+    sts.assume_role = mock.Mock(side_effect=[
+        assume_role_response("key_1", expiration=3600),
+        assume_role_response("key_2", expiration=7200),
+    ])
+    now = {"time": 0}
+    credentials = AssumedRoleCredentials(sts, "arn:aws:iam::123456789012:role/r", clock=lambda: now["time"])
+    first = credentials.get()
+    assert first["aws_access_key_id"] == "key_1"
+    now["time"] = 3000
+    assert credentials.get() is first
+    now["time"] = 3400
+    assert credentials.get()["aws_access_key_id"] == "key_2"
+    sts.assume_role.assert_called_with(
+        RoleArn="arn:aws:iam::123456789012:role/r",
+        RoleSessionName="aws-prometheus-exporter"
+    )
+
+
+def test_client_pool_recreates_clients_when_credentials_are_refreshed():
+    credentials = mock.NonCallableMagicMock()
+    credentials.get = mock.Mock(side_effect=[{"aws_access_key_id": "key_1"}] * 2 + [{"aws_access_key_id": "key_2"}])
+    with mock.patch("aws_prometheus_exporter.clients.boto3.Session") as session_class:
+        session_class.return_value.client = mock.Mock(side_effect=lambda service, **_: object())
+        pool = ClientPool(None, credentials=credentials)
+        ec2 = pool.client("ec2", "us-east-1")
+        assert pool.client("ec2", "us-east-1") is ec2
+        assert pool.client("ec2", "us-east-1") is not ec2
+    assert session_class.call_args_list == [mock.call(aws_access_key_id="key_1"), mock.call(aws_access_key_id="key_2")]
+
+
+def test_account_from_role_arn():
+    assert account_from_role_arn("arn:aws:iam::123456789012:role/exporter") == "123456789012"
+    with pytest.raises(ValueError):
+        account_from_role_arn("exporter")
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+from unittest import mock
+
+import pytest
+
+from aws_prometheus_exporter import AwsMetricsCollector, AwsTarget, parse_aws_metrics
+from aws_prometheus_exporter.cloudwatch import get_metric_data_pages, merge_latest_values, metric_data_query
+
+CLOUDWATCH_METRICS_YAML = """
+ec2_cpu_utilization:
+  description: Average CPU utilization of EC2 instances
+  cloudwatch:
+    namespace: AWS/EC2
+    metric_name: CPUUtilization
+    statistic: Average
+    period: 60
+    dimensions:
+%s
+  label_names:
+    - instance_id
+ec2_network_in:
+  description: Bytes received by EC2 instances
+  cloudwatch:
+    namespace: AWS/EC2
+    metric_name: NetworkIn
+    statistic: Sum
+    dimensions:
+      InstanceId: i-0
+sqs_visible_messages:
+  description: Messages available in SQS queues
+  cloudwatch:
+    namespace: AWS/SQS
+    metric_name: ApproximateNumberOfMessagesVisible
+    statistic: Maximum
+    dimensions:
+      QueueName: jobs
+"""
+
+
+def cloudwatch_metrics_yaml(instance_count):
+    return CLOUDWATCH_METRICS_YAML % "".join("      - InstanceId: i-%d\n" % index for index in range(instance_count))
+
+
+def fake_get_metric_data(requests, missing=()):
+    """
+    Returns a get_metric_data side effect recording the requests made, and answering each query over two pages with
+    the number in its id as latest value, except for the queries in missing, which have no datapoint.
+    """
+    def get_metric_data(**kwargs):
+        requests.append(kwargs)
+        results = [
+            {"Id": query["Id"], "Values": [] if query["Id"] in missing else [float(query["Id"][1:]), -1.0]}
+            for query in kwargs["MetricDataQueries"]
+        ]
+        if "NextToken" not in kwargs:
+            return {"MetricDataResults": results[:1], "NextToken": "token"}
+        return {"MetricDataResults": results[1:]}
+    return get_metric_data
+
+
+def test_get_metric_data_packs_queries_into_requests_of_500():
+    queries = [metric_data_query("q%d" % i, "AWS/EC2", "CPUUtilization", {"InstanceId": "i-%d" % i}, "Average", 60)
+               for i in range(1001)]
+    client = mock.NonCallableMagicMock()
+    requests = []
+    client.get_metric_data.side_effect = fake_get_metric_data(requests, missing={"q7"})
+    end_time = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    values = {}
+    for page in get_metric_data_pages(client, queries, end_time):
+        merge_latest_values(values, page)
+    assert [len(request["MetricDataQueries"]) for request in requests] == [500, 500, 500, 500, 1, 1]
+    assert [request.get("NextToken") for request in requests] == [None, "token"] * 3
+    assert requests[0]["StartTime"] == end_time - datetime.timedelta(minutes=3)
+    assert requests[0]["ScanBy"] == "TimestampDescending"
+    assert queries[1]["MetricStat"]["Metric"]["Dimensions"] == [{"Name": "InstanceId", "Value": "i-1"}]
+    assert len(values) == 1000 and "q7" not in values
+    assert values["q0"] == 0.0 and values["q1000"] == 1000.0
+
+
+def test_get_metric_data_requests_complete_periods_only():
+    queries = [
+        metric_data_query("q0", "AWS/EC2", "CPUUtilization", {"InstanceId": "i-0"}, "Average", 60),
+        metric_data_query("q1", "AWS/EC2", "NetworkIn", {"InstanceId": "i-0"}, "Sum", 300),
+    ]
+    client = mock.NonCallableMagicMock()
+    requests = []
+    client.get_metric_data.side_effect = fake_get_metric_data(requests)
+    end_time = datetime.datetime(2020, 1, 1, 12, 7, 42, 500000, tzinfo=datetime.timezone.utc)
+    list(get_metric_data_pages(client, queries, end_time))
+    assert requests[0]["EndTime"] == datetime.datetime(2020, 1, 1, 12, 5, tzinfo=datetime.timezone.utc)
+    assert requests[0]["StartTime"] == datetime.datetime(2020, 1, 1, 11, 50, tzinfo=datetime.timezone.utc)
+
+
+def test_collect_cloudwatch_metrics_in_batched_requests():
+    metrics = parse_aws_metrics(cloudwatch_metrics_yaml(600))
+    assert metrics[0].cloudwatch.dimensions[1] == {"InstanceId": "i-1"}
+    assert metrics[1].label_names == ["InstanceId"] and metrics[1].cloudwatch.period == 300
+    session = mock.NonCallableMagicMock()
+    requests = []
+    session.client.return_value.get_metric_data.side_effect = fake_get_metric_data(requests, missing={"q600"})
+    session.client.return_value.get_caller_identity.return_value = {"Account": "123456789012"}
+    targets = [AwsTarget("us-east-1"), AwsTarget("eu-west-1")]
+    collector = AwsMetricsCollector(metrics, session, max_workers=4, targets=targets)
+    collector.update()
+
+    # in each region: 601 AWS/EC2 queries in 2 requests, and 1 AWS/SQS query
+    assert sorted(len(request["MetricDataQueries"]) for request in requests if "NextToken" not in request) == [
+        1, 1, 101, 101, 500, 500
+    ]
+    families = {family.name: family.samples for family in collector.collect()}
+    cpu = {(s.labels["region"], s.labels["instance_id"]): s.value for s in families["ec2_cpu_utilization"]}
+    assert len(cpu) == 2 * 600
+    assert cpu[("us-east-1", "i-0")] == 0.0 and cpu[("eu-west-1", "i-599")] == 599.0
+    assert {s.labels["account"] for s in families["ec2_cpu_utilization"]} == {"123456789012"}
+    assert families["ec2_network_in"] == []  # no datapoint
+    assert [(s.labels["QueueName"], s.value) for s in families["sqs_visible_messages"]] == [("jobs", 0.0)] * 2
+
+
+def test_load_rejects_invalid_cloudwatch_metrics():
+    with pytest.raises(ValueError, match="missing mandatory cloudwatch field 'statistic'"):
+        parse_aws_metrics(cloudwatch_metrics_yaml(1).replace("statistic: Average", ""))
+    with pytest.raises(ValueError, match="cloudwatch dimensions with different names"):
+        parse_aws_metrics(cloudwatch_metrics_yaml(1).replace("- InstanceId: i-0", "- InstanceId: i-0\n      - Id: 1"))
+    with pytest.raises(ValueError, match="cannot have both 'cloudwatch' and 'search'"):
+        parse_aws_metrics(cloudwatch_metrics_yaml(1) + "  search: '[]'\n")
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import urllib.request
+from unittest import mock
+
+from prometheus_client import CollectorRegistry, Counter
+from prometheus_client.exposition import generate_latest
+
+from aws_prometheus_exporter import AwsMetricsCollector, RenderedExposition, parse_aws_metrics, start_exposition_server
+from aws_prometheus_exporter.exposition import accepts_gzip
+
+METRICS_YAML = """
+ec2_instance_ids:
+  description: EC2 instance ids
+  service: ec2
+  paginator: describe_instances
+  label_names:
+    - id
+  search: |
+    Reservations[].Instances[].{id: InstanceId, value: `1`}[]
+
+ssm_instance_ids:
+  description: SSM instance ids
+  service: ssm
+  paginator: describe_instance_information
+  label_names:
+    - id
+  search: |
+    InstanceInformationList[].{id: InstanceId, value: `1`}[]
+"""
+
+
+def create_collector(instance_ids):
+    session = mock.NonCallableMagicMock()
+    page = {
+        "Reservations": [{"Instances": [{"InstanceId": instance_id} for instance_id in instance_ids]}],
+        "InstanceInformationList": [{"InstanceId": "mi-1"}],
+    }
+    session.client.return_value.get_paginator.return_value.paginate = mock.Mock(side_effect=lambda **_: [page])
+    return AwsMetricsCollector(parse_aws_metrics(METRICS_YAML), session)
+
+
+def test_rendered_exposition_appends_suffix_to_cached_gzip_stream():
+    exposition = RenderedExposition(b"a 1\n" * 1000)
+    assert exposition.body(b"b 2\n") == b"a 1\n" * 1000 + b"b 2\n"
+    for suffix in (b"b 2\n", b"c 3\n", b""):
+        assert gzip.decompress(exposition.body(suffix, gzip=True)) == b"a 1\n" * 1000 + suffix
+
+
+def test_accepts_gzip():
+    assert accepts_gzip("gzip")
+    assert accepts_gzip("deflate, gzip;q=0.5")
+    assert accepts_gzip("*")
+    assert not accepts_gzip("gzip;q=0")
+    assert not accepts_gzip("*;q=0.5, gzip;q=0")
+    assert not accepts_gzip("gzip;q=0, *")
+    assert accepts_gzip("*;q=0, gzip")
+    assert not accepts_gzip("identity")
+    assert not accepts_gzip(None)
+
+
+def test_exposition_matches_collect():
+    collector = create_collector(["i-1", "i-2"])
+    collector.update()
+    families = list(collector.collect())[:2]
+    assert collector.exposition().text == generate_latest(mock.Mock(collect=lambda: families))
+
+
+def test_exposition_only_renders_families_which_changed():
+    collector = create_collector(["i-1"])
+    collector.update()
+    with mock.patch("aws_prometheus_exporter.render_families", side_effect=lambda f: b"") as render_families:
+        collector.update_metrics(collector.metrics[:1])
+    assert [[family.name for family in call[0][0]] for call in render_families.call_args_list] == [
+        ["ec2_instance_ids"]
+    ]
+
+
+def test_exposition_server_negotiates_gzip():
+    collector = create_collector(["i-1"])
+    collector.update()
+    registry = CollectorRegistry()
+    Counter("other_metric", "Some other metric", registry=registry).inc()
+    server = start_exposition_server(0, collector, registry, addr="127.0.0.1")
+    try:
+        url = "http://127.0.0.1:%d/metrics" % server.server_port
+        with urllib.request.urlopen(url) as response:
+            assert response.headers.get("Content-Encoding") is None
+            plain = response.read()
+        request = urllib.request.Request(url, headers={"Accept-Encoding": "gzip"})
+        with urllib.request.urlopen(request) as response:
+            assert response.headers["Content-Encoding"] == "gzip"
+            assert response.headers["Vary"] == "Accept-Encoding"
+            compressed = gzip.decompress(response.read())
+    finally:
+        server.shutdown()
+        server.server_close()
+    for body in (plain, compressed):
+        assert body.startswith(collector.exposition().text)
+        assert b'ec2_instance_ids{id="i-1"} 1.0' in body
+        assert b"aws_prometheus_exporter_snapshot_age_seconds" in body
+        assert b"other_metric_total 1.0" in body
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+from unittest import mock
+
+import pytest
+
+from aws_prometheus_exporter import AwsMetricsCollector, MetricScheduler, parse_aws_metrics
+from aws_prometheus_exporter.persistence import load_snapshot_file, save_snapshot_file
+from aws_prometheus_exporter.samples import SampleTableBuilder
+
+METRICS_YAML = """
+ec2_instance_ids:
+  description: EC2 instance ids
+  service: ec2
+  paginator: describe_instances
+  label_names:
+    - id
+    - name
+  search: |
+    Reservations[].Instances[].{id: InstanceId, name: Name, value: `1`}[]
+"""
+
+
+def create_session_mock(*instances):
+    session = mock.NonCallableMagicMock()
+    paginator = session.client.return_value.get_paginator.return_value
+    paginator.paginate.return_value = [{"Reservations": [{"Instances": list(instances)}]}]
+    return session
+
+
+def family_samples(collector, name):
+    family = next(family for family in collector.collect() if family.name == name)
+    return [(sample.labels, sample.value) for sample in family.samples]
+
+
+def test_snapshot_file_round_trip(tmp_path):
+    builder = SampleTableBuilder(["dev", "é"], 2, {})
+    builder.add(("i-1", "web"), 1)
+    builder.add(("i-2", None), 2.5)
+    empty = SampleTableBuilder([], 0, {})
+    empty.add((), 3)
+    path = str(tmp_path / "snapshot")
+    save_snapshot_file(path, [(["a", "b"], 12.5, builder.build()), (["c"], 1.0, empty.build())])
+    assert [(key, timestamp, list(table)) for (key, timestamp, table) in load_snapshot_file(path)] == [
+        (["a", "b"], 12.5, [(["dev", "é", "i-1", "web"], 1), (["dev", "é", "i-2", "<null>"], 2.5)]),
+        (["c"], 1.0, [([], 3)]),
+    ]
+    with open(path, "r+b") as snapshot_file:
+        snapshot_file.truncate(100)
+    with pytest.raises(ValueError):
+        load_snapshot_file(path)
+
+
+def test_collector_serves_persisted_snapshot_as_stale_until_refreshed(tmp_path):
+    path = str(tmp_path / "snapshot")
+    metrics = parse_aws_metrics(METRICS_YAML)
+    session = create_session_mock({"InstanceId": "i-1", "Name": "web"})
+    collector = AwsMetricsCollector(metrics, session, ["env"], ["dev"], snapshot_path=path)
+    with mock.patch("time.time", return_value=1000.0):
+        collector.update()
+
+    restarted = AwsMetricsCollector(metrics, create_session_mock({"InstanceId": "i-2"}), ["env"], ["dev"],
+                                    snapshot_path=path)
+    assert restarted.load_snapshot() == 1
+    assert restarted.snapshot().timestamp == 1000.0
+    assert family_samples(restarted, "ec2_instance_ids") == [({"env": "dev", "id": "i-1", "name": "web"}, 1)]
+    assert family_samples(restarted, "aws_prometheus_exporter_snapshot_stale") == [({"env": "dev"}, 1)]
+    assert b'id="i-1"' in restarted.exposition().text
+
+    restarted.update()
+    assert family_samples(restarted, "ec2_instance_ids") == [({"env": "dev", "id": "i-2", "name": "<null>"}, 1)]
+    assert family_samples(restarted, "aws_prometheus_exporter_snapshot_stale") == [({"env": "dev"}, 0)]
+
+
+def test_collector_ignores_persisted_samples_of_changed_metrics(tmp_path):
+    path = str(tmp_path / "snapshot")
+    collector = AwsMetricsCollector(parse_aws_metrics(METRICS_YAML), create_session_mock({"InstanceId": "i-1"}),
+                                    snapshot_path=path)
+    collector.update()
+    changed = parse_aws_metrics(METRICS_YAML.replace("    - name\n", "").replace(", name: Name", ""))
+    restarted = AwsMetricsCollector(changed, create_session_mock(), snapshot_path=path)
+    assert restarted.load_snapshot() == 0
+    with open(path, "wb") as snapshot_file:
+        snapshot_file.write(b"not a snapshot")
+    assert restarted.load_snapshot() == 0
+
+
+def test_scheduler_waits_for_startup_jitter():
+    collector = mock.NonCallableMagicMock()
+    collector.metrics = parse_aws_metrics(METRICS_YAML)
+    now = {"time": 0.0}
+    scheduler = MetricScheduler(collector, 60, clock=lambda: now["time"], startup_jitter=10, jitter=lambda: 0.5)
+    assert scheduler.run_pending() == 5.0
+    collector.update.assert_not_called()
+    now["time"] = 5.0
+    assert scheduler.run_pending() == 60.0
+    collector.update.assert_called_once_with()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+import urllib.error
+import urllib.request
+from unittest import mock
+
+import pytest
+
+from aws_prometheus_exporter import AwsMetricsCollector, parse_aws_metrics, start_exposition_server
+from aws_prometheus_exporter.profiling import UpdateProfiler
+
+METRICS_YAML = """
+ec2_instance_ids:
+  description: EC2 instance ids
+  service: ec2
+  paginator: describe_instances
+  label_names:
+    - id
+  search: |
+    Reservations[].Instances[].{id: InstanceId, value: `1`}[]
+
+ec2_instance_count:
+  description: Number of EC2 instances by type
+  service: ec2
+  paginator: describe_instances
+  search: |
+    Reservations[].Instances[].{instance_type: InstanceType}[]
+  aggregate:
+    by:
+      - instance_type
+    function: count
+"""
+
+
+def create_collector():
+    session = mock.NonCallableMagicMock()
+    pages = [
+        {"Reservations": [{"Instances": [{"InstanceId": "i-%d-%d" % (page, index), "InstanceType": "t3.micro"}
+                                         for index in range(100)]}]}
+        for page in range(3)
+    ]
+    session.client.return_value.get_paginator.return_value.paginate = mock.Mock(side_effect=lambda **_: pages)
+    return AwsMetricsCollector(parse_aws_metrics(METRICS_YAML), session)
+
+
+def phase_calls(report):
+    """
+    Returns a dict of (metric, phase) to the number of calls of the breakdown table of report.
+    """
+    table = report.split("Time and memory by metric and phase:\n", 1)[1].split("\n\n", 1)[0]
+    rows = [line.split() for line in table.splitlines()[1:]]
+    return {(row[0], row[1]): int(row[2]) for row in rows}
+
+
+def test_profiles_the_next_update_cycles(tmp_path):
+    collector = create_collector()
+    report_path = tmp_path / "profile.txt"
+    profiler = collector.start_profiling(cycles=2, report_path=str(report_path))
+    with pytest.raises(ValueError, match="already being profiled"):
+        collector.start_profiling()
+    collector.update()
+    assert collector.profile_report() is None and not profiler.done.is_set()
+    asyncio.run(collector.update_async())
+    assert profiler.done.is_set()
+
+    report = collector.profile_report()
+    assert report_path.read_text() == report
+    assert report.startswith("Profile of 2 update cycles")
+    assert phase_calls(report) == {
+        ("ec2_instance_count", "fetch"): 8,
+        ("ec2_instance_count", "search"): 6,
+        ("ec2_instance_count", "convert"): 6,
+        ("ec2_instance_count", "build"): 2,
+        ("ec2_instance_ids", "fetch"): 8,
+        ("ec2_instance_ids", "search"): 6,
+        ("ec2_instance_ids", "convert"): 6,
+        ("ec2_instance_ids", "build"): 2,
+    }
+    assert "Top 20 allocation sites" in report
+    assert "_collect_metric" in report.split("(cProfile):", 1)[1]
+
+    # the next cycles are not profiled
+    collector.update()
+    assert collector.profile_report() == report
+    assert collector.start_profiling() is not profiler
+
+
+def test_profiles_metrics_collected_concurrently():
+    session = mock.NonCallableMagicMock()
+    barrier = threading.Barrier(2, timeout=5)
+
+    def paginate(**_):
+        barrier.wait()  # both call groups are being collected at once
+        return [{"Reservations": [{"Instances": [{"InstanceId": "i-0", "InstanceType": "t3.micro"}]}]}]
+
+    session.client.return_value.get_paginator.return_value.paginate = mock.Mock(side_effect=paginate)
+    metrics = parse_aws_metrics(METRICS_YAML)
+    metrics[1] = metrics[1]._replace(method="describe_spot_instances")  # a call group of its own
+    collector = AwsMetricsCollector(metrics, session, max_workers=2)
+    profiler = collector.start_profiling(cycles=1)
+    collector.update()
+    assert profiler.done.is_set()
+    families = {family.name: family for family in collector.collect()}
+    assert [sample.value for sample in families["ec2_instance_ids"].samples] == [1]
+    assert [sample.value for sample in families["ec2_instance_count"].samples] == [1]
+    assert phase_calls(collector.profile_report())[("ec2_instance_ids", "build")] == 1
+    assert "function calls" in collector.profile_report().split("(cProfile):", 1)[1]
+
+
+def test_profiler_runs_calls_without_cprofile_while_another_is_profiled():
+    profiler = UpdateProfiler(1)
+    assert profiler.run(profiler.run, sum, [1, 2]) == 3
+
+
+def test_exposition_server_serves_the_profile_report():
+    collector = create_collector()
+    server = start_exposition_server(0, collector, None, addr="127.0.0.1")
+    try:
+        url = "http://127.0.0.1:%d/debug/profile" % server.server_port
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url)
+        assert error.value.code == 404
+        collector.start_profiling()
+        collector.update()
+        with urllib.request.urlopen(url) as response:
+            assert response.headers["Content-Type"] == "text/plain; charset=utf-8"
+            assert response.read().decode("utf-8") == collector.profile_report()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_profiler_rejects_invalid_cycles():
+    with pytest.raises(ValueError):
+        UpdateProfiler(0)
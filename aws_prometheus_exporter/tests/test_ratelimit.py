@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import boto3
+from botocore.awsrequest import AWSResponse
+
+from aws_prometheus_exporter import AdaptiveRateLimiter
+from aws_prometheus_exporter.ratelimit import TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.time = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.time
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.time += seconds
+
+
+def test_token_bucket_allows_bursts_up_to_capacity_then_waits():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=2, clock=clock, sleep=clock.sleep)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0.5
+    clock.time += 10
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0.5
+
+
+def test_rate_limiter_uses_configured_rates():
+    limiter = AdaptiveRateLimiter({"ec2": 20, "ec2.DescribeInstances": 5}, default_rate=1)
+    limiter.acquire("ec2", "DescribeInstances")
+    limiter.acquire("ec2", "DescribeVolumes")
+    limiter.acquire("s3", "ListBuckets")
+    assert limiter.rates() == {
+        ("ec2", "DescribeInstances"): 5,
+        ("ec2", "DescribeVolumes"): 20,
+        ("s3", "ListBuckets"): 1,
+    }
+
+
+def test_rate_limiter_decreases_multiplicatively_and_increases_additively():
+    clock = FakeClock()
+    limiter = AdaptiveRateLimiter({"ec2": 8}, min_rate=1, increase_per_second=1, clock=clock, sleep=clock.sleep)
+    limiter.on_throttle("ec2", "DescribeInstances")
+    limiter.on_throttle("ec2", "DescribeInstances")  # within a second of the previous decrease: ignored
+    assert limiter.rates()[("ec2", "DescribeInstances")] == 4
+    for _ in range(3):
+        clock.time += 1
+        limiter.on_throttle("ec2", "DescribeInstances")
+    assert limiter.rates()[("ec2", "DescribeInstances")] == 1
+    assert limiter.throttled_counts() == {("ec2", "DescribeInstances"): 5}
+    for _ in range(1000):
+        limiter.on_success("ec2", "DescribeInstances")
+    assert limiter.rates()[("ec2", "DescribeInstances")] == 8
+
+
+def test_rate_limiter_backoff_is_jittered_and_capped():
+    limiter = AdaptiveRateLimiter(base_delay=1, max_delay=10, jitter=lambda: 0.5)
+    assert [limiter.backoff(attempts) for attempts in range(1, 6)] == [0.5, 1, 2, 4, 5]
+
+
+class RawBody:
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **_):
+        yield self.body
+
+
+THROTTLED_RESPONSE = (503, b"<Response><Errors><Error><Code>RequestLimitExceeded</Code><Message>Slow down</Message>"
+                           b"</Error></Errors><RequestID>1</RequestID></Response>")
+SUCCESSFUL_RESPONSE = (200, b'<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">'
+                            b'<requestId>2</requestId><reservationSet/></DescribeInstancesResponse>')
+
+
+def create_client_with_responses(responses):
+    session = boto3.Session(aws_access_key_id="key", aws_secret_access_key="secret", region_name="us-east-1")
+    client = session.client("ec2")
+
+    def respond(request, **_):
+        (status, body) = responses.pop(0)
+        return AWSResponse(request.url, status, {}, RawBody(body))
+
+    return client, respond
+
+
+def test_registered_rate_limiter_retries_throttled_requests():
+    clock = FakeClock()
+    client, respond = create_client_with_responses([THROTTLED_RESPONSE, THROTTLED_RESPONSE, SUCCESSFUL_RESPONSE])
+    limiter = AdaptiveRateLimiter({"ec2": 10}, clock=clock, sleep=clock.sleep, jitter=lambda: 0)
+    limiter.register(client)
+    client.meta.events.register("before-send", respond)
+    response = client.describe_instances()
+    assert response["Reservations"] == []
+    assert response["ResponseMetadata"]["RetryAttempts"] == 2
+    assert limiter.throttled_counts() == {("ec2", "DescribeInstances"): 2}
+    assert limiter.rates()[("ec2", "DescribeInstances")] < 10
+
+
+def test_registered_rate_limiter_gives_up_after_max_attempts():
+    clock = FakeClock()
+    client, respond = create_client_with_responses([THROTTLED_RESPONSE] * 3)
+    limiter = AdaptiveRateLimiter(max_attempts=3, clock=clock, sleep=clock.sleep, jitter=lambda: 0)
+    limiter.register(client)
+    client.meta.events.register("before-send", respond)
+    try:
+        client.describe_instances()
+        assert False, "the throttling error should be raised after 3 attempts"
+    except client.exceptions.ClientError as e:
+        assert e.response["Error"]["Code"] == "RequestLimitExceeded"
+    assert limiter.throttled_counts() == {("ec2", "DescribeInstances"): 3}
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the CPU time spent obtaining boto3 clients during a refresh, with and without a ClientPool.
+No API call is made: only client creation is measured, which is what the pool saves on every refresh.
+
+Usage (from the repository root): python -m benchmarks.bench_client_pool [--metrics 80] [--refreshes 5]
+"""
+
+import time
+import argparse
+
+import boto3
+
+from aws_prometheus_exporter import ClientPool
+
+SERVICES = ["ec2", "s3", "emr", "ssm", "rds", "elbv2", "autoscaling", "lambda"]
+
+
+def create_session():
+    return boto3.Session(
+        aws_access_key_id="AKIDEXAMPLE",
+        aws_secret_access_key="secret",
+        region_name="us-east-1",
+    )
+
+
+def refresh(get_client, metric_count):
+    for i in range(metric_count):
+        get_client(SERVICES[i % len(SERVICES)])
+
+
+def measure(get_client, metric_count, refreshes):
+    timings = []
+    for _ in range(refreshes):
+        start = time.process_time()
+        refresh(get_client, metric_count)
+        timings.append(time.process_time() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ClientPool benchmark")
+    parser.add_argument("--metrics", type=int, default=80, help="metrics per refresh")
+    parser.add_argument("--refreshes", type=int, default=5, help="number of refreshes")
+    args = parser.parse_args()
+
+    session = create_session()
+    uncached = measure(session.client, args.metrics, args.refreshes)
+    pool = ClientPool(create_session())
+    pooled = measure(pool.client, args.metrics, args.refreshes)
+
+    print("%d metrics per refresh, %d refreshes" % (args.metrics, args.refreshes))
+    print("%-24s %12s %12s" % ("", "first (ms)", "steady (ms)"))
+    for (name, timings) in (("session.client()", uncached), ("ClientPool.client()", pooled)):
+        steady = sum(timings[1:]) / max(1, len(timings) - 1)
+        print("%-24s %12.1f %12.1f" % (name, timings[0] * 1000, steady * 1000))
+    steady_uncached = sum(uncached[1:]) / max(1, len(uncached) - 1)
+    steady_pooled = sum(pooled[1:]) / max(1, len(pooled) - 1)
+    print("CPU saved per refresh: %.1f ms" % ((steady_uncached - steady_pooled) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of AwsMetricsCollector.update() and of scrapes, against a local fake EC2 endpoint serving synthetic
+describe_instances pages (see synthetic.py). No network access or AWS credentials are needed.
+
+For each scenario (number of instances), reports:
+- refresh: wall time of update(), median of --repeat runs
+- scrape: wall time of serving the pre-rendered exposition (gzip), and of rendering collect() through prometheus_client
+- peak / retained memory: traced by tracemalloc during a separate update() (tracemalloc slows things down, so it is not
+  enabled while timing), and the number of memory blocks still allocated after it
+
+Usage (from the repository root): python -m benchmarks.bench_collector [--sizes 1000 10000 100000] [--json out.json]
+"""
+
+import gc
+import sys
+import time
+import json
+import argparse
+import statistics
+import tracemalloc
+
+from prometheus_client.exposition import generate_latest
+
+from aws_prometheus_exporter import AwsMetricsCollector, parse_aws_metrics
+from benchmarks.synthetic import EndpointSession, FakeEc2Endpoint
+
+METRICS_YAML = """
+ec2_instance_info:
+  description: EC2 instances
+  service: ec2
+  paginator: describe_instances
+  label_names:
+    - instance_id
+    - instance_type
+    - availability_zone
+    - team
+  search: |
+    Reservations[].Instances[].{
+      instance_id: InstanceId,
+      instance_type: InstanceType,
+      availability_zone: Placement.AvailabilityZone,
+      team: Tags[?Key=='team'] | [0].Value,
+      value: `1`
+    }
+
+ec2_instance_state_code:
+  description: EC2 instance state codes
+  service: ec2
+  paginator: describe_instances
+  label_names:
+    - instance_id
+    - state
+  search: |
+    Reservations[].Instances[].{instance_id: InstanceId, state: State.Name, value: State.Code}
+"""
+
+
+def median_time(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def run_scenario(item_count, repeat, page_size, max_workers):
+    metrics = parse_aws_metrics(METRICS_YAML)
+    with FakeEc2Endpoint(item_count, page_size) as endpoint:
+        session = EndpointSession(endpoint.url)
+        collector = AwsMetricsCollector(metrics, session, max_workers=max_workers)
+        collector.update()  # creates clients and connections, and loads the service models into session
+
+        refresh_seconds = median_time(collector.update, repeat)
+        cached_scrape_seconds = median_time(
+            lambda: collector.exposition().body(collector.render_exporter_metrics(), gzip=True),
+            max(repeat, 10)
+        )
+        collect_scrape_seconds = median_time(lambda: generate_latest(collector), repeat)
+        series = sum(len(samples) for samples in collector.snapshot().data.values())
+        exposition_bytes = len(collector.exposition().text)
+
+        del collector
+        gc.collect()
+        blocks_before = sys.getallocatedblocks()
+        tracemalloc.start()
+        collector = AwsMetricsCollector(metrics, session, max_workers=max_workers)
+        collector.update()
+        (retained_bytes, peak_bytes) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        gc.collect()
+        retained_blocks = sys.getallocatedblocks() - blocks_before
+        requests = endpoint.requests
+
+    return {
+        "items": item_count,
+        "series": series,
+        "requests": requests,
+        "refresh_seconds": refresh_seconds,
+        "cached_scrape_seconds": cached_scrape_seconds,
+        "collect_scrape_seconds": collect_scrape_seconds,
+        "exposition_bytes": exposition_bytes,
+        "peak_bytes": peak_bytes,
+        "retained_bytes": retained_bytes,
+        "retained_blocks": retained_blocks,
+    }
+
+
+def print_results(results):
+    columns = [
+        ("items", "%10d", 1),
+        ("series", "%10d", 1),
+        ("refresh_seconds", "%12.3f", 1),
+        ("cached_scrape_seconds", "%12.2f", 1000),
+        ("collect_scrape_seconds", "%12.2f", 1000),
+        ("peak_bytes", "%10.1f", 1.0 / 2 ** 20),
+        ("retained_bytes", "%10.1f", 1.0 / 2 ** 20),
+        ("retained_blocks", "%10d", 1),
+    ]
+    headers = ["items", "series", "refresh (s)", "scrape (ms)", "collect (ms)", "peak MiB", "kept MiB", "kept blocks"]
+    print(" ".join(header.rjust(len(fmt % 0)) for ((_, fmt, _), header) in zip(columns, headers)))
+    for result in results:
+        print(" ".join(fmt % (result[key] * scale) for (key, fmt, scale) in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline AwsMetricsCollector benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="instances per scenario")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per measurement")
+    parser.add_argument("--page-size", type=int, default=1000, help="instances per describe_instances page")
+    parser.add_argument("--max-workers", type=int, default=1, help="max_workers of the collector")
+    parser.add_argument("--json", metavar="PATH", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = [run_scenario(size, args.repeat, args.page_size, args.max_workers) for size in args.sizes]
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the memory retained by the samples of a snapshot, stored as they used to be (a list of (list of label values,
+value) tuples, referencing the strings parsed from the API responses) and as SampleTable columns of interned label
+values. Label values are copied for every sample, as they are when botocore parses each response.
+
+Usage (from the repository root): python -m benchmarks.bench_sample_storage [--sizes 10000 200000]
+"""
+
+import gc
+import time
+import argparse
+import tracemalloc
+
+from aws_prometheus_exporter.samples import SampleTableBuilder
+from benchmarks.synthetic import synthetic_instance
+
+LABEL_VALUES = ["prod", "us-east-1", "123456789012"]
+LABEL_NAMES = ["InstanceId", "InstanceType", "AvailabilityZone", "Team"]
+
+
+def parsed_responses(item_count):
+    for index in range(item_count):
+        instance = synthetic_instance(index)
+        # new str objects for every response, as parsed by botocore
+        yield {name: instance[name].encode("utf-8").decode("utf-8") for name in LABEL_NAMES}
+
+
+def list_storage(item_count):
+    samples = []
+    for response in parsed_responses(item_count):
+        samples.append((LABEL_VALUES + [response[name] for name in LABEL_NAMES], 1))
+    return samples
+
+
+def table_storage(item_count):
+    builder = SampleTableBuilder(LABEL_VALUES, len(LABEL_NAMES), {})
+    for response in parsed_responses(item_count):
+        builder.add(tuple(response[name] for name in LABEL_NAMES), 1)
+    return builder.build()
+
+
+def measure(storage, item_count):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    samples = storage(item_count)
+    duration = time.perf_counter() - start
+    gc.collect()
+    (retained, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del samples
+    return (retained, peak, duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory used by the samples of a snapshot")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 200000], help="samples per scenario")
+    args = parser.parse_args()
+    print("%10s %12s %14s %14s %12s" % ("samples", "storage", "retained MiB", "bytes/sample", "build (s)"))
+    for item_count in args.sizes:
+        for (name, storage) in (("list", list_storage), ("SampleTable", table_storage)):
+            (retained, _, duration) = measure(storage, item_count)
+            print("%10d %12s %14.1f %14.1f %12.3f" % (
+                item_count, name, retained / 2.0 ** 20, retained / float(item_count), duration
+            ))
+
+
+if __name__ == "__main__":
+    main()
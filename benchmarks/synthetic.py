@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic AWS responses for offline benchmarks: a generator of describe_instances-style pages, and a local fake
+EC2 endpoint serving them over HTTP, so that benchmarks go through botocore's HTTP and response parsing like the
+real thing does, without any network access or AWS credentials.
+"""
+
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import boto3
+
+INSTANCE_TYPES = ["t3.micro", "t3.large", "m5.large", "m5.xlarge", "c5.2xlarge", "r5.4xlarge"]
+AVAILABILITY_ZONES = ["us-east-1a", "us-east-1b", "us-east-1c", "us-east-1d"]
+STATES = [(16, "running")] * 8 + [(80, "stopped"), (0, "pending")]
+TEAMS = ["core", "data", "web", "infra", "ml"]
+INSTANCES_PER_RESERVATION = 4
+
+
+def synthetic_instance(index):
+    """
+    Returns a dict describing the index-th synthetic instance. The same index always gives the same instance.
+    """
+    (state_code, state_name) = STATES[index % len(STATES)]
+    return {
+        "InstanceId": "i-%017x" % index,
+        "InstanceType": INSTANCE_TYPES[index % len(INSTANCE_TYPES)],
+        "AvailabilityZone": AVAILABILITY_ZONES[(index // 7) % len(AVAILABILITY_ZONES)],
+        "StateCode": state_code,
+        "StateName": state_name,
+        "PrivateIpAddress": "10.%d.%d.%d" % ((index >> 16) & 255, (index >> 8) & 255, index & 255),
+        "Team": TEAMS[(index // 3) % len(TEAMS)],
+        "Name": "instance-%d" % index,
+    }
+
+
+def _instance_xml(instance):
+    return (
+        "<item>"
+        "<instanceId>{InstanceId}</instanceId>"
+        "<imageId>ami-0123456789abcdef0</imageId>"
+        "<instanceState><code>{StateCode}</code><name>{StateName}</name></instanceState>"
+        "<privateDnsName>ip-{PrivateIpAddress}.ec2.internal</privateDnsName>"
+        "<instanceType>{InstanceType}</instanceType>"
+        "<launchTime>2020-01-01T00:00:00.000Z</launchTime>"
+        "<placement><availabilityZone>{AvailabilityZone}</availabilityZone><tenancy>default</tenancy></placement>"
+        "<monitoring><state>disabled</state></monitoring>"
+        "<privateIpAddress>{PrivateIpAddress}</privateIpAddress>"
+        "<architecture>x86_64</architecture>"
+        "<rootDeviceType>ebs</rootDeviceType>"
+        "<tagSet>"
+        "<item><key>Name</key><value>{Name}</value></item>"
+        "<item><key>team</key><value>{Team}</value></item>"
+        "</tagSet>"
+        "</item>"
+    ).format(**instance)
+
+
+def describe_instances_page_xml(item_count, page_index, page_size):
+    """
+    Returns the XML body of the page_index-th page of a describe_instances response listing item_count instances.
+    """
+    start = page_index * page_size
+    end = min(item_count, start + page_size)
+    reservations = []
+    for reservation_start in range(start, end, INSTANCES_PER_RESERVATION):
+        instances = "".join(
+            _instance_xml(synthetic_instance(index))
+            for index in range(reservation_start, min(end, reservation_start + INSTANCES_PER_RESERVATION))
+        )
+        reservations.append(
+            "<item><reservationId>r-%017x</reservationId><ownerId>123456789012</ownerId>"
+            "<instancesSet>%s</instancesSet></item>" % (reservation_start, instances)
+        )
+    next_token = "<nextToken>%d</nextToken>" % (page_index + 1) if end < item_count else ""
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">'
+        "<requestId>00000000-0000-0000-0000-000000000000</requestId>"
+        "<reservationSet>%s</reservationSet>%s"
+        "</DescribeInstancesResponse>" % ("".join(reservations), next_token)
+    ).encode("utf-8")
+
+
+class FakeEc2Endpoint:
+    """
+    A local HTTP server answering DescribeInstances calls with item_count synthetic instances, page_size per page.
+    Pages are rendered once, and then served from memory.
+    """
+
+    def __init__(self, item_count, page_size=1000):
+        self.item_count = item_count
+        self.page_size = page_size
+        self.requests = 0
+        page_count = max(1, -(-item_count // page_size))
+        self._pages = [describe_instances_page_xml(item_count, index, page_size) for index in range(page_count)]
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self._server.server_port
+
+    def page(self, index):
+        """
+        Returns the XML body of the DescribeInstances response page at index.
+        """
+        return self._pages[index]
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler_class(self):
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                form = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8"))
+                page_index = int(form.get("NextToken", ["0"])[0])
+                body = endpoint.page(page_index)
+                endpoint.requests += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "text/xml;charset=UTF-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                pass
+
+        return Handler
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class EndpointSession:
+    """
+    A boto3 session whose clients all send their requests to endpoint_url, with fake credentials.
+    """
+
+    def __init__(self, endpoint_url, region_name="us-east-1"):
+        self._endpoint_url = endpoint_url
+        self._session = boto3.Session(
+            aws_access_key_id="AKIDEXAMPLE",
+            aws_secret_access_key="secret",
+            region_name=region_name,
+        )
+
+    def client(self, service, **kwargs):
+        return self._session.client(service, endpoint_url=self._endpoint_url, **kwargs)